@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+Scrape time and size of /metrics in the multiprocess mode against the number
+of distinct destinations, for each destination label policy.
+
+Usage: PYTHONPATH=src python benchmarks/scrape_cardinality.py [destinations ...]
+
+Each run counts one notification per destination from 5 worker processes,
+then times the collection of the registry as done by the exporter.
+"""
+
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+POLICIES = ['raw', 'hash', 'bucket', 'top', 'none']
+WORKERS = 5
+SCRAPES = 5
+
+
+def _worker(destinations: int, worker: int):
+    import metrics
+    for i in range(destinations):
+        if i % WORKERS == worker:
+            metrics.notification_sent('email', f'subscription {i % 50}', f'user{i}@example.com')
+            metrics.notification_error('email', f'subscription {i % 50}',
+                                       f'user{i}@example.com', ConnectionError(f'error {i}'))
+
+
+def run(destinations: int):
+    """Runs in a fresh interpreter with the policy set in the environment."""
+    from prometheus_client import generate_latest
+    import metrics
+    procs = [multiprocessing.Process(target=_worker, args=(destinations, w))
+             for w in range(WORKERS)]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
+    files = os.listdir(os.environ['PROMETHEUS_MULTIPROC_DIR'])
+    size = sum(os.path.getsize(os.path.join(os.environ['PROMETHEUS_MULTIPROC_DIR'], f))
+               for f in files)
+    start = time.perf_counter()
+    for _ in range(SCRAPES):
+        body = generate_latest(metrics.registry)
+    elapsed = (time.perf_counter() - start) / SCRAPES
+    print(f'{elapsed * 1000:.1f} {len(body)} {size}')
+
+
+def main(sizes):
+    print(f'{"policy":<8}{"destinations":>14}{"scrape ms":>12}{"body KiB":>10}{"mmap KiB":>10}')
+    for destinations in sizes:
+        for policy in POLICIES:
+            with tempfile.TemporaryDirectory() as tmp:
+                env = dict(os.environ, PROMETHEUS_MULTIPROC_DIR=tmp,
+                           METRICS_DESTINATION_LABELS=policy)
+                out = subprocess.run([sys.executable, __file__, '--run', str(destinations)],
+                                     env=env, check=True, capture_output=True, text=True)
+                ms, body, size = out.stdout.split()
+                print(f'{policy:<8}{destinations:>14}{float(ms):>12.1f}'
+                      f'{int(body) / 1024:>10.0f}{int(size) / 1024:>10.0f}')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 3 and sys.argv[1] == '--run':
+        run(int(sys.argv[2]))
+    else:
+        main([int(n) for n in sys.argv[1:]] or [100, 1000, 10000])
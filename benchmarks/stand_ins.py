@@ -0,0 +1,348 @@
+"""
+Local stand-ins for the services the notifiers talk to, for benchmarks:
+a fake Kafka consumer generating messages, an SMTP sink accepting XOAUTH2,
+an HTTP server standing in for Slack webhooks (and the OAuth2 token
+endpoint), and an MQTT broker stub.
+
+Every generated message carries a marker `bench-<seq>-<created at>` in its
+subscription name, which ends up in the email subject, the Slack message and
+the MQTT payload. The stand-ins look for it to count deliveries and measure
+their latency.
+"""
+
+import base64
+import json
+import random
+import re
+import socketserver
+import ssl
+import struct
+import subprocess
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from kafka import TopicPartition
+from kafka.consumer.fetcher import ConsumerRecord
+
+MARKER = re.compile(rb'bench-(\d+)-(\d+\.\d+)')
+
+
+def marker(seq: int, created: float) -> str:
+    return f'bench-{seq}-{created:.6f}'
+
+
+class Deliveries:
+    """Deliveries seen by the stand-ins, with their latency."""
+
+    def __init__(self, expected: int):
+        self.expected = expected
+        self.seen = set()
+        self.duplicates = 0
+        self.latencies = []
+        self.first_at = None
+        self.last_at = None
+        self.done = threading.Event()
+        self._lock = threading.Lock()
+
+    def record(self, data: bytes):
+        now = time.time()
+        markers = {int(seq): float(created) for seq, created in MARKER.findall(data)}
+        with self._lock:
+            for seq, created in markers.items():
+                if seq in self.seen:
+                    self.duplicates += 1
+                    continue
+                self.seen.add(seq)
+                self.latencies.append(now - created)
+                self.first_at = self.first_at or now
+                self.last_at = now
+            if len(self.seen) >= self.expected:
+                self.done.set()
+
+    def __len__(self):
+        return len(self.seen)
+
+
+class FakeKafkaConsumer:
+    """
+    Stands in for KafkaConsumer: generates `total` records on the fly, as
+    many as asked per poll, over `partitions` partitions of the topic, or of
+    each topic of the list. Raises
+    KeyboardInterrupt from poll() once `stop` is set, which shuts down the
+    consuming loop of notify_deps. Values are JSON bytes, or dicts when
+    `decode` is set.
+    """
+
+    def __init__(self, topic, total: int, value_fn, stop, partitions: int = 4,
+                 listener=None, decode: bool = False):
+        self.topics = [topic] if isinstance(topic, str) else list(topic)
+        self.decode = decode
+        self.total = total
+        self.value_fn = value_fn
+        self.stop = stop
+        self.partitions = [TopicPartition(t, p) for t in self.topics for p in range(partitions)]
+        self.offsets = {tp: 0 for tp in self.partitions}
+        self.generated = 0
+        self.commits = 0
+        self._paused = set()
+        if listener is not None:
+            listener.on_partitions_assigned(self.partitions)
+
+    def poll(self, timeout_ms=0, max_records=500):
+        if self.stop.is_set():
+            raise KeyboardInterrupt
+        active = [tp for tp in self.partitions if tp not in self._paused]
+        if not active or self.generated >= self.total:
+            time.sleep(timeout_ms / 1000)
+            return {}
+        records = {}
+        now = time.time()
+        for _ in range(min(max_records, self.total - self.generated)):
+            tp = active[self.generated % len(active)]
+            seq = self.generated
+            value = json.dumps(self.value_fn(seq, marker(seq, now))).encode()
+            size = len(value)
+            if self.decode:
+                value = json.loads(value)
+            records.setdefault(tp, []).append(ConsumerRecord(
+                tp.topic, tp.partition, self.offsets[tp], int(now * 1000), 0, str(seq), value,
+                [], None, len(str(seq)), size, -1))
+            self.offsets[tp] += 1
+            self.generated += 1
+        return records
+
+    def commit(self, offsets=None):
+        self.commits += 1
+
+    def assignment(self):
+        return set(self.partitions)
+
+    def highwater(self, tp):
+        return self.offsets[tp] + (self.total - self.generated) // len(self.partitions)
+
+    def position(self, tp):
+        return self.offsets[tp]
+
+    def pause(self, *partitions):
+        self._paused.update(partitions)
+
+    def resume(self, *partitions):
+        self._paused.difference_update(partitions)
+
+    def paused(self):
+        return set(self._paused)
+
+    def close(self):
+        pass
+
+
+def self_signed_cert(directory: str):
+    """(certfile, keyfile) generated with openssl, or None if unavailable."""
+    cert, key = f'{directory}/cert.pem', f'{directory}/key.pem'
+    try:
+        subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+                        '-keyout', key, '-out', cert, '-days', '1', '-subj', '/CN=localhost'],
+                       check=True, capture_output=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return cert, key
+
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+
+    def reply(self, line: str):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        server = self.server
+        self.reply('220 localhost ESMTP bench')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            cmd = line.strip().split(b' ', 1)
+            verb = cmd[0].upper()
+            if verb in (b'EHLO', b'HELO'):
+                self.wfile.write(b'250-localhost\r\n250-AUTH XOAUTH2\r\n250 8BITMIME\r\n')
+            elif verb == b'AUTH':
+                if server.latency:
+                    time.sleep(server.latency)
+                arg = cmd[1].split(b' ', 1) if len(cmd) > 1 else [b'']
+                auth = base64.b64decode(arg[1]) if len(arg) > 1 else b''
+                ok = arg[0].upper() == b'XOAUTH2' and b'auth=Bearer ' in auth
+                self.reply('235 2.7.0 Accepted' if ok else '535 5.7.8 Invalid credentials')
+            elif verb == b'DATA':
+                self.reply('354 Go ahead')
+                data = []
+                while True:
+                    line = self.rfile.readline()
+                    if not line or line == b'.\r\n':
+                        break
+                    data.append(line)
+                if server.latency:
+                    time.sleep(server.latency)
+                server.deliveries.record(b''.join(data))
+                self.reply('250 2.0.0 OK')
+            elif verb == b'QUIT':
+                self.reply('221 2.0.0 Bye')
+                return
+            elif verb in (b'MAIL', b'RCPT', b'RSET', b'NOOP'):
+                self.reply('250 2.0.0 OK')
+            else:
+                self.reply('502 5.5.1 Unrecognized command')
+
+
+class SMTPSink(socketserver.ThreadingTCPServer):
+    """
+    SMTP server accepting XOAUTH2 authentication and discarding the emails.
+    Implicit TLS, as SMTP_SSL expects, when a certificate is given.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, deliveries: Deliveries, latency: float = 0, cert=None):
+        super().__init__(('127.0.0.1', 0), _SMTPHandler)
+        self.deliveries = deliveries
+        self.latency = latency
+        self.tls = None
+        if cert:
+            self.tls = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            self.tls.load_cert_chain(*cert)
+
+    def get_request(self):
+        sock, addr = super().get_request()
+        if self.tls:
+            sock = self.tls.wrap_socket(sock, server_side=True)
+        return sock, addr
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+
+class _HTTPHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def respond(self, code: int, body: bytes, headers=()):
+        self.send_response(code)
+        for k, v in headers:
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if self.path == '/token':
+            token = json.dumps({'access_token': f'token-{time.time()}', 'expires_in': 3600})
+            self.respond(200, token.encode())
+            return
+        if server.latency:
+            time.sleep(server.latency)
+        with server.lock:
+            throttled = server.random.random() < server.rate_429
+        if throttled:
+            self.respond(429, b'rate_limited', [('Retry-After', '1')])
+            return
+        server.deliveries.record(body)
+        self.respond(200, b'ok')
+
+
+class HTTPStandIn(ThreadingHTTPServer):
+    """
+    Stands in for Slack webhooks (any path) with a fixed latency and a rate of
+    429 answers, and for the OAuth2 token endpoint (POST /token).
+    """
+
+    daemon_threads = True
+
+    def __init__(self, deliveries: Deliveries, latency: float = 0, rate_429: float = 0,
+                 seed: int = 0):
+        super().__init__(('127.0.0.1', 0), _HTTPHandler)
+        self.deliveries = deliveries
+        self.latency = latency
+        self.rate_429 = rate_429
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+
+class _MQTTHandler(socketserver.BaseRequestHandler):
+
+    def read(self, n: int) -> bytes:
+        data = b''
+        while len(data) < n:
+            chunk = self.request.recv(n - len(data))
+            if not chunk:
+                raise ConnectionError('closed')
+            data += chunk
+        return data
+
+    def packet(self):
+        header = self.read(1)[0]
+        length, shift = 0, 0
+        while True:
+            byte = self.read(1)[0]
+            length |= (byte & 0x7f) << shift
+            shift += 7
+            if not byte & 0x80:
+                break
+        return header, self.read(length)
+
+    def handle(self):
+        server = self.server
+        try:
+            while True:
+                header, body = self.packet()
+                kind = header >> 4
+                if kind == 1:  # CONNECT
+                    self.request.sendall(b'\x20\x02\x00\x00')
+                elif kind == 3:  # PUBLISH
+                    qos = (header >> 1) & 3
+                    topic_len = struct.unpack('!H', body[:2])[0]
+                    start = 2 + topic_len
+                    if qos:
+                        mid = body[start:start + 2]
+                        start += 2
+                    if server.latency:
+                        time.sleep(server.latency)
+                    server.deliveries.record(body[start:])
+                    if qos:
+                        self.request.sendall(b'\x40\x02' + mid)
+                elif kind == 12:  # PINGREQ
+                    self.request.sendall(b'\xd0\x00')
+                elif kind == 14:  # DISCONNECT
+                    return
+        except (ConnectionError, OSError):
+            return
+
+
+class MQTTBrokerStub(socketserver.ThreadingTCPServer):
+    """MQTT 3.1.1 broker stub: accepts connections and publishes, routes nothing."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, deliveries: Deliveries, latency: float = 0):
+        super().__init__(('127.0.0.1', 0), _MQTTHandler)
+        self.deliveries = deliveries
+        self.latency = latency
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+
+def serve(server):
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
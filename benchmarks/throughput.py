@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+"""
+Throughput and latency benchmark of a notifier against local stand-ins.
+
+Runs `notify_deps.main` with the worker of the notifier of the channel in a
+child process, fed by a fake Kafka consumer generating the messages, and
+sending them to a local SMTP sink, Slack webhook stand-in or MQTT broker
+stub. Reports the messages delivered per second, the p50/p99 latency from
+the poll to the delivery, and the peak memory of each process.
+
+Usage: PYTHONPATH=src python benchmarks/throughput.py email --messages 20000
+
+The notifiers read their configuration from the environment as usual, e.g.
+KAFKA_DELIVERY_MODE=at-least-once or EMAIL_DIGEST_WINDOW=1. The Slack rate
+limit is disabled unless SLACK_RATE_LIMIT is set.
+"""
+
+import argparse
+import importlib.util
+import json
+import multiprocessing
+import os
+import signal
+import sys
+import tempfile
+import threading
+import time
+
+import stand_ins
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+
+TOPICS = {
+    'email': 'NOTIFICATIONS_EMAIL_S',
+    'slack': 'NOTIFICATIONS_SLACK_S',
+    'mqtt': 'NOTIFICATIONS_MQTT_S',
+}
+
+
+def load_notifier(channel: str):
+    spec = importlib.util.spec_from_file_location(
+        f'notify_{channel}', os.path.join(SRC, f'notify-{channel}.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def message_value(channel: str, args, ports: dict):
+    def value(seq: int, marker: str) -> dict:
+        dest = seq % args.destinations
+        if channel == 'email':
+            destination = f'user{dest}@example.com'
+        elif channel == 'slack':
+            destination = f'http://127.0.0.1:{ports["http"]}/hook/{dest}'
+        else:
+            destination = f'127.0.0.1:{ports["mqtt"]}/bench/{dest}'
+        return {
+            'SUBS_ID': f'subscription-config/{seq % 100}',
+            'SUBS_NAME': marker,
+            'NAME': f'nuvlaedge {seq % 1000}',
+            'DESTINATION': destination,
+            'RESOURCE_URI': f'edge/{seq % 1000}',
+            'RESOURCE_NAME': f'nuvlaedge {seq % 1000}',
+            'METRIC': 'CPU load',
+            'CONDITION': '>',
+            'CONDITION_VALUE': '90',
+            'VALUE': '95',
+            'RECOVERY': False,
+            'TIMESTAMP': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        }
+    return value
+
+
+def run_notifier(channel: str, args, ports: dict, cert, stop):
+    """Child process: the notifier under test, as its __main__ would run it."""
+    os.setsid()
+    os.environ.setdefault('SLACK_RATE_LIMIT', '0')
+    os.environ.setdefault('OAUTH2_TOKEN_CACHE_DIR', tempfile.mkdtemp(prefix='bench-'))
+    os.chdir(SRC)
+    sys.path.insert(0, SRC)
+    import notify_deps
+
+    value_fn = message_value(channel, args, ports)
+
+    def kafka_consumer(topic, bootstrap_servers, group_id, auto_offset_reset='latest',
+                       enable_auto_commit=True, decode_values=True, listener=None):
+        return stand_ins.FakeKafkaConsumer(topic, args.messages, value_fn, stop,
+                                           listener=listener, decode=decode_values)
+
+    notify_deps.kafka_consumer = kafka_consumer
+    notifier = load_notifier(channel)
+    kwargs = dict(num_workers=args.workers, max_workers=args.max_workers, engine=args.engine,
+                  async_worker=notifier.async_worker,
+                  manual_commit=notifier.channel.manual_commit)
+    if channel == 'email':
+        import smtplib
+        import xoauth2_client
+        xoauth2_client.XOAuth2SMTPClientGoogle.REFRESH_TOKEN_URL = \
+            f'http://127.0.0.1:{ports["http"]}/token'
+        if cert is None:
+            xoauth2_client.smtplib.SMTP_SSL = smtplib.SMTP
+        notifier.init_email_templates()
+        smtp_params = xoauth2_client.SMTPParamsGoogle(**{
+            'smtp-host': '127.0.0.1',
+            'smtp-port': ports['smtp'],
+            'smtp-username': 'bench@example.com',
+            'smtp-xoauth2': 'google',
+            'smtp-xoauth2-config': {'client-id': 'bench', 'client-secret': 'bench',
+                                    'refresh-token': 'bench'}})
+        notifier.get_token_refresher(smtp_params).start()
+        kwargs.update(initargs=(smtp_params,))
+    notify_deps.main(notifier.worker, TOPICS[channel], f'bench-{channel}', **kwargs)
+
+
+def rss_kib(pid: int) -> int:
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def descendants(pid: int) -> list:
+    children = {}
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open(f'/proc/{entry}/stat') as f:
+                    ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            children.setdefault(ppid, []).append(int(entry))
+    found, todo = [], [pid]
+    while todo:
+        p = todo.pop()
+        found.append(p)
+        todo.extend(children.get(p, []))
+    return found
+
+
+class MemorySampler(threading.Thread):
+    """Peak resident memory of a process and of its descendants."""
+
+    def __init__(self, pid: int, interval: float = 0.25):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.peak = {}
+        self.peak_total = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            total = 0
+            for pid in descendants(self.pid):
+                rss = rss_kib(pid)
+                total += rss
+                self.peak[pid] = max(self.peak.get(pid, 0), rss)
+            self.peak_total = max(self.peak_total, total)
+
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[int(q * (len(values) - 1))]
+
+
+def benchmark(args) -> dict:
+    deliveries = stand_ins.Deliveries(args.messages)
+    with tempfile.TemporaryDirectory() as tmp:
+        cert = stand_ins.self_signed_cert(tmp) if args.channel == 'email' else None
+        http = stand_ins.serve(stand_ins.HTTPStandIn(deliveries, args.latency,
+                                                     args.rate_429, args.seed))
+        ports = {'http': http.port}
+        if args.channel == 'email':
+            ports['smtp'] = stand_ins.serve(
+                stand_ins.SMTPSink(deliveries, args.latency, cert)).port
+        elif args.channel == 'mqtt':
+            ports['mqtt'] = stand_ins.serve(
+                stand_ins.MQTTBrokerStub(deliveries, args.latency)).port
+
+        ctx = multiprocessing.get_context('fork')
+        stop = ctx.Event()
+        started = time.time()
+        child = ctx.Process(target=run_notifier,
+                            args=(args.channel, args, ports, cert, stop))
+        child.start()
+        sampler = MemorySampler(child.pid)
+        sampler.start()
+        completed = deliveries.done.wait(args.timeout)
+        ended = time.time()
+        sampler.stopped.set()
+        stop.set()
+        child.join(5)
+        if child.is_alive():
+            os.killpg(child.pid, signal.SIGKILL)
+            child.join()
+
+    workers = [rss for pid, rss in sampler.peak.items() if pid != child.pid]
+    steady = (deliveries.last_at - deliveries.first_at) if len(deliveries) > 1 else 0
+    return {
+        'channel': args.channel,
+        'engine': args.engine,
+        'workers': args.workers,
+        'messages': args.messages,
+        'delivered': len(deliveries),
+        'duplicates': deliveries.duplicates,
+        'completed': completed,
+        'tls': cert is not None,
+        'wall_seconds': round(ended - started, 3),
+        'msgs_per_second': round((len(deliveries) - 1) / steady, 1) if steady else 0,
+        'latency_p50_ms': round(percentile(deliveries.latencies, 0.50) * 1000, 2),
+        'latency_p99_ms': round(percentile(deliveries.latencies, 0.99) * 1000, 2),
+        'rss_main_mib': round(sampler.peak.get(child.pid, 0) / 1024, 1),
+        'rss_worker_max_mib': round(max(workers, default=0) / 1024, 1),
+        'rss_total_peak_mib': round(sampler.peak_total / 1024, 1),
+    }
+
+
+def report(result: dict):
+    print(f"{result['channel']} engine={result['engine']} workers={result['workers']} "
+          f"tls={result['tls']}")
+    print(f"  delivered   {result['delivered']}/{result['messages']} "
+          f"({result['duplicates']} duplicates) in {result['wall_seconds']}s"
+          f"{'' if result['completed'] else ' - TIMED OUT'}")
+    print(f"  throughput  {result['msgs_per_second']} msgs/s")
+    print(f"  latency     p50 {result['latency_p50_ms']} ms, p99 {result['latency_p99_ms']} ms")
+    print(f"  memory      main {result['rss_main_mib']} MiB, worker max "
+          f"{result['rss_worker_max_mib']} MiB, total peak {result['rss_total_peak_mib']} MiB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('channel', choices=sorted(TOPICS))
+    parser.add_argument('--messages', type=int, default=10000)
+    parser.add_argument('--destinations', type=int, default=100,
+                        help='number of distinct recipients, webhooks or MQTT topics')
+    parser.add_argument('--engine', choices=['process', 'asyncio'],
+                        default=os.environ.get('WORKER_ENGINE') or 'process')
+    parser.add_argument('--workers', type=int, default=5)
+    parser.add_argument('--max-workers', type=int, default=None,
+                        help='scale the worker processes up to this number (see AUTOSCALE_*)')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds the stand-ins take per delivery')
+    parser.add_argument('--rate-429', type=float, default=0,
+                        help='share of the Slack posts answered with 429')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--timeout', type=float, default=300)
+    parser.add_argument('--json', action='store_true', help='print the result as JSON')
+    args = parser.parse_args()
+    result = benchmark(args)
+    if args.json:
+        print(json.dumps(result))
+    else:
+        report(result)
+
+
+if __name__ == '__main__':
+    main()
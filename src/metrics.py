@@ -1,7 +1,9 @@
+import hashlib
 import os
 import shutil
+import threading
 from prometheus_client import multiprocess, CollectorRegistry
-from prometheus_client import Counter, Enum
+from prometheus_client import Counter, Enum, Gauge, Histogram
 
 registry = CollectorRegistry()
 
@@ -25,3 +27,244 @@ NOTIFICATIONS_ERROR = Counter('notifications_error',
                               'Number of notifications that could not be sent due to error',
                               ['type', 'name', 'endpoint', 'exception'],
                               namespace='kafka_notify', registry=registry)
+
+SMTP_SESSION_RECONNECTS = Counter('smtp_session_reconnects',
+                                  'Number of SMTP sessions (re)established',
+                                  ['reason'],
+                                  namespace='kafka_notify', registry=registry)
+SMTP_SESSION_REUSED = Counter('smtp_session_reused',
+                              'Number of emails sent over an already authenticated SMTP session',
+                              namespace='kafka_notify', registry=registry)
+OAUTH2_TOKEN_REFRESHES = Counter('oauth2_token_refreshes',
+                                 'Number of OAuth2 access token requests to the provider',
+                                 ['result'],
+                                 namespace='kafka_notify', registry=registry)
+
+STARTUP_SECONDS = Gauge('startup_seconds',
+                        'Duration of the startup phases, of the slowest worker for the worker phase',
+                        ['phase'],
+                        namespace='kafka_notify', registry=registry, multiprocess_mode='max')
+SHUTDOWN_SECONDS = Gauge('shutdown_seconds',
+                         'Duration of the last drain of the workers on shutdown',
+                         namespace='kafka_notify', registry=registry, multiprocess_mode='max')
+MESSAGES_ABANDONED = Counter('messages_abandoned',
+                             'Number of messages not processed by the workers on shutdown, '
+                             'to be consumed again with manual commits',
+                             ['type'],
+                             namespace='kafka_notify', registry=registry)
+WORKERS_READY = Gauge('workers_ready',
+                      'Number of worker processes ready to take work',
+                      namespace='kafka_notify', registry=registry, multiprocess_mode='livesum')
+WORKERS = Gauge('workers',
+                'Number of worker processes the channel is scaled to',
+                ['type'],
+                namespace='kafka_notify', registry=registry, multiprocess_mode='max')
+WORKER_UTILIZATION = Gauge('worker_utilization',
+                           'Share of the worker processes of the channel busy, averaged over '
+                           'the autoscaling interval',
+                           ['type'],
+                           namespace='kafka_notify', registry=registry, multiprocess_mode='max')
+CONSUMER_LAG = Gauge('consumer_lag',
+                     'Number of messages of the topic of the channel not consumed yet',
+                     ['type'],
+                     namespace='kafka_notify', registry=registry, multiprocess_mode='max')
+WORKER_QUEUE_DEPTH = Gauge('worker_queue_depth',
+                           'Number of messages waiting for the worker with key affinity',
+                           ['type', 'worker'],
+                           namespace='kafka_notify', registry=registry, multiprocess_mode='max')
+KEYS_REBALANCED = Counter('keys_rebalanced',
+                          'Number of keys routed to a less busy worker than the one of their hash',
+                          ['type'],
+                          namespace='kafka_notify', registry=registry)
+AUTOSCALE_DECISIONS = Counter('autoscale_decisions',
+                              'Number of scaling decisions of the worker processes, by direction '
+                              'and reason',
+                              ['type', 'direction', 'reason'],
+                              namespace='kafka_notify', registry=registry)
+
+CONSUMER_PAUSED = Gauge('consumer_paused',
+                        'Whether fetching from the assigned partitions is paused due to backpressure',
+                        namespace='kafka_notify', registry=registry, multiprocess_mode='max')
+CONSUMER_PAUSES = Counter('consumer_pauses',
+                          'Number of times fetching was paused due to backpressure',
+                          namespace='kafka_notify', registry=registry)
+CONSUMER_PAUSED_SECONDS = Counter('consumer_paused_seconds',
+                                  'Time spent with fetching paused due to backpressure',
+                                  namespace='kafka_notify', registry=registry)
+
+DEDUP_LOOKUPS = Counter('dedup_lookups',
+                        'Number of notifications looked up in the deduplication cache, '
+                        'by result (hit for a duplicate dropped)',
+                        ['result'],
+                        namespace='kafka_notify', registry=registry)
+DEDUP_CACHE_SIZE = Gauge('dedup_cache_size',
+                         'Number of notifications in the deduplication cache',
+                         namespace='kafka_notify', registry=registry, multiprocess_mode='max')
+
+NOTIFICATIONS_FLAPPING = Counter('notifications_flapping',
+                                 'Number of alert/recovery pairs suppressed within the hold-down window',
+                                 namespace='kafka_notify', registry=registry)
+FLAP_HELD = Gauge('flap_held',
+                  'Number of resources with an alert held back in the hold-down window',
+                  namespace='kafka_notify', registry=registry, multiprocess_mode='max')
+
+RENDER_CACHE_HITS = Counter('render_cache_hits',
+                            'Number of notifications rendered from the render cache',
+                            ['template'],
+                            namespace='kafka_notify', registry=registry)
+RENDER_CACHE_MISSES = Counter('render_cache_misses',
+                              'Number of notifications rendered from their template',
+                              ['template'],
+                              namespace='kafka_notify', registry=registry)
+
+NOTIFICATIONS_THROTTLED = Counter('notifications_throttled',
+                                  'Number of sends delayed by the rate limiter',
+                                  ['type', 'destination'],
+                                  namespace='kafka_notify', registry=registry)
+NOTIFICATIONS_THROTTLED_SECONDS = Counter('notifications_throttled_seconds',
+                                          'Delay imposed on sends by the rate limiter',
+                                          ['type', 'destination'],
+                                          namespace='kafka_notify', registry=registry)
+NOTIFICATIONS_RATE_LIMITED = Counter('notifications_rate_limited',
+                                     'Number of sends rejected by the destination due to rate limiting',
+                                     ['type', 'destination'],
+                                     namespace='kafka_notify', registry=registry)
+
+NOTIFICATIONS_RETRIES = Counter('notifications_retries',
+                                'Number of failed sends scheduled for a retry',
+                                ['type'],
+                                namespace='kafka_notify', registry=registry)
+CIRCUIT_BREAKER_OPENED = Counter('circuit_breaker_opened',
+                                 'Number of times sends to a destination started failing fast',
+                                 ['type'],
+                                 namespace='kafka_notify', registry=registry)
+
+NOTIFICATIONS_DEAD_LETTERED = Counter('notifications_dead_lettered',
+                                      'Number of undeliverable notifications published to the dead-letter topic',
+                                      ['type', 'reason'],
+                                      namespace='kafka_notify', registry=registry)
+
+# Buckets in seconds, from sub-second sends to deliveries delayed by retries.
+LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600)
+
+DELIVERY_DELAY = Histogram('delivery_delay_seconds',
+                           'Time from the notification event to its delivery',
+                           ['type'], buckets=LATENCY_BUCKETS,
+                           namespace='kafka_notify', registry=registry)
+QUEUE_WAIT = Histogram('queue_wait_seconds',
+                       'Time from consuming a message to a worker taking it up',
+                       buckets=LATENCY_BUCKETS,
+                       namespace='kafka_notify', registry=registry)
+RENDER_TIME = Histogram('render_seconds',
+                        'Time to build the notification content',
+                        ['type'], buckets=LATENCY_BUCKETS,
+                        namespace='kafka_notify', registry=registry)
+SEND_TIME = Histogram('send_seconds',
+                      'Time to send a notification to its destination',
+                      ['type'], buckets=LATENCY_BUCKETS,
+                      namespace='kafka_notify', registry=registry)
+
+# Label policy bounding the number of label sets, hence the size of the
+# multiprocess files and of the scrapes. Destinations (recipients, webhooks,
+# brokers) are labelled:
+# 'raw': as they are;
+# 'hash': with a short hash of the destination;
+# 'bucket': with one of METRICS_DESTINATION_BUCKETS buckets of hashes;
+# 'top': as they are for the METRICS_TOP_DESTINATIONS busiest destinations of
+#        the process, and as 'other' for the rest;
+# 'none': not at all.
+METRICS_DESTINATION_LABELS = os.environ.get('METRICS_DESTINATION_LABELS') or 'raw'
+METRICS_DESTINATION_BUCKETS = int(os.environ.get('METRICS_DESTINATION_BUCKETS') or 64)
+METRICS_TOP_DESTINATIONS = int(os.environ.get('METRICS_TOP_DESTINATIONS') or 20)
+# Subscription names are labelled as they are ('raw') or not at all ('none').
+METRICS_NAME_LABELS = os.environ.get('METRICS_NAME_LABELS') or 'raw'
+
+OTHER = 'other'
+
+
+class TopDestinations:
+    """
+    Tracks the busiest destinations with the space-saving algorithm over
+    `capacity` counters. A destination ranking among the top `n` is given its
+    own label for good; once `n` destinations have one, the others are
+    labelled as 'other'.
+    """
+
+    def __init__(self, n: int, capacity: int = None):
+        self.n = n
+        self.capacity = capacity or max(10 * n, 100)
+        self._counts = {}
+        self._named = set()
+        self._lock = threading.Lock()
+
+    def _count(self, dest):
+        if dest in self._counts:
+            self._counts[dest] += 1
+        elif len(self._counts) < self.capacity:
+            self._counts[dest] = 1
+        else:
+            # Replace the least counted, inheriting its count as error bound.
+            least = min(self._counts, key=self._counts.get)
+            self._counts[dest] = self._counts.pop(least) + 1
+        return self._counts[dest]
+
+    def label(self, dest: str) -> str:
+        with self._lock:
+            if dest in self._named:
+                return dest
+            if len(self._named) >= self.n:
+                return OTHER
+            count = self._count(dest)
+            higher = sum(1 for c in self._counts.values() if c > count)
+            if higher < self.n:
+                self._named.add(dest)
+                return dest
+            return OTHER
+
+
+_top_destinations = TopDestinations(METRICS_TOP_DESTINATIONS)
+
+
+def _hash(value: str) -> str:
+    return hashlib.sha1(value.encode()).hexdigest()
+
+
+def destination_label(dest) -> str:
+    dest = '' if dest is None else str(dest)
+    if METRICS_DESTINATION_LABELS == 'hash':
+        return _hash(dest)[:12]
+    if METRICS_DESTINATION_LABELS == 'bucket':
+        return f'bucket-{int(_hash(dest)[:8], 16) % METRICS_DESTINATION_BUCKETS}'
+    if METRICS_DESTINATION_LABELS == 'top':
+        return _top_destinations.label(dest)
+    if METRICS_DESTINATION_LABELS == 'none':
+        return ''
+    return dest
+
+
+def name_label(name) -> str:
+    if METRICS_NAME_LABELS == 'none':
+        return ''
+    return '' if name is None else str(name)
+
+
+def error_label(error) -> str:
+    """Errors are labelled with their class only, never with their message."""
+    if isinstance(error, type):
+        return error.__name__
+    return type(error).__name__
+
+
+def notification_sent(channel: str, name, endpoint):
+    NOTIFICATIONS_SENT.labels(channel, name_label(name), destination_label(endpoint)).inc()
+
+
+def notification_error(channel: str, name, endpoint, error):
+    NOTIFICATIONS_ERROR.labels(channel, name_label(name), destination_label(endpoint),
+                               error_label(error)).inc()
+
+
+def process_dead(pid: int):
+    """Drop the live gauges of an exited worker process in the multiprocess mode."""
+    if path:
+        multiprocess.mark_process_dead(pid, path)
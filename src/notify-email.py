@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 
+import asyncio
 import os
-import time
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 
@@ -9,45 +9,53 @@ import yaml
 import multiprocessing
 import requests
 import smtplib
-from jinja2 import Template
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader, Template
 from datetime import datetime
 
-from notify_deps import get_logger, timestamp_convert, main
+from notify_deps import get_logger, timestamp_convert, ack, Coalescer, LRUCache
+from notify_deps import AT_LEAST_ONCE, DelayedWork, Retrier, Throttled, PermanentError, dead_letter
+from notify_deps import malformed
+from notify_deps import delivered, retiring, startup_phase
+from notify_deps import Channel, register_channel, run
 from notify_deps import NUVLA_ENDPOINT, prometheus_exporter_port
 from prometheus_client import start_http_server
-from metrics import (PROCESS_STATES, NOTIFICATIONS_SENT, NOTIFICATIONS_ERROR,
-                     registry)
-from xoauth2_client import (SMTPParams, SMTPParamsGoogle, XOAuth2SMTPClient,
+from metrics import (PROCESS_STATES, notification_sent, notification_error,
+                     RENDER_CACHE_HITS, RENDER_CACHE_MISSES, RENDER_TIME, SEND_TIME, registry)
+from xoauth2_client import (SMTPParams, SMTPParamsGoogle, TokenRefresher, XOAuth2SMTPClient,
                             XOAuth2SMTPClientGoogle)
+from ratelimit import SharedRateLimiter
 
 
 log_local = get_logger('email')
 
 EMAIL_TEMPLATE_DEFAULT_FILE = 'templates/default.html'
 EMAIL_TEMPLATE_APP_PUB_FILE = 'templates/app-pub.html'
+EMAIL_TEMPLATE_DIGEST_FILE = 'templates/digest.html'
+
+# Max number of rendered emails kept for reuse (0 disables the cache).
+EMAIL_RENDER_CACHE_SIZE = int(os.environ.get('EMAIL_RENDER_CACHE_SIZE') or 256)
 
 EMAIL_TEMPLATES = {
     'default': Template('dummy'),
     'app-pub': Template('dummy'),
+    'digest': Template('dummy'),
 }
 
 NUVLA_API_LOCAL = 'http://api:8200'
 
 SMTP_CONFIG_ENV = 'SMTP_CONFIG'
+# Timeout (seconds) of the request of the configuration to the Nuvla API.
+NUVLA_CONFIG_TIMEOUT = float(os.environ.get('NUVLA_CONFIG_TIMEOUT') or 10)
 
 IMG_ALERT_OK = 'ui/images/nuvla-alert-ok.png'
 IMG_ALERT_NOK = 'ui/images/nuvla-alert-nok.png'
 
 
-class SendFailedMaxAttempts(Exception):
-    pass
-
-
 def get_smtp_config_from_nuvla() -> dict:
     nuvla_api_authn_header = 'group/nuvla-admin'
     config_url = f'{NUVLA_API_LOCAL}/api/configuration/nuvla'
     headers = {'nuvla-authn-info': nuvla_api_authn_header}
-    resp = requests.get(config_url, headers=headers)
+    resp = requests.get(config_url, headers=headers, timeout=NUVLA_CONFIG_TIMEOUT)
     if resp.status_code != 200:
         raise EnvironmentError(f'Failed to get response from server: status {resp.status_code}')
     return resp.json()
@@ -83,10 +91,35 @@ def load_smtp_params() -> SMTPParams:
         raise ValueError(msg)
 
 
-KAFKA_TOPIC = os.environ.get('KAFKA_TOPIC') or 'NOTIFICATIONS_EMAIL_S'
+# EMAIL_KAFKA_TOPIC takes precedence, e.g. with the runner of several channels.
+KAFKA_TOPIC = (os.environ.get('EMAIL_KAFKA_TOPIC') or os.environ.get('KAFKA_TOPIC')
+               or 'NOTIFICATIONS_EMAIL_S')
 KAFKA_GROUP_ID = 'nuvla-notification-email'
+# Number of worker processes, scaled up to EMAIL_MAX_WORKERS on load.
+EMAIL_WORKERS = int(os.environ.get('EMAIL_WORKERS') or 5)
+EMAIL_MAX_WORKERS = int(os.environ.get('EMAIL_MAX_WORKERS') or EMAIL_WORKERS)
+
+# Digest mode: when the window (seconds) is set, messages to the same
+# recipients are buffered for that long, or until the max number of messages
+# is reached, and sent as a single email.
+EMAIL_DIGEST_WINDOW = float(os.environ.get('EMAIL_DIGEST_WINDOW') or 0)
+EMAIL_DIGEST_MAX_MESSAGES = int(os.environ.get('EMAIL_DIGEST_MAX_MESSAGES') or 50)
+
+# Number of concurrent SMTP sessions with the asyncio engine.
+EMAIL_SMTP_SESSIONS = int(os.environ.get('EMAIL_SMTP_SESSIONS') or 5)
 
-SEND_EMAIL_ATTEMPTS = 3
+# Emails per second and burst size allowed per SMTP account and process.
+# 0 disables the limit.
+EMAIL_RATE_LIMIT = float(os.environ.get('EMAIL_RATE_LIMIT') or 0)
+EMAIL_RATE_BURST = float(os.environ.get('EMAIL_RATE_BURST') or 10)
+# Seconds to stop sending when the SMTP server reports a sending quota error.
+EMAIL_QUOTA_BACKOFF = float(os.environ.get('EMAIL_QUOTA_BACKOFF') or 60)
+
+# SMTP replies meaning the account is sending too much.
+SMTP_QUOTA_CODES = (421, 452)
+
+limiter = SharedRateLimiter('email', EMAIL_RATE_LIMIT, EMAIL_RATE_BURST)
+retrier = Retrier('email')
 
 
 def get_smtp_client(smtp_parms: SMTPParams) -> XOAuth2SMTPClient:
@@ -102,19 +135,30 @@ def get_smtp_client(smtp_parms: SMTPParams) -> XOAuth2SMTPClient:
     raise ValueError(msg)
 
 
-def get_email_template(msg_params: dict) -> Template:
-    if 'TEMPLATE' not in msg_params:
-        return EMAIL_TEMPLATES['default']
+def get_token_refresher(smtp_parms: SMTPParams) -> TokenRefresher:
+    """
+    Refresher of the access token shared by the SMTP clients of all workers,
+    to be started in the parent process.
+    """
+    if smtp_parms.provider() == 'google':
+        return TokenRefresher(XOAuth2SMTPClientGoogle.token_cache(smtp_parms))
+    raise ValueError(f'Unsupported XOAUTH2 provider: {smtp_parms.provider()}')
+
+
+def get_email_template_name(msg_params: dict) -> str:
     tmpl_name = msg_params.get('TEMPLATE', 'default')
-    template = EMAIL_TEMPLATES.get(tmpl_name)
-    if template is None:
+    if tmpl_name not in EMAIL_TEMPLATES:
         log_local.warning('Failed to find email template %s. Using default.',
                           tmpl_name)
-        template = EMAIL_TEMPLATES['default']
-    return template
+        tmpl_name = 'default'
+    return tmpl_name
 
 
-def html_content(msg_params: dict):
+def get_email_template(msg_params: dict) -> Template:
+    return EMAIL_TEMPLATES[get_email_template_name(msg_params)]
+
+
+def html_params(msg_params: dict) -> dict:
     r_uri = msg_params.get('RESOURCE_URI')
     link_text = msg_params.get('RESOURCE_NAME') or r_uri
     component_link = f'<a href="{NUVLA_ENDPOINT}/ui/{r_uri}">{link_text}</a>'
@@ -125,6 +169,8 @@ def html_content(msg_params: dict):
     else:
         img_alert = IMG_ALERT_NOK
         notif_title = f"[Alert] {msg_params.get('SUBS_NAME')}"
+    if msg_params.get('FLAPPING'):
+        notif_title = f"[Flapping] {msg_params.get('SUBS_NAME')}"
 
     subs_name = 'Notification configuration'
     subs_config_link = f'<a href="{NUVLA_ENDPOINT}/ui/notifications">{subs_name}</a>'
@@ -152,85 +198,371 @@ def html_content(msg_params: dict):
             params['condition'] = f"{msg_params.get('CONDITION')} {msg_params.get('CONDITION_VALUE')}"
             params['value'] = msg_params.get('VALUE')
 
-    return get_email_template(msg_params).render(**params)
+    return params
 
 
-def send(smtp_client: XOAuth2SMTPClientGoogle, recipients, subject, html,
-         attempts=SEND_EMAIL_ATTEMPTS, sleep_interval=0.5, smtp_params: SMTPParams = None):
-    wname = multiprocessing.current_process().name
-    for i in range(attempts):
-        try:
+_render_cache = LRUCache(EMAIL_RENDER_CACHE_SIZE)
+
+
+def render_email(tmpl_name: str, params: dict) -> str:
+    """
+    Render the template with the parameters. Identical notifications fanned
+    out to many recipients are rendered once and then served from the cache.
+    """
+    key = (tmpl_name, tuple(sorted(params.items())))
+    html = _render_cache.get(key)
+    if html is not None:
+        RENDER_CACHE_HITS.labels(tmpl_name).inc()
+        return html
+    RENDER_CACHE_MISSES.labels(tmpl_name).inc()
+    html = EMAIL_TEMPLATES[tmpl_name].render(**params)
+    _render_cache.put(key, html)
+    return html
+
+
+def html_content(msg_params: dict):
+    return render_email(get_email_template_name(msg_params), html_params(msg_params))
+
+
+def digest_html_content(msgs_params: list):
+    items = [html_params(msg_params) for msg_params in msgs_params]
+    if all(msg_params.get('RECOVERY', False) for msg_params in msgs_params):
+        img_alert = IMG_ALERT_OK
+    else:
+        img_alert = IMG_ALERT_NOK
+    return EMAIL_TEMPLATES['digest'].render(
+        title=digest_subject(msgs_params),
+        items=items,
+        subs_config_link=items[0]['subs_config_link'],
+        header_img=f'{NUVLA_ENDPOINT}/{img_alert}',
+        current_year=str(datetime.now().year))
+
+
+def digest_subject(msgs_params: list) -> str:
+    subs_names = list(dict.fromkeys(m.get('SUBS_NAME') or 'alert' for m in msgs_params))
+    return f"{len(msgs_params)} notifications: {', '.join(subs_names)}"
+
+
+def smtp_quota_exceeded(ex: Exception) -> bool:
+    if not isinstance(ex, smtplib.SMTPResponseException):
+        return False
+    error = ex.smtp_error
+    if isinstance(error, bytes):
+        error = error.decode(errors='replace')
+    return ex.smtp_code in SMTP_QUOTA_CODES or '5.4.5' in str(error)
+
+
+def smtp_account(smtp_client: XOAuth2SMTPClient) -> str:
+    return getattr(smtp_client, 'email', None) or 'smtp'
+
+
+def send(smtp_client: XOAuth2SMTPClientGoogle, recipients, subject, html):
+    """
+    Single attempt at sending the email. Failed sends are retried later by
+    the caller, so that the worker can move on.
+    """
+    # All emails go through the same account: rate limit and quota apply to it.
+    account = smtp_account(smtp_client)
+    delay = limiter.acquire(account)
+    if delay > 0:
+        raise Throttled(delay, rejected=False)
+    try:
+        with SEND_TIME.labels('email').time():
             smtp_client.send_email(
                 recipients=recipients,
                 subject=subject,
                 html=html
             )
-            log_local.info(f'Email sent to {recipients}')
-            return
-        except smtplib.SMTPException as ex:
-            if i < attempts - 1:  # no need to sleep on the last iteration
-                time.sleep(sleep_interval)
-                log_local.error(f'{wname} - Failed sending email due to SMTP error: {ex}')
-                log_local.warning(f'{wname} - Reconnecting to SMTP server...')
-                smtp_client.stop()
-                smtp_client = get_smtp_client(smtp_params)
-                log_local.warning(f'{wname} - Reconnecting to SMTP server... done.')
-        except Exception as ex:
-            log_local.error(f'Failed sending email: {ex}')
-            NOTIFICATIONS_ERROR.labels('email', subject, ','.join(recipients), type(ex)).inc()
-            PROCESS_STATES.state('error - recoverable')
-            if i < attempts - 1:
-                time.sleep(sleep_interval)
-            smtp_client.stop()
-            smtp_client = get_smtp_client(smtp_params)
-    raise SendFailedMaxAttempts(f'Failed sending email after {attempts} attempts.')
+    except smtplib.SMTPRecipientsRefused as ex:
+        raise PermanentError(f'Recipients refused: {ex.recipients}') from ex
+    except smtplib.SMTPException as ex:
+        if smtp_quota_exceeded(ex):
+            limiter.block(account, EMAIL_QUOTA_BACKOFF)
+            raise Throttled(EMAIL_QUOTA_BACKOFF, f'Sending quota exceeded: {ex}') from ex
+        raise
+    log_local.info(f'Email sent to {recipients}')
 
 
 def get_recipients(v: dict) -> list:
     return list(filter(lambda x: x != '', v.get('DESTINATION', '').split(' ')))
 
 
+def email_subject(v: dict) -> str:
+    return v.get('SUBS_NAME') or f"{v.get('NAME') or v.get('RESOURCE_ID')} alert"
+
+
+def process_message(smtp_client: XOAuth2SMTPClient, msg) -> float:
+    """
+    Send the message. Returns the delay (seconds) after which to retry it, or
+    0 when done with it.
+    """
+    wname = multiprocessing.current_process().name
+    if malformed(msg, 'email'):
+        return 0
+    recipients = get_recipients(msg.value)
+    if len(recipients) == 0:
+        log_local.warning(f'{wname} - No recipients provided in: {msg.value}')
+        return 0
+    r_id = msg.value.get('RESOURCE_ID')
+    r_name = msg.value.get('NAME')
+    subject = email_subject(msg.value)
+    try:
+        with RENDER_TIME.labels('email').time():
+            html = html_content(msg.value)
+    except Exception as ex:
+        log_local.error(f'{wname} Failed rendering email: {ex}')
+        notification_error('email', r_name, ','.join(recipients), ex)
+        dead_letter(msg, 'email', ex)
+        return 0
+    account = smtp_account(smtp_client)
+    try:
+        delay = retrier.run(msg, account, send, smtp_client, recipients, subject, html)
+    except Exception as ex:
+        # Out of attempts: the retrier dead-lettered the message and re-raised.
+        log_local.error(f'{wname} Failed sending email, dead-lettered: {ex}')
+        notification_error('email', r_name, ','.join(recipients), ex)
+        PROCESS_STATES.state('error - recoverable')
+        return 0
+    if delay == 0:
+        log_local.info(f'{wname} - sent: {msg} to {recipients}')
+        notification_sent('email', r_name or r_id, ','.join(recipients))
+        delivered(msg, 'email')
+    return delay
+
+
+def process_digest(smtp_client: XOAuth2SMTPClient, recipients: list, msgs: list) -> list:
+    """
+    Send the messages as a single email. Returns (message, delay) of the
+    messages to retry after delay (seconds).
+    """
+    if len(msgs) == 1:
+        delay = process_message(smtp_client, msgs[0])
+        return [(msgs[0], delay)] if delay > 0 else []
+    wname = multiprocessing.current_process().name
+    msgs_params = [msg.value for msg in msgs]
+    try:
+        with RENDER_TIME.labels('email').time():
+            html = digest_html_content(msgs_params)
+    except Exception as ex:
+        log_local.error(f'{wname} Failed rendering digest email: {ex}')
+        for msg in msgs:
+            notification_error('email', msg.value.get('NAME'), ','.join(recipients), ex)
+            dead_letter(msg, 'email', ex)
+        return []
+    try:
+        retrier.call(smtp_account(smtp_client),
+                     send, smtp_client, recipients, digest_subject(msgs_params), html)
+    except Exception as ex:
+        retries = [(msg, retrier.delay(msg, ex)) for msg in msgs]
+        failed = [msg.value for msg, delay in retries if delay is None]
+        if failed:
+            log_local.error(f'{wname} Failed sending digest email: {ex}')
+            for v in failed:
+                notification_error('email', v.get('NAME'), ','.join(recipients), ex)
+            PROCESS_STATES.state('error - recoverable')
+        else:
+            log_local.warning(f'{wname} Failed sending digest email, will retry: {ex}')
+        return [(msg, delay) for msg, delay in retries if delay is not None]
+    for msg in msgs:
+        retrier.done(msg)
+        delivered(msg, 'email')
+    log_local.info(f'{wname} - sent digest of {len(msgs)} messages to {recipients}')
+    for v in msgs_params:
+        notification_sent('email', v.get('NAME') or v.get('RESOURCE_ID'), ','.join(recipients))
+    return []
+
+
+def digest_worker(work: DelayedWork, smtp_client: XOAuth2SMTPClient):
+    wname = multiprocessing.current_process().name
+    digests = Coalescer(EMAIL_DIGEST_WINDOW, EMAIL_DIGEST_MAX_MESSAGES)
+    log_local.info('%s - digest mode: window %ss, max %s messages', wname,
+                   EMAIL_DIGEST_WINDOW, EMAIL_DIGEST_MAX_MESSAGES)
+
+    def flush(recipients, msgs):
+        PROCESS_STATES.state('processing')
+        retries = process_digest(smtp_client, list(recipients), msgs)
+        # Retried messages go through the digest again.
+        for m, delay in retries:
+            work.defer(m, delay)
+        retried = {id(m) for m, _ in retries}
+        for m in msgs:
+            if id(m) not in retried:
+                ack(m)
+
+    while True:
+        PROCESS_STATES.state('idle')
+        msg = work.get(timeout=digests.timeout())
+        if msg and malformed(msg, 'email'):
+            ack(msg)
+        elif msg:
+            recipients = get_recipients(msg.value)
+            if len(recipients) == 0:
+                log_local.warning(f'{wname} - No recipients provided in: {msg.value}')
+                ack(msg)
+            else:
+                full = digests.add(tuple(recipients), msg)
+                if full:
+                    flush(recipients, full)
+        # Digests are sent right away once the worker is asked to exit.
+        for recipients, msgs in (digests.drain() if retiring() else digests.expired()):
+            flush(recipients, msgs)
+
+
 def worker(workq: multiprocessing.Queue, smtp_params: SMTPParams = None):
     wname = multiprocessing.current_process().name
     log_local.info('Worker started: %s', wname)
     smtp_client = get_smtp_client(smtp_params)
+    # Failed messages are held back for a retry while the worker moves on.
+    work = DelayedWork(workq)
+    if EMAIL_DIGEST_WINDOW > 0:
+        digest_worker(work, smtp_client)
+        return
     while True:
         PROCESS_STATES.state('idle')
-        msg = workq.get()
+        msg = work.get()
         PROCESS_STATES.state('processing')
         if msg:
-            recipients = get_recipients(msg.value)
-            if len(recipients) == 0:
-                log_local.warning(f'{wname} - No recipients provided in: {msg.value}')
-                continue
-            r_id = msg.value.get('RESOURCE_ID')
-            r_name = msg.value.get('NAME')
-            subject = msg.value.get('SUBS_NAME') or f'{r_name or r_id} alert'
-            try:
-                html = html_content(msg.value)
-                send(smtp_client, recipients, subject, html, smtp_params=smtp_params)
-                log_local.info(f'{wname} - sent: {msg} to {recipients}')
-                NOTIFICATIONS_SENT.labels('email', f'{r_name or r_id}', ','.join(recipients)).inc()
-            except Exception as ex:
-                # TODO: Put unsent message to error queue.
-                log_local.error(f'{wname} Failed sending email: {ex}')
-                NOTIFICATIONS_ERROR.labels('email', r_name, ','.join(recipients), type(ex)).inc()
-                PROCESS_STATES.state('error - recoverable')
+            delay = process_message(smtp_client, msg)
+            if delay > 0:
+                work.defer(msg, delay)
+            else:
+                ack(msg)
+
+
+_smtp_clients = None
+_async_digests = None
+_async_digests_flusher = None
+
+
+async def smtp_clients(smtp_params: SMTPParams) -> asyncio.Queue:
+    """Pool of SMTP clients shared by the coroutines of the asyncio engine."""
+    global _smtp_clients
+    if _smtp_clients is None:
+        _smtp_clients = asyncio.Queue()
+        loop = asyncio.get_running_loop()
+        clients = await asyncio.gather(
+            *[loop.run_in_executor(None, get_smtp_client, smtp_params)
+              for _ in range(EMAIL_SMTP_SESSIONS)])
+        for client in clients:
+            _smtp_clients.put_nowait(client)
+    return _smtp_clients
+
+
+async def run_with_smtp_client(smtp_params: SMTPParams, fn, *args):
+    clients = await smtp_clients(smtp_params)
+    smtp_client = await clients.get()
+    try:
+        return await asyncio.get_running_loop().run_in_executor(None, fn, smtp_client, *args)
+    finally:
+        clients.put_nowait(smtp_client)
+
+
+async def async_retry(msg, delay: float, smtp_params: SMTPParams):
+    await asyncio.sleep(delay)
+    await async_worker(msg, smtp_params)
+
+
+async def async_flush_digest(smtp_params: SMTPParams, recipients, msgs: list):
+    retries = []
+    try:
+        retries = await run_with_smtp_client(smtp_params, process_digest,
+                                             list(recipients), msgs)
+        # Retried messages go through the digest again.
+        for m, delay in retries:
+            asyncio.ensure_future(async_retry(m, delay, smtp_params))
+    finally:
+        retried = {id(m) for m, _ in retries}
+        for m in msgs:
+            if id(m) not in retried:
+                ack(m)
+
+
+async def async_digest_flusher(smtp_params: SMTPParams):
+    while True:
+        timeout = _async_digests.timeout()
+        await asyncio.sleep(EMAIL_DIGEST_WINDOW if timeout is None else timeout)
+        for recipients, msgs in _async_digests.expired():
+            asyncio.ensure_future(async_flush_digest(smtp_params, recipients, msgs))
+
+
+async def async_worker(msg, smtp_params: SMTPParams = None):
+    global _async_digests, _async_digests_flusher
+    if EMAIL_DIGEST_WINDOW <= 0:
+        try:
+            while True:
+                delay = await run_with_smtp_client(smtp_params, process_message, msg)
+                if delay <= 0:
+                    return
+                await asyncio.sleep(delay)
+        finally:
+            ack(msg)
+    if _async_digests is None:
+        _async_digests = Coalescer(EMAIL_DIGEST_WINDOW, EMAIL_DIGEST_MAX_MESSAGES)
+        _async_digests_flusher = asyncio.ensure_future(async_digest_flusher(smtp_params))
+    if malformed(msg, 'email'):
+        ack(msg)
+        return
+    recipients = get_recipients(msg.value)
+    if len(recipients) == 0:
+        log_local.warning(f'No recipients provided in: {msg.value}')
+        ack(msg)
+        return
+    full = _async_digests.add(tuple(recipients), msg)
+    if full:
+        await async_flush_digest(smtp_params, recipients, full)
+
+
+_jinja_envs = {}
+
+
+def template_bytecode_cache():
+    try:
+        return FileSystemBytecodeCache()
+    except OSError as ex:
+        log_local.warning('Template bytecode cache disabled: %s', ex)
+        return None
+
+
+def jinja_env(templates_dir: str) -> Environment:
+    env = _jinja_envs.get(templates_dir)
+    if env is None:
+        env = Environment(loader=FileSystemLoader(templates_dir),
+                          bytecode_cache=template_bytecode_cache(),
+                          auto_reload=False)
+        _jinja_envs[templates_dir] = env
+    return env
 
 
 def email_template(template_file=EMAIL_TEMPLATE_DEFAULT_FILE):
-    return Template(open(template_file).read())
+    templates_dir, name = os.path.split(template_file)
+    return jinja_env(templates_dir or '.').get_template(name)
 
 
 def init_email_templates(default=EMAIL_TEMPLATE_DEFAULT_FILE,
-                         app_pub=EMAIL_TEMPLATE_APP_PUB_FILE):
+                         app_pub=EMAIL_TEMPLATE_APP_PUB_FILE,
+                         digest=EMAIL_TEMPLATE_DIGEST_FILE):
     EMAIL_TEMPLATES['default'] = email_template(default)
     EMAIL_TEMPLATES['app-pub'] = email_template(app_pub)
+    EMAIL_TEMPLATES['digest'] = email_template(digest)
 
 
-if __name__ == "__main__":
-    init_email_templates()
-    smtp_params = load_smtp_params()
+def setup() -> tuple:
+    """Load the templates and SMTP parameters, while the Kafka consumer starts."""
+    with startup_phase('templates'):
+        init_email_templates()
+    with startup_phase('config'):
+        smtp_params = load_smtp_params()
     assert smtp_params is not None, ('SMTP parameters must be set before starting the worker.')
+    get_token_refresher(smtp_params).start()
+    return smtp_params,
+
+
+channel = register_channel(Channel(
+    'email', KAFKA_TOPIC, worker, group_id=KAFKA_GROUP_ID, async_worker=async_worker,
+    setup=setup, manual_commit=AT_LEAST_ONCE or EMAIL_DIGEST_WINDOW > 0,
+    num_workers=EMAIL_WORKERS, max_workers=EMAIL_MAX_WORKERS))
+
+
+if __name__ == "__main__":
     start_http_server(prometheus_exporter_port(), registry=registry)
-    main(worker, KAFKA_TOPIC, KAFKA_GROUP_ID, initargs=(smtp_params,))
+    run([channel])
@@ -1,22 +1,50 @@
 #!/usr/bin/env python3
+import asyncio
 import json
 import multiprocessing
 import os
 import threading
+import time
+from collections import OrderedDict
 from urllib.parse import urlparse
 
-from paho.mqtt import publish as mqtt_publish
+from paho.mqtt import client as mqtt
 from prometheus_client import start_http_server
 
-from notify_deps import get_logger, main
-from notify_deps import NUVLA_ENDPOINT, prometheus_exporter_port
-from metrics import PROCESS_STATES, NOTIFICATIONS_SENT, NOTIFICATIONS_ERROR, registry
+from notify_deps import get_logger, ack, Channel, register_channel, run
+from notify_deps import NUVLA_ENDPOINT, MAX_DEFERRED, prometheus_exporter_port
+from notify_deps import Retrier, CircuitOpen, dead_letter, delivered, malformed
+from metrics import (PROCESS_STATES, notification_sent, notification_error, RENDER_TIME,
+                     SEND_TIME, registry)
+from ratelimit import SharedRateLimiter, ThrottledWork
 
-KAFKA_TOPIC = os.environ.get('KAFKA_TOPIC') or 'NOTIFICATIONS_MQTT_S'
+# MQTT_KAFKA_TOPIC takes precedence, e.g. with the runner of several channels.
+KAFKA_TOPIC = (os.environ.get('MQTT_KAFKA_TOPIC') or os.environ.get('KAFKA_TOPIC')
+               or 'NOTIFICATIONS_MQTT_S')
 KAFKA_GROUP_ID = 'nuvla-notification-mqtt'
+# Number of worker processes, scaled up to MQTT_MAX_WORKERS on load.
+MQTT_WORKERS = int(os.environ.get('MQTT_WORKERS') or 5)
+MQTT_MAX_WORKERS = int(os.environ.get('MQTT_MAX_WORKERS') or MQTT_WORKERS)
 
 log_local = get_logger('mqtt-notifier')
 
+# Max number of broker connections kept open per worker process.
+MQTT_POOL_SIZE = int(os.environ.get('MQTT_POOL_SIZE') or 20)
+# Connections unused for longer than this (seconds) are closed.
+MQTT_IDLE_TIMEOUT = float(os.environ.get('MQTT_IDLE_TIMEOUT') or 300)
+# Max number of unacknowledged publishes per broker connection.
+MQTT_MAX_INFLIGHT = int(os.environ.get('MQTT_MAX_INFLIGHT') or 100)
+# Time to wait (seconds) for a free slot in the inflight window.
+MQTT_PUBLISH_TIMEOUT = float(os.environ.get('MQTT_PUBLISH_TIMEOUT') or 10)
+MQTT_QOS = int(os.environ.get('MQTT_QOS') or 0)
+MQTT_CONNECT_TIMEOUT = float(os.environ.get('MQTT_CONNECT_TIMEOUT') or 5)
+# Publishes per second and burst size allowed per broker. 0 disables the limit.
+MQTT_RATE_LIMIT = float(os.environ.get('MQTT_RATE_LIMIT') or 0)
+MQTT_RATE_BURST = float(os.environ.get('MQTT_RATE_BURST') or 10)
+# Max number of messages held back by the rate limiter or for a retry per
+# worker process.
+MQTT_MAX_DEFERRED = int(os.environ.get('MQTT_MAX_DEFERRED') or MAX_DEFERRED)
+
 
 def message_content(msg_params: dict) -> dict:
     log_local.debug('Building message content for: %s', msg_params)
@@ -40,7 +68,8 @@ def message_content(msg_params: dict) -> dict:
         'TIMESTAMP',
         'TRIGGER_RESOURCE_PATH',
         'TRIGGER_RESOURCE_NAME',
-        'RECOVERY']
+        'RECOVERY',
+        'FLAPPING']
 
     result = {}
     for attr in attrs:
@@ -64,50 +93,259 @@ def extract_destination(dest: str) -> tuple:
     return host, port, uri
 
 
-def send_mqtt_notification(payload: str, mqtt_server: str):
+class BrokerConnection:
+    """
+    Long-lived connection to an MQTT broker with a bounded window of
+    unacknowledged publishes. Publish outcomes are reported asynchronously
+    through the `on_done` callback given to `publish()`.
+    """
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.last_used = time.monotonic()
+        self._window = threading.BoundedSemaphore(MQTT_MAX_INFLIGHT)
+        self._pending = {}  # mid -> on_done
+        self._lock = threading.Lock()
+        self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+        self.client.connect_timeout = MQTT_CONNECT_TIMEOUT
+        self.client.max_inflight_messages_set(MQTT_MAX_INFLIGHT)
+        self.client.reconnect_delay_set(min_delay=1, max_delay=30)
+        self.client.on_publish = self._on_publish
+        self.client.on_disconnect = self._on_disconnect
+        self.client.connect(host, port)
+        self.client.loop_start()
+        log_local.info(f'Connected to MQTT broker {host}:{port}')
+
+    def _done(self, mid, error=None):
+        with self._lock:
+            on_done = self._pending.pop(mid, None)
+        if on_done is None:
+            return
+        self._window.release()
+        on_done(error)
+
+    def _on_publish(self, client, userdata, mid, reason_code, properties):
+        error = None
+        if reason_code.is_failure:
+            error = ConnectionError(f'Publish rejected by broker: {reason_code}')
+        self._done(mid, error)
+
+    def _on_disconnect(self, client, userdata, flags, reason_code, properties):
+        if reason_code.is_failure:
+            log_local.warning(f'Disconnected from MQTT broker {self.host}:{self.port}: '
+                              f'{reason_code}')
+        if MQTT_QOS == 0:
+            # QoS 0 messages not yet written to the socket are lost.
+            self.fail_pending(ConnectionError(f'Disconnected: {reason_code}'))
+
+    def fail_pending(self, error):
+        with self._lock:
+            mids = list(self._pending)
+        for mid in mids:
+            self._done(mid, error)
+
+    def publish(self, topic: str, payload: str, on_done):
+        if not self._window.acquire(timeout=MQTT_PUBLISH_TIMEOUT):
+            raise TimeoutError(f'Inflight window to {self.host}:{self.port} is full.')
+        self.last_used = time.monotonic()
+        # Hold the lock so that the acknowledgement can't be handled by the
+        # network loop thread before the message is registered as pending.
+        with self._lock:
+            info = self.client.publish(topic, payload, qos=MQTT_QOS)
+            if info.rc != mqtt.MQTT_ERR_SUCCESS:
+                self._window.release()
+                raise ConnectionError(f'Failed publishing to {self.host}:{self.port}: '
+                                      f'{mqtt.error_string(info.rc)}')
+            self._pending[info.mid] = on_done
+
+    def inflight(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+    def close(self):
+        self.client.disconnect()
+        self.client.loop_stop()
+        self.fail_pending(ConnectionError('Connection closed.'))
+
+
+class BrokerConnectionPool:
+    """
+    Bounded pool of broker connections keyed by (host, port). The least
+    recently used connection is evicted when the pool is full, and
+    connections idle for longer than `idle_timeout` are closed.
+    """
+
+    def __init__(self, max_size: int = MQTT_POOL_SIZE, idle_timeout: float = MQTT_IDLE_TIMEOUT):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self._conns = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._conns)
+
+    def _evict(self, key):
+        conn = self._conns.pop(key)
+        log_local.info(f'Closing connection to MQTT broker {conn.host}:{conn.port}')
+        try:
+            conn.close()
+        except Exception as ex:
+            log_local.warning(f'Failed closing connection to {conn.host}:{conn.port}: {ex}')
+
+    def evict_idle(self):
+        now = time.monotonic()
+        with self._lock:
+            for key in [k for k, c in self._conns.items()
+                        if now - c.last_used > self.idle_timeout and c.inflight() == 0]:
+                self._evict(key)
+
+    def get(self, host: str, port: int) -> BrokerConnection:
+        key = (host, port)
+        with self._lock:
+            conn = self._conns.pop(key, None)
+            if conn is None:
+                while len(self._conns) >= self.max_size:
+                    self._evict(next(iter(self._conns)))
+                conn = BrokerConnection(host, port)
+            self._conns[key] = conn
+            return conn
+
+
+limiter = SharedRateLimiter('mqtt', MQTT_RATE_LIMIT, MQTT_RATE_BURST)
+retrier = Retrier('mqtt')
+
+# Fields without which a message cannot be sent: it is dead-lettered.
+REQUIRED_FIELDS = ('DESTINATION',)
+
+
+def broker(msg) -> str:
+    host, port, _ = extract_destination(msg.value['DESTINATION'])
+    return f'{host}:{port}'
+
+
+_pool = None
+
+
+def broker_pool() -> BrokerConnectionPool:
+    global _pool
+    if _pool is None:
+        _pool = BrokerConnectionPool()
+    return _pool
+
+
+def send_message(payload: str, mqtt_server, on_done):
     host, port, topic = extract_destination(mqtt_server)
     log_local.info(f'Sending message to {host}:{port}/{topic}')
-    return mqtt_publish.single(topic, payload, hostname=host, port=int(port))
+    broker_pool().get(host, int(port)).publish(topic, payload, on_done)
 
 
-def send_message(payload: str, mqtt_server):
-    def thread_function():
-        try:
-            send_mqtt_notification(payload, mqtt_server)
-        except Exception as e:
-            log_local.error(f'An error occurred: {e}')
+def process_message(msg, retry=None):
+    """
+    Publish the message. The outcome is handled once the broker acknowledged
+    the publish: a failed message is handed over to `retry(msg, delay)` for
+    another attempt, if given.
+    """
+    if malformed(msg, 'mqtt', REQUIRED_FIELDS):
+        ack(msg)
+        return
+    log_local.debug("Received message. Key: %s. Value: %s", msg.key, msg.value)
+    subs_name = msg.value.get('NAME') or msg.value.get('SUBS_NAME')
+    dest = msg.value['DESTINATION']
+    try:
+        dest_broker = broker(msg)
+    except Exception:
+        dest_broker = dest
 
-    thread = threading.Thread(target=thread_function)
-    thread.start()
+    def on_done(error):
+        if error is None:
+            SEND_TIME.labels('mqtt').observe(time.monotonic() - sent_at)
+            retrier.breaker.success(dest_broker)
+            retrier.done(msg)
+            ack(msg)
+            notification_sent('mqtt', subs_name, dest)
+            delivered(msg, 'mqtt')
+            log_local.info(f'sent: {subs_name} to {dest}')
+            return
+        if not isinstance(error, CircuitOpen):
+            retrier.breaker.failure(dest_broker)
+        if retry:
+            delay = retrier.delay(msg, error)
+        else:
+            delay = None
+            retrier.give_up(msg, error)
+        if delay is not None:
+            log_local.warning(f'Failed sending message: {subs_name} to {dest}, '
+                              f'retry in {delay:.1f}s: {error}')
+            retry(msg, delay)
+            return
+        failed(error)
+
+    def failed(error):
+        ack(msg)
+        log_local.error(f'Failed sending message: {subs_name} to {dest}: {error}')
+        PROCESS_STATES.state('error - recoverable')
+        notification_error('mqtt', subs_name, dest, error)
+
+    try:
+        with RENDER_TIME.labels('mqtt').time():
+            payload = json.dumps(message_content(msg.value))
+    except Exception as ex:
+        dead_letter(msg, 'mqtt', ex)
+        failed(ex)
+        return
+    # Publishes are acknowledged asynchronously: timed until on_done().
+    sent_at = time.monotonic()
+    try:
+        retrier.breaker.check(dest_broker)
+        send_message(payload, dest, on_done)
+    except Exception as ex:
+        on_done(ex)
 
 
 def worker(workq: multiprocessing.Queue):
+    pool = broker_pool()
+    # Messages to brokers over their rate, and failed ones, are deferred
+    # rather than waited for.
+    work = ThrottledWork(workq, limiter, broker, MQTT_MAX_DEFERRED)
     while True:
         PROCESS_STATES.state('idle')
 
-        msg = workq.get()
+        msg = work.get(timeout=pool.idle_timeout)
+        pool.evict_idle()
         if not msg:
             continue
 
         PROCESS_STATES.state('processing')
+        process_message(msg, work.defer)
+
+
+async def async_worker(msg):
+    pool = broker_pool()
+    loop = asyncio.get_running_loop()
+
+    def retry(m, delay):
+        # Called from the network loop thread of the connection.
+        loop.call_soon_threadsafe(
+            lambda: asyncio.ensure_future(async_retry(m, delay)))
+
+    async def async_retry(m, delay):
+        await asyncio.sleep(delay)
+        await loop.run_in_executor(None, process_message, m, retry)
+
+    await loop.run_in_executor(None, pool.evict_idle)
+    try:
+        await limiter.async_wait(broker(msg))
+    except Exception as ex:
+        log_local.debug(f'No destination for {msg}: {ex}')
+    await loop.run_in_executor(None, process_message, msg, retry)
 
-        log_local.debug("Received message. Key: %s. Value: %s", msg.key, msg.value)
-        subs_name = msg.value.get('NAME') or msg.value['SUBS_NAME']
-        dest = msg.value['DESTINATION']
-        try:
-            msg_dict = message_content(msg.value)
-            send_message(json.dumps(msg_dict), dest)
-        except Exception as ex:
-            err_msg = f'Failed sending message: {subs_name} to {dest}'
-            log_local.error(err_msg)
-            PROCESS_STATES.state('error - recoverable')
-            NOTIFICATIONS_ERROR.labels('mqtt', subs_name, dest, type(ex)).inc()
-            continue
 
-        NOTIFICATIONS_SENT.labels('mqtt', subs_name, dest).inc()
-        log_local.info(f'sent: {msg} to {dest}')
+channel = register_channel(Channel(
+    'mqtt', KAFKA_TOPIC, worker, group_id=KAFKA_GROUP_ID, async_worker=async_worker,
+    num_workers=MQTT_WORKERS, max_workers=MQTT_MAX_WORKERS))
 
 
 if __name__ == "__main__":
     start_http_server(prometheus_exporter_port(), registry=registry)
-    main(worker, KAFKA_TOPIC, KAFKA_GROUP_ID)
+    run([channel])
@@ -0,0 +1,29 @@
+#!/usr/bin/env python3
+"""
+Runs several notification channels, e.g. email, Slack and MQTT, from a single
+Kafka consumer subscribed to all their topics, with a single Prometheus
+exporter. Each channel keeps its own worker processes, or its own budget of
+concurrent sends with the asyncio engine.
+"""
+
+import os
+
+from prometheus_client import start_http_server
+
+from notify_deps import get_logger, load_channels, run, prometheus_exporter_port
+from metrics import registry
+
+# Comma separated names of the channels to run.
+NOTIFY_CHANNELS = [name.strip() for name in
+                   (os.environ.get('NOTIFY_CHANNELS') or 'email,slack,mqtt').split(',')
+                   if name.strip()]
+KAFKA_GROUP_ID = os.environ.get('KAFKA_GROUP_ID') or 'nuvla-notification'
+
+log_local = get_logger('multi')
+
+
+if __name__ == "__main__":
+    channels = load_channels(NOTIFY_CHANNELS)
+    log_local.info(f'Running channels: {channels}')
+    start_http_server(prometheus_exporter_port(), registry=registry)
+    run(channels, KAFKA_GROUP_ID)
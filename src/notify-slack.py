@@ -1,19 +1,56 @@
 #!/usr/bin/env python3
 
+import asyncio
 import json
 import multiprocessing
 import os
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
 import requests
+from requests.adapters import HTTPAdapter
 
 from prometheus_client import start_http_server
 
-from notify_deps import get_logger, timestamp_convert, main, now_timestamp
-from notify_deps import NUVLA_ENDPOINT, prometheus_exporter_port
-from metrics import PROCESS_STATES, NOTIFICATIONS_SENT, NOTIFICATIONS_ERROR, registry
+from notify_deps import get_logger, timestamp_convert, now_timestamp, ack
+from notify_deps import Channel, register_channel, run
+from notify_deps import AT_LEAST_ONCE, Coalescer, DelayedWork, retiring
+from notify_deps import NUVLA_ENDPOINT, MAX_DEFERRED, prometheus_exporter_port
+from notify_deps import Retrier, Throttled, PermanentError, dead_letter, delivered, malformed
+from metrics import (PROCESS_STATES, notification_sent, notification_error, RENDER_TIME,
+                     SEND_TIME, registry)
+from ratelimit import SharedRateLimiter, ThrottledWork, retry_after
 
-KAFKA_TOPIC = os.environ.get('KAFKA_TOPIC') or 'NOTIFICATIONS_SLACK_S'
+# SLACK_KAFKA_TOPIC takes precedence, e.g. with the runner of several channels.
+KAFKA_TOPIC = (os.environ.get('SLACK_KAFKA_TOPIC') or os.environ.get('KAFKA_TOPIC')
+               or 'NOTIFICATIONS_SLACK_S')
 KAFKA_GROUP_ID = 'nuvla-notification-slack'
+# Number of worker processes, scaled up to SLACK_MAX_WORKERS on load.
+SLACK_WORKERS = int(os.environ.get('SLACK_WORKERS') or 5)
+SLACK_MAX_WORKERS = int(os.environ.get('SLACK_MAX_WORKERS') or SLACK_WORKERS)
+
+# Max number of concurrent webhook posts per worker process (or per process
+# with the asyncio engine).
+SLACK_MAX_INFLIGHT = int(os.environ.get('SLACK_MAX_INFLIGHT') or 10)
+SLACK_CONNECT_TIMEOUT = float(os.environ.get('SLACK_CONNECT_TIMEOUT') or 5)
+SLACK_READ_TIMEOUT = float(os.environ.get('SLACK_READ_TIMEOUT') or 10)
+# Posts per second and burst size allowed per webhook, across the worker
+# processes. 0 disables the limit.
+SLACK_RATE_LIMIT = float(os.environ.get('SLACK_RATE_LIMIT') or 1)
+SLACK_RATE_BURST = float(os.environ.get('SLACK_RATE_BURST') or 5)
+# Seconds to back off a webhook answering 429 without a Retry-After header.
+SLACK_RETRY_AFTER = float(os.environ.get('SLACK_RETRY_AFTER') or 30)
+# Max number of messages held back by the rate limiter or for a retry per
+# worker process.
+SLACK_MAX_DEFERRED = int(os.environ.get('SLACK_MAX_DEFERRED') or MAX_DEFERRED)
+# Messages to the same webhook within SLACK_BATCH_WINDOW seconds are posted as
+# a single payload of up to SLACK_BATCH_MAX_MESSAGES attachments and
+# SLACK_BATCH_MAX_BYTES bytes. 0 disables batching.
+SLACK_BATCH_WINDOW = float(os.environ.get('SLACK_BATCH_WINDOW') or 0)
+SLACK_BATCH_MAX_MESSAGES = int(os.environ.get('SLACK_BATCH_MAX_MESSAGES') or 20)
+SLACK_BATCH_MAX_BYTES = int(os.environ.get('SLACK_BATCH_MAX_BYTES') or 30000)
 
 log_local = get_logger('slack')
 
@@ -35,6 +72,8 @@ def message_content(msg_params: dict):
     else:
         color = COLOR_NOK
         notif_title = f"[Alert] {msg_params.get('SUBS_NAME')}"
+    if msg_params.get('FLAPPING'):
+        notif_title = f"[Flapping] {msg_params.get('SUBS_NAME')}"
 
     subs_config_link = f'<{NUVLA_ENDPOINT}/ui/notifications|Notification configuration>'
 
@@ -113,36 +152,342 @@ def message_content(msg_params: dict):
     return {'attachments': attachments}
 
 
+def batch_header(msgs_params: list) -> str:
+    recoveries = sum(bool(m.get('RECOVERY', False)) for m in msgs_params)
+    subs_names = list(dict.fromkeys(m.get('SUBS_NAME') or 'alert' for m in msgs_params))
+    return (f"*{len(msgs_params)} notifications* ({len(msgs_params) - recoveries} alerts, "
+            f"{recoveries} recoveries): {', '.join(subs_names)}")
+
+
+def batch_content(msgs_params: list, attachments: list) -> dict:
+    if len(attachments) == 1:
+        return {'attachments': attachments}
+    return {'text': batch_header(msgs_params), 'attachments': attachments}
+
+
+def batch_payloads(dest: str, msgs: list) -> list:
+    """
+    Split the messages into payloads of several attachments within
+    SLACK_BATCH_MAX_BYTES. Returns (messages, payload) of each payload.
+    Messages that cannot be rendered are dead-lettered.
+    """
+    payloads = []
+    chunk, attachments, payload = [], [], None
+    for msg in msgs:
+        try:
+            with RENDER_TIME.labels('slack').time():
+                attachment = message_content(msg.value)['attachments']
+        except Exception as ex:
+            log_local.error(f'Failed building message from {msg}: {ex}')
+            notification_error('slack', notification_name(msg.value), dest, ex)
+            dead_letter(msg, 'slack', ex)
+            continue
+        candidate = batch_content([m.value for m in chunk + [msg]], attachments + attachment)
+        if chunk and len(json.dumps(candidate)) > SLACK_BATCH_MAX_BYTES:
+            payloads.append((chunk, payload))
+            chunk, attachments = [], []
+            candidate = batch_content([msg.value], attachment)
+        chunk.append(msg)
+        attachments.extend(attachment)
+        payload = candidate
+    if chunk:
+        payloads.append((chunk, payload))
+    return payloads
+
+
+_http_sessions = {}
+_http_sessions_lock = threading.Lock()
+
+
+def http_session(dest: str) -> requests.Session:
+    """
+    Keep-alive HTTP session shared by all posts to the webhook host of `dest`.
+    """
+    host = urlparse(dest).netloc
+    with _http_sessions_lock:
+        session = _http_sessions.get(host)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=SLACK_MAX_INFLIGHT)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _http_sessions[host] = session
+        return session
+
+
+limiter = SharedRateLimiter('slack', SLACK_RATE_LIMIT, SLACK_RATE_BURST)
+retrier = Retrier('slack')
+
+# Fields without which a message cannot be sent: it is dead-lettered.
+REQUIRED_FIELDS = ('DESTINATION',)
+
+
+def destination(msg) -> str:
+    return msg.value.get('DESTINATION')
+
+
 def send_message(dest, message):
-    return requests.post(dest, data=json.dumps(message))
+    return http_session(dest).post(dest, data=json.dumps(message),
+                                   timeout=(SLACK_CONNECT_TIMEOUT, SLACK_READ_TIMEOUT))
+
+
+def post(dest, message):
+    with SEND_TIME.labels('slack').time():
+        resp = send_message(dest, message)
+    if resp.status_code == 429:
+        delay = retry_after(resp.headers, SLACK_RETRY_AFTER)
+        limiter.block(dest, delay)
+        raise Throttled(delay)
+    if 400 <= resp.status_code < 500:
+        raise PermanentError(resp.text)
+    if not resp.ok:
+        raise ConnectionError(resp.text)
+
+
+def notification_name(msg_params: dict) -> str:
+    return f'{msg_params.get("NAME") or msg_params.get("SUBS_NAME")}'
+
+
+def process_message(msg) -> float:
+    """
+    Send the message. Returns the delay (seconds) after which to retry it, or
+    0 when done with it.
+    """
+    if malformed(msg, 'slack', REQUIRED_FIELDS):
+        return 0
+    dest = msg.value['DESTINATION']
+    name = notification_name(msg.value)
+    try:
+        with RENDER_TIME.labels('slack').time():
+            message = message_content(msg.value)
+    except Exception as ex:
+        log_local.error(f'Failed building message from {msg}: {ex}')
+        notification_error('slack', name, dest, ex)
+        dead_letter(msg, 'slack', ex)
+        return 0
+    try:
+        delay = retrier.run(msg, dest, post, dest, message)
+    except Exception as ex:
+        log_local.error(f'Failed sending {msg} to {dest}: {ex}')
+        PROCESS_STATES.state('error - recoverable')
+        notification_error('slack', name, dest, ex)
+        return 0
+    if delay == 0:
+        notification_sent('slack', name, dest)
+        delivered(msg, 'slack')
+        log_local.info(f'sent: {msg} to {dest}')
+    return delay
+
+
+def post_batch(dest: str, msgs: list, payload: dict) -> list:
+    """
+    Post the payload of the messages. Returns (message, delay) of the messages
+    to retry after delay (seconds).
+    """
+    try:
+        retrier.call(dest, post, dest, payload)
+    except Exception as ex:
+        retries = [(msg, retrier.delay(msg, ex)) for msg in msgs]
+        failed = [msg.value for msg, delay in retries if delay is None]
+        if failed:
+            log_local.error(f'Failed sending batch of {len(msgs)} messages to {dest}: {ex}')
+            for v in failed:
+                notification_error('slack', notification_name(v), dest, ex)
+            PROCESS_STATES.state('error - recoverable')
+        else:
+            log_local.warning(f'Failed sending batch of {len(msgs)} messages to {dest}, '
+                              f'will retry: {ex}')
+        return [(msg, delay) for msg, delay in retries if delay is not None]
+    for msg in msgs:
+        retrier.done(msg)
+        notification_sent('slack', notification_name(msg.value), dest)
+        delivered(msg, 'slack')
+    log_local.info(f'sent batch of {len(msgs)} messages to {dest}')
+    return []
+
+
+def process_batch(dest: str, msgs: list) -> list:
+    """
+    Send the messages to the webhook as few payloads as the caps allow, each
+    within the rate limit of the webhook. Returns (message, delay) of the
+    messages to retry after delay (seconds).
+    """
+    retries = []
+    for chunk, payload in batch_payloads(dest, msgs):
+        delay = limiter.acquire(dest)
+        if delay > 0:
+            retries.extend((msg, delay) for msg in chunk)
+        else:
+            retries.extend(post_batch(dest, chunk, payload))
+    return retries
+
+
+def batch_worker(workq: multiprocessing.Queue):
+    executor = ThreadPoolExecutor(max_workers=SLACK_MAX_INFLIGHT,
+                                  thread_name_prefix='slack-send')
+    inflight = threading.BoundedSemaphore(SLACK_MAX_INFLIGHT)
+    # Rate limits apply per batch rather than per message.
+    work = DelayedWork(workq, SLACK_MAX_DEFERRED)
+    batches = Coalescer(SLACK_BATCH_WINDOW, SLACK_BATCH_MAX_MESSAGES)
+    log_local.info('batch mode: window %ss, max %s messages, max %s bytes',
+                   SLACK_BATCH_WINDOW, SLACK_BATCH_MAX_MESSAGES, SLACK_BATCH_MAX_BYTES)
+
+    def run(dest, msgs):
+        retries = []
+        try:
+            retries = process_batch(dest, msgs)
+        except Exception as ex:
+            log_local.error(f'Failed processing batch to {dest}: {ex}')
+            for m in msgs:
+                dead_letter(m, 'slack', ex)
+        finally:
+            inflight.release()
+        # Retried messages go through a batch again.
+        for m, delay in retries:
+            work.defer(m, delay)
+        retried = {id(m) for m, _ in retries}
+        for m in msgs:
+            if id(m) not in retried:
+                ack(m)
+
+    def flush(dest, msgs):
+        inflight.acquire()
+        PROCESS_STATES.state('processing')
+        executor.submit(run, dest, msgs)
+
+    while True:
+        PROCESS_STATES.state('idle')
+        msg = work.get(timeout=batches.timeout())
+        if msg and malformed(msg, 'slack', REQUIRED_FIELDS):
+            ack(msg)
+        elif msg:
+            dest = destination(msg)
+            full = batches.add(dest, msg)
+            if full:
+                flush(dest, full)
+        # Batches are sent right away once the worker is asked to exit.
+        for dest, msgs in (batches.drain() if retiring() else batches.expired()):
+            flush(dest, msgs)
 
 
 def worker(workq: multiprocessing.Queue):
+    if SLACK_BATCH_WINDOW > 0:
+        batch_worker(workq)
+        return
+    executor = ThreadPoolExecutor(max_workers=SLACK_MAX_INFLIGHT,
+                                  thread_name_prefix='slack-send')
+    # Do not take more messages off the queue than can be sent concurrently.
+    inflight = threading.BoundedSemaphore(SLACK_MAX_INFLIGHT)
+    # Messages to webhooks over their rate, and failed ones, are deferred
+    # rather than waited for.
+    work = ThrottledWork(workq, limiter, destination, SLACK_MAX_DEFERRED)
+
+    def run(msg):
+        delay = 0
+        try:
+            delay = process_message(msg)
+        except Exception as ex:
+            log_local.error(f'Failed processing {msg}: {ex}')
+            dead_letter(msg, 'slack', ex)
+        finally:
+            inflight.release()
+        if delay > 0:
+            work.defer(msg, delay)
+        else:
+            ack(msg)
+
     while True:
+        inflight.acquire()
         PROCESS_STATES.state('idle')
-        msg = workq.get()
+        msg = work.get()
         PROCESS_STATES.state('processing')
         if msg:
-            dest = msg.value['DESTINATION']
-            try:
-                resp = send_message(dest, message_content(msg.value))
-            except requests.exceptions.RequestException as ex:
-                log_local.error(f'Failed sending {msg} to {dest}: {ex}')
-                PROCESS_STATES.state('error - recoverable')
-                NOTIFICATIONS_ERROR.labels('slack', f'{msg.value.get("NAME") or msg.value["SUBS_NAME"]}',
-                                           dest, type(ex)).inc()
-                continue
-            if not resp.ok:
-                log_local.error(f'Failed sending {msg} to {dest}: {resp.text}')
-                PROCESS_STATES.state('error - recoverable')
-                NOTIFICATIONS_ERROR.labels('slack', f'{msg.value.get("NAME") or msg.value["SUBS_NAME"]}',
-                                           dest, resp.text).inc()
-            else:
-                NOTIFICATIONS_SENT.labels('slack', f'{msg.value.get("NAME") or msg.value["SUBS_NAME"]}',
-                                          dest).inc()
-                log_local.info(f'sent: {msg} to {dest}')
+            executor.submit(run, msg)
+        else:
+            inflight.release()
+
+
+_async_inflight = None
+_async_batches = None
+_async_batches_flusher = None
+
+
+async def async_retry(msg, delay: float):
+    await asyncio.sleep(delay)
+    await async_worker(msg)
+
+
+async def async_flush_batch(dest: str, msgs: list):
+    retries = []
+    try:
+        async with _async_inflight:
+            retries = await asyncio.get_running_loop().run_in_executor(
+                None, process_batch, dest, msgs)
+        # Retried messages go through a batch again.
+        for m, delay in retries:
+            asyncio.ensure_future(async_retry(m, delay))
+    except Exception as ex:
+        log_local.error(f'Failed processing batch to {dest}: {ex}')
+        for m in msgs:
+            dead_letter(m, 'slack', ex)
+    finally:
+        retried = {id(m) for m, _ in retries}
+        for m in msgs:
+            if id(m) not in retried:
+                ack(m)
+
+
+async def async_batch_flusher():
+    while True:
+        timeout = _async_batches.timeout()
+        await asyncio.sleep(SLACK_BATCH_WINDOW if timeout is None else timeout)
+        for dest, msgs in _async_batches.expired():
+            asyncio.ensure_future(async_flush_batch(dest, msgs))
+
+
+async def async_batch(msg):
+    global _async_batches, _async_batches_flusher
+    if _async_batches is None:
+        _async_batches = Coalescer(SLACK_BATCH_WINDOW, SLACK_BATCH_MAX_MESSAGES)
+        _async_batches_flusher = asyncio.ensure_future(async_batch_flusher())
+    dest = destination(msg)
+    full = _async_batches.add(dest, msg)
+    if full:
+        await async_flush_batch(dest, full)
+
+
+async def async_worker(msg):
+    global _async_inflight
+    if _async_inflight is None:
+        _async_inflight = asyncio.Semaphore(SLACK_MAX_INFLIGHT)
+    if malformed(msg, 'slack', REQUIRED_FIELDS):
+        ack(msg)
+        return
+    if SLACK_BATCH_WINDOW > 0:
+        await async_batch(msg)
+        return
+    try:
+        while True:
+            await limiter.async_wait(destination(msg))
+            async with _async_inflight:
+                delay = await asyncio.get_running_loop().run_in_executor(
+                    None, process_message, msg)
+            if delay <= 0:
+                return
+            await asyncio.sleep(delay)
+    except Exception as ex:
+        log_local.error(f'Failed processing {msg}: {ex}')
+        dead_letter(msg, 'slack', ex)
+    finally:
+        ack(msg)
+
+
+channel = register_channel(Channel(
+    'slack', KAFKA_TOPIC, worker, group_id=KAFKA_GROUP_ID, async_worker=async_worker,
+    manual_commit=AT_LEAST_ONCE or SLACK_BATCH_WINDOW > 0,
+    num_workers=SLACK_WORKERS, max_workers=SLACK_MAX_WORKERS))
 
 
 if __name__ == "__main__":
     start_http_server(prometheus_exporter_port(), registry=registry)
-    main(worker, KAFKA_TOPIC, KAFKA_GROUP_ID)
+    run([channel])
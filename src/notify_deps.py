@@ -1,12 +1,35 @@
+import asyncio
+import contextlib
+import functools
+import hashlib
+import heapq
+import importlib.util
+import itertools
 import json
 import logging
 import multiprocessing
+import multiprocessing.util
 import queue
 import os
+import random
+import signal
 import sys
+import threading
 import time
-from datetime import datetime
-from kafka import KafkaConsumer
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from kafka import KafkaConsumer, KafkaProducer, TopicPartition
+from kafka.consumer.subscription_state import ConsumerRebalanceListener
+from kafka.structs import OffsetAndMetadata
+
+from metrics import (CONSUMER_PAUSED, CONSUMER_PAUSES, CONSUMER_PAUSED_SECONDS,
+                     NOTIFICATIONS_RETRIES, CIRCUIT_BREAKER_OPENED, NOTIFICATIONS_DEAD_LETTERED,
+                     DELIVERY_DELAY, QUEUE_WAIT, STARTUP_SECONDS, WORKERS_READY,
+                     DEDUP_LOOKUPS, DEDUP_CACHE_SIZE, NOTIFICATIONS_FLAPPING, FLAP_HELD,
+                     WORKERS, WORKER_UTILIZATION, CONSUMER_LAG, AUTOSCALE_DECISIONS,
+                     WORKER_QUEUE_DEPTH, KEYS_REBALANCED, SHUTDOWN_SECONDS,
+                     MESSAGES_ABANDONED, error_label, process_dead)
 
 log_formatter = logging.Formatter(
     '%(asctime)s - %(name)s - %(process)d - %(module)s:%(lineno)d - %(levelname)s - %(message)s')
@@ -34,23 +57,259 @@ if 'KAFKA_BOOTSTRAP_SERVERS' in os.environ:
 
 NUVLA_ENDPOINT = (os.environ.get('NUVLA_ENDPOINT') or 'https://nuvla.io').rstrip('/')
 
+# 'raw': the consumer hands over raw value bytes which workers decode;
+# 'decoded': the consumer decodes values and hands over the whole ConsumerRecord.
+KAFKA_RECORD_MODE = os.environ.get('KAFKA_RECORD_MODE') or 'raw'
+
+# 'at-most-once': offsets are auto-committed once messages are consumed;
+# 'at-least-once': offsets are committed once workers are done with messages.
+KAFKA_DELIVERY_MODE = os.environ.get('KAFKA_DELIVERY_MODE') or 'at-most-once'
+AT_LEAST_ONCE = KAFKA_DELIVERY_MODE == 'at-least-once'
+# Interval (seconds) between commits of acknowledged offsets.
+KAFKA_COMMIT_INTERVAL = float(os.environ.get('KAFKA_COMMIT_INTERVAL') or 5)
+
+# 'process': messages are sent from a pool of worker processes;
+# 'asyncio': messages are sent concurrently from a single process.
+WORKER_ENGINE = os.environ.get('WORKER_ENGINE') or 'process'
+# Max number of concurrent sends with the asyncio engine.
+ASYNC_MAX_INFLIGHT = int(os.environ.get('ASYNC_MAX_INFLIGHT') or 200)
+
+# Max number of records returned by a single poll.
+KAFKA_MAX_POLL_RECORDS = int(os.environ.get('KAFKA_MAX_POLL_RECORDS') or 500)
+# 'shared': the worker processes take messages off a single work queue;
+# 'key': messages are routed to a queue per worker by key, keeping the order
+# of the messages of the same key.
+KAFKA_DISPATCH_MODE = os.environ.get('KAFKA_DISPATCH_MODE') or 'shared'
+# Fields making the key of a message without a Kafka key.
+AFFINITY_FIELDS = ('SUBS_ID', 'RESOURCE_URI')
+# A key with no message in flight goes to the least busy worker, rather than
+# the one of its hash, when the latter has this many more messages waiting.
+KEY_STEAL_THRESHOLD = int(os.environ.get('KEY_STEAL_THRESHOLD') or 10)
+
+# Max number of messages handed over to a worker at once, and how long
+# (seconds) a partial batch is held back to be filled before it is handed over.
+KAFKA_BATCH_SIZE = int(os.environ.get('KAFKA_BATCH_SIZE') or 10)
+KAFKA_BATCH_LINGER = float(os.environ.get('KAFKA_BATCH_LINGER') or 0)
+
+# Fetching from Kafka is paused when the number of messages waiting for or
+# being processed reaches the high watermark, and resumed once it is at or
+# below the low watermark. Default to the work queue size (or the max number
+# of in-flight sends) and half of it.
+KAFKA_PAUSE_HIGH_WATERMARK = int(os.environ.get('KAFKA_PAUSE_HIGH_WATERMARK') or 0)
+KAFKA_PAUSE_LOW_WATERMARK = int(os.environ.get('KAFKA_PAUSE_LOW_WATERMARK') or 0)
+
+# Failed sends are retried up to RETRY_ATTEMPTS times in all, after an
+# exponential backoff (seconds) with jitter, capped at RETRY_BACKOFF_MAX.
+RETRY_ATTEMPTS = int(os.environ.get('RETRY_ATTEMPTS') or 3)
+RETRY_BACKOFF = float(os.environ.get('RETRY_BACKOFF') or 1)
+RETRY_BACKOFF_MAX = float(os.environ.get('RETRY_BACKOFF_MAX') or 300)
+# Sends rejected by the destination as over its rate or quota, e.g. Slack 429
+# or SMTP 421, are retried after the delay it asks for, up to
+# RETRY_THROTTLED_ATTEMPTS times in all.
+RETRY_THROTTLED_ATTEMPTS = int(os.environ.get('RETRY_THROTTLED_ATTEMPTS') or 10)
+# Sends to a destination fail fast for CIRCUIT_RESET_TIMEOUT seconds after
+# CIRCUIT_FAILURE_THRESHOLD consecutive failures (0 disables the breaker).
+CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get('CIRCUIT_FAILURE_THRESHOLD') or 5)
+CIRCUIT_RESET_TIMEOUT = float(os.environ.get('CIRCUIT_RESET_TIMEOUT') or 30)
+# Max number of messages held back for a later retry per worker process.
+MAX_DEFERRED = int(os.environ.get('MAX_DEFERRED') or 1000)
+
+# Topic to publish undeliverable messages to (disabled when not set), and how
+# long (milliseconds) the producer waits to batch them.
+KAFKA_DLQ_TOPIC = os.environ.get('KAFKA_DLQ_TOPIC') or ''
+KAFKA_DLQ_LINGER_MS = int(os.environ.get('KAFKA_DLQ_LINGER_MS') or 100)
+
+# Seconds during which a notification already consumed is dropped as a
+# duplicate (0 disables deduplication), and max number of notifications
+# remembered.
+DEDUP_TTL = float(os.environ.get('DEDUP_TTL') or 0)
+DEDUP_CAPACITY = int(os.environ.get('DEDUP_CAPACITY') or 100000)
+# Fields identifying a notification.
+DEDUP_FIELDS = ('SUBS_ID', 'RESOURCE_URI', 'RECOVERY', 'TIMESTAMP')
+
+# Seconds alerts are held back, per subscription and resource, for a
+# recovery to cancel them (0 disables flap suppression). With the 'drop'
+# mode, the alert and the recovery are both dropped; with 'summary', the
+# last of them is sent at the end of the window, flagged as FLAPPING.
+FLAP_WINDOW = float(os.environ.get('FLAP_WINDOW') or 0)
+FLAP_MODE = os.environ.get('FLAP_MODE') or 'drop'
+# Max number of resources with an alert held back.
+FLAP_CAPACITY = int(os.environ.get('FLAP_CAPACITY') or 100000)
+
+# Seconds given to the workers on shutdown, e.g. on SIGTERM, to finish their
+# work before they are terminated. Keep it below the grace period of the
+# orchestrator (10 seconds for Docker, 30 for Kubernetes).
+SHUTDOWN_TIMEOUT = float(os.environ.get('SHUTDOWN_TIMEOUT') or 8)
+
+# Channels with more max than min workers are scaled every AUTOSCALE_INTERVAL
+# seconds: up when the share of busy workers reaches AUTOSCALE_UP_UTILIZATION
+# with messages waiting for them, or the consumer lag reaches AUTOSCALE_UP_LAG
+# messages per worker (0 disables the lag); down when it stays at or below
+# AUTOSCALE_DOWN_UTILIZATION without messages waiting. No change is made for
+# the cooldown (seconds) following a scale up, or down.
+AUTOSCALE_INTERVAL = float(os.environ.get('AUTOSCALE_INTERVAL') or 10)
+AUTOSCALE_UP_UTILIZATION = float(os.environ.get('AUTOSCALE_UP_UTILIZATION') or 0.8)
+AUTOSCALE_DOWN_UTILIZATION = float(os.environ.get('AUTOSCALE_DOWN_UTILIZATION') or 0.3)
+AUTOSCALE_UP_LAG = int(os.environ.get('AUTOSCALE_UP_LAG') or 1000)
+AUTOSCALE_UP_COOLDOWN = float(os.environ.get('AUTOSCALE_UP_COOLDOWN') or 30)
+AUTOSCALE_DOWN_COOLDOWN = float(os.environ.get('AUTOSCALE_DOWN_COOLDOWN') or 300)
+
 work_queue = multiprocessing.Queue()
 
 DEFAULT_PROMETHEUS_EXPORTER_PORT = 9140
 
 
-def kafka_consumer(topic, bootstrap_servers, group_id, auto_offset_reset='latest'):
+def _json_decode(x: bytes):
+    return json.loads(x.decode())
+
+
+try:
+    import orjson
+    _default_value_decoder = orjson.loads
+except ImportError:
+    _default_value_decoder = _json_decode
+
+VALUE_DECODERS = {
+    'json': _json_decode,
+    'orjson': _default_value_decoder,
+}
+
+_value_decoder = VALUE_DECODERS.get(os.environ.get('KAFKA_VALUE_DECODER'),
+                                    _default_value_decoder)
+
+
+def set_value_decoder(decoder):
+    """Set the function used to decode raw Kafka values (bytes) into dicts."""
+    global _value_decoder
+    _value_decoder = decoder
+
+
+def decode_value(x: bytes) -> dict:
+    return {} if x is None else _value_decoder(x)
+
+
+class Record:
+    """
+    Kafka record as handed over to the workers: the raw value bytes plus the
+    minimal metadata. The value is decoded on first access, in the worker.
+    `timestamp` is the Kafka record timestamp (milliseconds) and
+    `consumed_at` the time (seconds since the epoch) it was polled.
+    """
+
+    __slots__ = ('topic', 'partition', 'offset', 'key', 'raw_value', '_value',
+                 'timestamp', 'consumed_at')
+
+    def __init__(self, topic: str, partition: int, offset: int, key: str, raw_value: bytes,
+                 timestamp: int = None, consumed_at: float = None):
+        self.topic = topic
+        self.partition = partition
+        self.offset = offset
+        self.key = key
+        self.raw_value = raw_value
+        self._value = None
+        self.timestamp = timestamp
+        self.consumed_at = consumed_at
+
+    @classmethod
+    def from_consumer_record(cls, msg, consumed_at: float = None):
+        return cls(msg.topic, msg.partition, msg.offset, msg.key, msg.value,
+                   msg.timestamp, consumed_at)
+
+    @property
+    def value(self) -> dict:
+        if self._value is None:
+            self._value = decode_value(self.raw_value)
+        return self._value
+
+    def __reduce__(self):
+        # Never ship the decoded value between processes.
+        return Record, (self.topic, self.partition, self.offset, self.key, self.raw_value,
+                        self.timestamp, self.consumed_at)
+
+    def __repr__(self):
+        return (f'Record(topic={self.topic!r}, partition={self.partition}, '
+                f'offset={self.offset}, key={self.key!r})')
+
+
+def kafka_consumer(topic, bootstrap_servers, group_id, auto_offset_reset='latest',
+                   enable_auto_commit=True, decode_values=True, listener=None):
+    """Consumer subscribed to the topic, or to the list of topics."""
     consumer = KafkaConsumer(
-        topic,
         bootstrap_servers=bootstrap_servers,
         auto_offset_reset=auto_offset_reset,
         group_id=group_id,
+        enable_auto_commit=enable_auto_commit,
         key_deserializer=lambda x: '' if x is None else str(x.decode()),
-        value_deserializer=lambda x: {} if x is None else json.loads(x.decode()))
+        value_deserializer=decode_value if decode_values else None)
+    consumer.subscribe([topic] if isinstance(topic, str) else list(topic), listener=listener)
     log.info("Kafka consumer created.")
     return consumer
 
 
+@contextlib.contextmanager
+def startup_phase(phase: str):
+    """Time a startup phase, exported as kafka_notify_startup_seconds{phase}."""
+    started = time.monotonic()
+    yield
+    seconds = time.monotonic() - started
+    STARTUP_SECONDS.labels(phase).set(seconds)
+    log.info('Startup phase %s took %.3fs.', phase, seconds)
+
+
+def _start_consumer(create_consumer, channels: list):
+    """
+    Create the Kafka consumer in the background while the channels are set
+    up. Return the consumer, and the initargs of each channel extended with
+    the ones returned by its `setup`.
+    """
+    def create():
+        with startup_phase('consumer'):
+            return create_consumer()
+
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix='kafka-start') as executor:
+        consumer = executor.submit(create)
+        initargs = []
+        with startup_phase('setup'):
+            for channel in channels:
+                extra = tuple(channel.setup()) if channel.setup is not None else ()
+                initargs.append(channel.initargs + extra)
+        return consumer.result(), initargs
+
+
+@functools.lru_cache(maxsize=1024)
+def timestamp_epoch(ts) -> float:
+    return datetime.strptime(ts, '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=timezone.utc).timestamp()
+
+
+def delivery_delay(msg):
+    """
+    Seconds since the notification event: the Kafka record timestamp, or the
+    TIMESTAMP of the message. None when unknown.
+    """
+    ts = getattr(msg, 'timestamp', None)
+    if ts is not None and ts > 0:
+        return time.time() - ts / 1000
+    try:
+        return time.time() - timestamp_epoch(msg.value['TIMESTAMP'])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def delivered(msg, channel: str):
+    """Record the end-to-end delay of the delivered message."""
+    delay = delivery_delay(msg)
+    if delay is not None:
+        DELIVERY_DELAY.labels(channel).observe(max(delay, 0))
+
+
+def taken_up(msg):
+    """Record how long the message waited since it was consumed."""
+    consumed_at = getattr(msg, 'consumed_at', None)
+    if consumed_at is not None:
+        QUEUE_WAIT.observe(max(time.time() - consumed_at, 0))
+
+
+@functools.lru_cache(maxsize=1024)
 def timestamp_convert(ts):
     return datetime.strptime(ts, '%Y-%m-%dT%H:%M:%SZ'). \
         strftime('%Y-%m-%d %H:%M:%S UTC')
@@ -64,53 +323,1891 @@ def prometheus_exporter_port():
     return int(os.environ.get('PROMETHEUS_EXPORTER_PORT', DEFAULT_PROMETHEUS_EXPORTER_PORT))
 
 
-def main(worker_fn, kafka_topic: str, group_id: str, *, initargs: tuple = (),
-         num_workers: int = 5, queue_maxsize: int = 100,
-         consumer_poll_timeout: float = 0.05):
+class LRUCache:
+    """
+    Thread-safe mapping bounded to `maxsize` entries, evicting the least
+    recently used.
     """
-    Launch a pool of worker processes consuming Kafka messages.
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+            except KeyError:
+                return default
+            return self._data[key]
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+
+def fingerprint(value: dict):
+    """
+    Identity of a notification for deduplication, or None when it has no
+    subscription or timestamp.
+    """
+    if not isinstance(value, dict) or not value.get('SUBS_ID') or not value.get('TIMESTAMP'):
+        return None
+    fields = '\0'.join(str(value.get(f)) for f in DEDUP_FIELDS)
+    return hashlib.blake2b(fields.encode(), digest_size=16).digest()
+
+
+class Deduplicator:
+    """
+    Drops notifications consumed again within `ttl` seconds of the first
+    time, e.g. re-delivered upstream or replayed after a rebalance.
+    Remembers at most `capacity` notifications, evicting the oldest first.
+    Used by the consuming loop, before messages are dispatched to workers.
+    """
+
+    def __init__(self, ttl: float = DEDUP_TTL, capacity: int = DEDUP_CAPACITY):
+        self.ttl = ttl
+        self.capacity = capacity
+        # fingerprint -> (expiry time, topic, partition, offset), oldest first
+        self._seen = OrderedDict()
+
+    def __len__(self):
+        return len(self._seen)
+
+    def _expire(self, now: float):
+        while self._seen:
+            key, (expires_at, *_) = next(iter(self._seen.items()))
+            if expires_at > now:
+                return
+            del self._seen[key]
+
+    def duplicate(self, msg) -> bool:
+        """Whether the message was seen within the TTL; remembers it otherwise."""
+        try:
+            key = fingerprint(msg.value)
+        except ValueError:
+            return False
+        if key is None:
+            return False
+        now = time.monotonic()
+        self._expire(now)
+        if key in self._seen:
+            DEDUP_LOOKUPS.labels('hit').inc()
+            return True
+        DEDUP_LOOKUPS.labels('miss').inc()
+        self._seen[key] = (now + self.ttl, msg.topic, msg.partition, msg.offset)
+        if len(self._seen) > self.capacity:
+            self._seen.popitem(last=False)
+        DEDUP_CACHE_SIZE.set(len(self._seen))
+        return False
+
+    def forget(self, redelivered: dict):
+        """
+        Forget the notifications of revoked partitions from the offset they
+        will be consumed again on, {TopicPartition: offset}: they were not
+        delivered.
+        """
+        if not redelivered:
+            return
+        for key, (_, topic, partition, offset) in list(self._seen.items()):
+            start = redelivered.get(TopicPartition(topic, partition))
+            if start is not None and offset >= start:
+                del self._seen[key]
+        DEDUP_CACHE_SIZE.set(len(self._seen))
+
+
+def with_value(msg, value: dict):
+    """Copy of the message, a Record or a ConsumerRecord, with another value."""
+    if isinstance(msg, Record):
+        return Record(msg.topic, msg.partition, msg.offset, msg.key,
+                      json.dumps(value).encode(), msg.timestamp, msg.consumed_at)
+    return msg._replace(value=value)
+
+
+class _Flap:
+    __slots__ = ('msg', 'recovery', 'flaps', 'release_at')
+
+    def __init__(self, msg, release_at: float):
+        self.msg = msg
+        self.recovery = False
+        self.flaps = 0
+        self.release_at = release_at
+
+
+class FlapSuppressor:
+    """
+    Holds alerts back for `window` seconds per subscription and resource.
+    A recovery arriving in the meantime cancels the alert: both are dropped
+    (`summary` false) or, with `summary`, the last notification of the
+    resource is released at the end of the window with FLAPPING set to the
+    number of alert/recovery pairs.
+
+    Used by the consuming loop: `add()` and `expired()` return the messages
+    to dispatch, and messages dropped are passed to `on_drop`. At most
+    `capacity` resources are held, releasing the oldest early.
+    """
+
+    def __init__(self, window: float, capacity: int = FLAP_CAPACITY, summary: bool = False,
+                 on_drop=None):
+        self.window = window
+        self.capacity = capacity
+        self.summary = summary
+        self.on_drop = on_drop or (lambda msg: None)
+        # (subscription, resource) -> held notification, in release order
+        self._held = OrderedDict()
+        self._held_per_topic = {}
+
+    def __len__(self):
+        return len(self._held)
+
+    def held(self, topic: str = None) -> int:
+        """Number of messages held back, of `topic` only if given."""
+        if topic is None:
+            return len(self._held)
+        return self._held_per_topic.get(topic, 0)
+
+    def _count(self, msg, n: int):
+        self._held_per_topic[msg.topic] = self._held_per_topic.get(msg.topic, 0) + n
+
+    def _drop(self, msg):
+        self.on_drop(msg)
+
+    def _release(self, flap: _Flap):
+        if flap.flaps:
+            value = dict(flap.msg.value)
+            value['FLAPPING'] = flap.flaps
+            return with_value(flap.msg, value)
+        return flap.msg
+
+    def add(self, msg, now: float = None) -> list:
+        try:
+            value = msg.value
+        except ValueError:
+            return [msg]
+        if not isinstance(value, dict) or not value.get('SUBS_ID'):
+            return [msg]
+        key = (value['SUBS_ID'], value.get('RESOURCE_URI'))
+        recovery = bool(value.get('RECOVERY'))
+        if isinstance(msg, Record):
+            # Held raw: the workers decode the value again anyway.
+            msg._value = None
+        flap = self._held.get(key)
+        if flap is None:
+            if recovery:
+                return [msg]
+            now = time.monotonic() if now is None else now
+            self._held[key] = _Flap(msg, now + self.window)
+            self._count(msg, 1)
+            released = []
+            while len(self._held) > self.capacity:
+                flap = self._held.popitem(last=False)[1]
+                self._count(flap.msg, -1)
+                released.append(self._release(flap))
+            FLAP_HELD.set(len(self._held))
+            return released
+        # The alert, or the last alert or recovery, is superseded.
+        self._drop(flap.msg)
+        if recovery and not flap.recovery:
+            NOTIFICATIONS_FLAPPING.inc()
+            flap.flaps += 1
+            if not self.summary:
+                self._drop(msg)
+                del self._held[key]
+                self._count(flap.msg, -1)
+                FLAP_HELD.set(len(self._held))
+                return []
+        self._count(flap.msg, -1)
+        self._count(msg, 1)
+        flap.msg = msg
+        flap.recovery = recovery
+        return []
+
+    def expired(self, now: float = None) -> list:
+        """Messages held back for the whole window."""
+        if not self._held:
+            return []
+        now = time.monotonic() if now is None else now
+        released = []
+        while self._held:
+            flap = next(iter(self._held.values()))
+            if flap.release_at > now:
+                break
+            self._held.popitem(last=False)
+            self._count(flap.msg, -1)
+            released.append(self._release(flap))
+        if released:
+            FLAP_HELD.set(len(self._held))
+        return released
+
+    def clear(self):
+        """Forget held messages, e.g. of revoked partitions, to be consumed again."""
+        self._held.clear()
+        self._held_per_topic.clear()
+        FLAP_HELD.set(0)
+
+
+def _flap_suppressor(committer):
+    if FLAP_WINDOW <= 0:
+        return None
+    return FlapSuppressor(FLAP_WINDOW, FLAP_CAPACITY, FLAP_MODE == 'summary',
+                          on_drop=lambda msg: _acked(committer, msg))
+
+
+def _acked(committer, msg):
+    """Record the consuming loop is done with a message it does not dispatch."""
+    if committer:
+        committer.tracker.acked(TopicPartition(msg.topic, msg.partition), msg.offset)
+
+
+def _deduplicator():
+    return Deduplicator(DEDUP_TTL, DEDUP_CAPACITY) if DEDUP_TTL > 0 else None
+
+
+class Coalescer:
+    """
+    Buffers items per key and releases a group when it either reached
+    `max_items` or its oldest item is older than `window` seconds.
+    """
+
+    def __init__(self, window: float, max_items: int):
+        self.window = window
+        self.max_items = max_items
+        self._groups = OrderedDict()  # key -> (first_added_at, [items])
+
+    def __len__(self):
+        return sum(len(items) for _, items in self._groups.values())
+
+    def add(self, key, item, now=None) -> list:
+        """Add item to the group of key. Returns the group if it is full."""
+        if now is None:
+            now = time.monotonic()
+        if key not in self._groups:
+            self._groups[key] = (now, [])
+        items = self._groups[key][1]
+        items.append(item)
+        if len(items) >= self.max_items:
+            del self._groups[key]
+            return items
+        return []
+
+    def expired(self, now=None) -> list:
+        """Remove and return (key, items) of all groups older than the window."""
+        if now is None:
+            now = time.monotonic()
+        groups = []
+        # Groups are kept in creation order, so the oldest are first.
+        while self._groups:
+            key, (added_at, items) = next(iter(self._groups.items()))
+            if now - added_at < self.window:
+                break
+            del self._groups[key]
+            groups.append((key, items))
+        return groups
+
+    def drain(self) -> list:
+        groups = [(k, items) for k, (_, items) in self._groups.items()]
+        self._groups.clear()
+        return groups
+
+    def timeout(self, now=None):
+        """Seconds until the oldest group expires, or None when empty."""
+        if not self._groups:
+            return None
+        if now is None:
+            now = time.monotonic()
+        added_at = next(iter(self._groups.values()))[0]
+        return max(self.window - (now - added_at), 0)
+
+
+class Throttled(Exception):
+    """
+    The destination rejected the send; retry after `retry_after` seconds.
+    Not `rejected` when held back by the local rate limiter before sending.
+    """
+
+    def __init__(self, retry_after: float, msg: str = None, rejected: bool = True):
+        super().__init__(msg or f'Throttled, retry after {retry_after}s.')
+        self.retry_after = retry_after
+        self.rejected = rejected
+
+
+class PermanentError(Exception):
+    """The destination rejected the send for good; retrying it is pointless."""
+
+
+class CircuitOpen(Exception):
+    """Sends to the destination fail fast for another `retry_after` seconds."""
+
+    def __init__(self, dest, retry_after: float):
+        super().__init__(f'Circuit open for {dest}, retry after {retry_after:.1f}s.')
+        self.retry_after = retry_after
+
+
+class DelayQueue:
+    """Thread-safe queue of items that become ready after a delay."""
+
+    def __init__(self):
+        self._heap = []
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def push(self, item, delay: float):
+        with self._lock:
+            heapq.heappush(self._heap, (time.monotonic() + delay, next(self._seq), item))
+
+    def pop_ready(self):
+        """Remove and return the earliest ready item, or None."""
+        with self._lock:
+            if self._heap and self._heap[0][0] <= time.monotonic():
+                return heapq.heappop(self._heap)[2]
+        return None
+
+    def timeout(self):
+        """Seconds until the earliest item is ready, or None when empty."""
+        with self._lock:
+            if not self._heap:
+                return None
+            return max(self._heap[0][0] - time.monotonic(), 0)
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker per destination. After `threshold` consecutive failures
+    the circuit opens: sends to the destination fail fast for `reset_timeout`
+    seconds. Then a single trial send is let through; its success closes the
+    circuit, its failure opens it again.
+    """
+
+    def __init__(self, channel: str, threshold: int = CIRCUIT_FAILURE_THRESHOLD,
+                 reset_timeout: float = CIRCUIT_RESET_TIMEOUT, max_destinations: int = 10000):
+        self.channel = channel
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.max_destinations = max_destinations
+        self._failures = OrderedDict()  # dest -> consecutive failures
+        self._open_until = {}  # dest -> monotonic time
+        self._lock = threading.Lock()
+
+    def open_for(self, dest) -> float:
+        """Seconds the circuit of the destination stays open, 0 when closed."""
+        with self._lock:
+            return max(self._open_until.get(dest, 0) - time.monotonic(), 0)
+
+    def check(self, dest):
+        """Raise CircuitOpen unless a send to the destination is allowed."""
+        with self._lock:
+            open_until = self._open_until.get(dest)
+            if open_until is None:
+                return
+            now = time.monotonic()
+            if now < open_until:
+                raise CircuitOpen(dest, open_until - now)
+            # Let this send through as a trial, and fail the others fast.
+            self._open_until[dest] = now + self.reset_timeout
+
+    def success(self, dest):
+        with self._lock:
+            self._failures.pop(dest, None)
+            if self._open_until.pop(dest, None) is not None:
+                log.info(f'{self.channel} circuit to {dest} closed.')
+
+    def failure(self, dest):
+        if self.threshold <= 0:
+            return
+        with self._lock:
+            failures = self._failures.pop(dest, 0) + 1
+            self._failures[dest] = failures
+            while len(self._failures) > self.max_destinations:
+                self._open_until.pop(self._failures.popitem(last=False)[0], None)
+            if failures >= self.threshold:
+                if dest not in self._open_until:
+                    CIRCUIT_BREAKER_OPENED.labels(self.channel).inc()
+                    log.warning(f'{self.channel} circuit to {dest} opened after '
+                                f'{failures} failures.')
+                self._open_until[dest] = time.monotonic() + self.reset_timeout
+
+
+class DeadLetterQueue:
+    """
+    Publishes undeliverable messages to the dead-letter topic. The record
+    value is the original value, the failure is described in the headers:
+    original topic, partition, offset, channel, error and number of attempts.
+    """
+
+    def __init__(self, topic: str, bootstrap_servers=None, linger_ms: int = KAFKA_DLQ_LINGER_MS):
+        self.topic = topic
+        self.producer = KafkaProducer(bootstrap_servers=bootstrap_servers or KAFKA_BOOTSTRAP_SERVERS,
+                                      linger_ms=linger_ms, acks='all', retries=5)
+        log.info(f'Dead-letter producer to {topic} created.')
+
+    @staticmethod
+    def headers(msg, channel: str, error: Exception, attempts: int) -> list:
+        headers = {
+            'dlq-topic': msg.topic,
+            'dlq-partition': msg.partition,
+            'dlq-offset': msg.offset,
+            'dlq-channel': channel,
+            'dlq-error-type': type(error).__name__,
+            'dlq-error': str(error),
+            'dlq-attempts': attempts,
+            'dlq-failed-at': now_timestamp()}
+        return [(k, str(v).encode()) for k, v in headers.items()]
+
+    def publish(self, msg, channel: str, error: Exception, attempts: int):
+        raw_value = getattr(msg, 'raw_value', None)
+        if raw_value is None:
+            raw_value = json.dumps(msg.value).encode()
+        key = msg.key.encode() if msg.key else None
+        self.producer.send(self.topic, value=raw_value, key=key,
+                           headers=self.headers(msg, channel, error, attempts)) \
+            .add_errback(lambda ex: log.error(f'Failed dead-lettering {msg}: {ex}'))
+
+    def flush(self, timeout: float = None):
+        self.producer.flush(timeout)
+
+
+_dlq = None
+_dlq_lock = threading.Lock()
+
+
+def dead_letter_queue():
+    """Dead-letter queue of the process, or None when disabled."""
+    global _dlq
+    if not KAFKA_DLQ_TOPIC:
+        return None
+    with _dlq_lock:
+        # Created lazily: a producer must not be shared across fork().
+        if _dlq is None:
+            _dlq = DeadLetterQueue(KAFKA_DLQ_TOPIC)
+            # Unlike atexit handlers, also run on exit of the worker processes.
+            multiprocessing.util.Finalize(None, _dlq.flush, args=(10,), exitpriority=10)
+        return _dlq
+
+
+def malformed(msg, channel: str, required: tuple = ()) -> bool:
+    """
+    Whether the value of the message cannot be decoded, or lacks one of the
+    `required` fields. The message is then dead-lettered with its raw value,
+    and the caller is done with it.
+    """
+    try:
+        value = msg.value
+    except ValueError as ex:
+        log.error(f'Failed decoding {msg}: {ex}')
+        dead_letter(msg, channel, ex)
+        return True
+    missing = [f for f in required if not isinstance(value, dict) or not value.get(f)]
+    if missing:
+        ex = ValueError(f'Missing {", ".join(missing)}')
+        log.error(f'Failed processing {msg}: {ex}')
+        dead_letter(msg, channel, ex)
+        return True
+    return False
+
+
+def dead_letter(msg, channel: str, error: Exception, attempts: int = 0):
+    """Publish the undeliverable message to the dead-letter topic, if any."""
+    dlq = dead_letter_queue()
+    if dlq is None or msg is None:
+        return
+    try:
+        dlq.publish(msg, channel, error, attempts)
+        NOTIFICATIONS_DEAD_LETTERED.labels(channel, error_label(error)).inc()
+    except Exception as ex:
+        log.error(f'Failed dead-lettering {msg}: {ex}')
+
+
+class Retrier:
+    """
+    Retry policy of a channel. Sends go through a circuit breaker per
+    destination, and failed messages are to be retried after an exponential
+    backoff with full jitter, up to `attempts` attempts in all. The caller
+    schedules the retry, e.g. with `DelayedWork.defer()`, and moves on.
+    Messages out of attempts are dead-lettered.
+    """
+
+    def __init__(self, channel: str, attempts: int = RETRY_ATTEMPTS,
+                 backoff: float = RETRY_BACKOFF, backoff_max: float = RETRY_BACKOFF_MAX,
+                 breaker: CircuitBreaker = None,
+                 throttled_attempts: int = RETRY_THROTTLED_ATTEMPTS):
+        self.channel = channel
+        self.attempts = attempts
+        self.throttled_attempts = throttled_attempts
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.breaker = breaker or CircuitBreaker(channel)
+        self._failed = {}  # (topic, partition, offset) -> failed attempts
+        self._throttled = {}  # (topic, partition, offset) -> attempts rejected as throttled
+        self._lock = threading.Lock()
+
+    def call(self, dest, fn, *args):
+        """Call fn(*args) to send to dest through the circuit breaker."""
+        self.breaker.check(dest)
+        try:
+            result = fn(*args)
+        except (Throttled, PermanentError):
+            raise
+        except Exception:
+            self.breaker.failure(dest)
+            raise
+        self.breaker.success(dest)
+        return result
+
+    @staticmethod
+    def _key(msg):
+        # A ConsumerRecord of the decoded mode holds a dict value: not hashable.
+        return msg.topic, msg.partition, msg.offset
+
+    def done(self, msg):
+        key = self._key(msg)
+        with self._lock:
+            self._failed.pop(key, None)
+            self._throttled.pop(key, None)
+
+    def delay(self, msg, error: Exception):
+        """
+        Seconds after which to retry the message that failed with error, or
+        None when it is out of attempts.
+        """
+        key = self._key(msg)
+        if isinstance(error, Throttled):
+            if not error.rejected:
+                return error.retry_after
+            with self._lock:
+                throttled = self._throttled.get(key, 0) + 1
+                retry = throttled < self.throttled_attempts
+                if retry:
+                    self._throttled[key] = throttled
+            if not retry:
+                self.give_up(msg, error)
+                return None
+            return error.retry_after
+        with self._lock:
+            attempt = self._failed.get(key, 0) + 1
+            retry = attempt < self.attempts and not isinstance(error, PermanentError)
+            if retry:
+                self._failed[key] = attempt
+        if not retry:
+            self.give_up(msg, error)
+            return None
+        delay = random.uniform(0, min(self.backoff_max, self.backoff * 2 ** (attempt - 1)))
+        if isinstance(error, CircuitOpen):
+            delay = max(delay, error.retry_after)
+        NOTIFICATIONS_RETRIES.labels(self.channel).inc()
+        return delay
+
+    def give_up(self, msg, error: Exception):
+        """Done with the message that failed with error: dead-letter it."""
+        key = self._key(msg)
+        with self._lock:
+            attempts = self._failed.pop(key, 0) + self._throttled.pop(key, 0) + 1
+        dead_letter(msg, self.channel, error, attempts)
+
+    def run(self, msg, dest, fn, *args) -> float:
+        """
+        Call fn(*args) to send msg to dest. Returns 0 once sent, or the delay
+        after which to retry. Raises the error when out of attempts.
+        """
+        try:
+            self.call(dest, fn, *args)
+        except Exception as ex:
+            delay = self.delay(msg, ex)
+            if delay is None:
+                raise
+            log.warning(f'{self.channel} send of {msg} to {dest} failed, '
+                        f'retry in {delay:.1f}s: {ex}')
+            return delay
+        self.done(msg)
+        return 0
+
+
+class OffsetTracker:
+    """
+    Tracks offsets handed over to workers and the ones acknowledged back,
+    per partition. Only the offset following the highest contiguous
+    acknowledged offset of a partition is safe to commit.
+    """
+
+    def __init__(self):
+        self._pending = {}  # TopicPartition -> deque of dispatched offsets
+        self._acked = {}  # TopicPartition -> set of acked offsets
+        self._next = {}  # TopicPartition -> next offset to commit
+        self._committed = {}  # TopicPartition -> last committed offset
+
+    def dispatched(self, tp: TopicPartition, offset: int):
+        self._pending.setdefault(tp, deque()).append(offset)
+        self._acked.setdefault(tp, set())
+
+    def acked(self, tp: TopicPartition, offset: int):
+        pending = self._pending.get(tp)
+        if not pending or offset < pending[0]:
+            return
+        acked = self._acked[tp]
+        acked.add(offset)
+        while pending and pending[0] in acked:
+            acked.discard(pending[0])
+            self._next[tp] = pending.popleft() + 1
+
+    def unacked(self, tp: TopicPartition):
+        """First dispatched offset of the partition not acknowledged yet, or None."""
+        pending = self._pending.get(tp)
+        return pending[0] if pending else None
+
+    def revoke(self, partitions):
+        """Forget dispatched offsets of partitions no longer assigned."""
+        for tp in partitions:
+            for d in (self._pending, self._acked, self._next, self._committed):
+                d.pop(tp, None)
+
+    def in_flight(self, topic: str = None) -> int:
+        return sum(len(p) for tp, p in self._pending.items() if topic is None or tp.topic == topic)
+
+    def committable(self) -> dict:
+        """Offsets advanced since the last call, ready to be committed."""
+        offsets = {tp: OffsetAndMetadata(offset, None)
+                   for tp, offset in self._next.items()
+                   if self._committed.get(tp) != offset}
+        for tp, om in offsets.items():
+            self._committed[tp] = om.offset
+        return offsets
+
+
+class Backpressure:
+    """
+    Pauses fetching from all assigned partitions, or those of `topic` only,
+    when the in-flight work reaches the high watermark, and resumes it once
+    at or below the low watermark. The consumer must keep polling while
+    paused to stay in the consumer group.
+    """
+
+    _paused_count = 0  # instances paused, for the gauge
+
+    def __init__(self, high: int, low: int = None, topic: str = None):
+        self.high = max(high, 1)
+        self.low = min(self.high // 2 if low is None else low, self.high - 1)
+        self.topic = topic
+        self._paused_since = None
+
+    @property
+    def paused(self) -> bool:
+        return self._paused_since is not None
+
+    def _partitions(self, partitions) -> list:
+        return [tp for tp in partitions if self.topic is None or tp.topic == self.topic]
+
+    def update(self, consumer, in_flight: int) -> bool:
+        """Pause or resume fetching given the in-flight work. Returns whether paused."""
+        now = time.monotonic()
+        if self._paused_since is None:
+            if in_flight >= self.high:
+                consumer.pause(*self._partitions(consumer.assignment()))
+                self._paused_since = now
+                Backpressure._paused_count += 1
+                CONSUMER_PAUSES.inc()
+                CONSUMER_PAUSED.set(1)
+                log.debug('Paused fetching: %s messages in flight.', in_flight)
+            return self.paused
+        CONSUMER_PAUSED_SECONDS.inc(now - self._paused_since)
+        if in_flight <= self.low:
+            consumer.resume(*self._partitions(consumer.paused()))
+            self._paused_since = None
+            Backpressure._paused_count -= 1
+            CONSUMER_PAUSED.set(1 if Backpressure._paused_count > 0 else 0)
+            log.debug('Resumed fetching: %s messages in flight.', in_flight)
+        else:
+            self._paused_since = now
+            # Partitions assigned by a rebalance while paused start unpaused.
+            consumer.pause(*self._partitions(consumer.assignment()))
+        return self.paused
+
+
+def _backpressure(default_high: int, topic: str = None) -> Backpressure:
+    return Backpressure(KAFKA_PAUSE_HIGH_WATERMARK or default_high,
+                        KAFKA_PAUSE_LOW_WATERMARK or None, topic)
+
+
+def consumer_lag(consumer, topic: str = None) -> int:
+    """
+    Number of messages of the assigned partitions, or those of `topic` only,
+    not consumed yet, as of the last fetch.
+    """
+    lag = 0
+    for tp in consumer.assignment():
+        if topic is not None and tp.topic != topic:
+            continue
+        highwater = consumer.highwater(tp)
+        if highwater is not None:
+            lag += max(highwater - consumer.position(tp), 0)
+    return lag
+
+
+class Autoscaler:
+    """
+    Decides the number of worker processes of a channel, between
+    `min_workers` and `max_workers`, from the share of busy workers and the
+    number of messages waiting for them, averaged over `interval` seconds,
+    and from the consumer lag.
+
+    The number of workers is doubled when the workers are busy with messages
+    waiting for them, or when the lag reaches `up_lag` messages per worker.
+    It is decreased by one when the workers are mostly idle with no messages
+    waiting, and the lag is below half of the scale up threshold. No change
+    is made for `up_cooldown` seconds after a scale up, and `down_cooldown`
+    seconds after a scale down.
+    """
+
+    def __init__(self, name: str, min_workers: int, max_workers: int, *,
+                 interval: float = AUTOSCALE_INTERVAL,
+                 up_utilization: float = AUTOSCALE_UP_UTILIZATION,
+                 down_utilization: float = AUTOSCALE_DOWN_UTILIZATION,
+                 up_lag: int = AUTOSCALE_UP_LAG,
+                 up_cooldown: float = AUTOSCALE_UP_COOLDOWN,
+                 down_cooldown: float = AUTOSCALE_DOWN_COOLDOWN):
+        self.name = name
+        self.min_workers = max(min_workers, 1)
+        self.max_workers = max(max_workers, self.min_workers)
+        self.interval = interval
+        self.up_utilization = up_utilization
+        self.down_utilization = down_utilization
+        self.up_lag = up_lag
+        self.up_cooldown = up_cooldown
+        self.down_cooldown = down_cooldown
+        self._cooldown_until = 0
+        self._next_decision = time.monotonic() + interval
+        self._utilization = 0.0
+        self._samples = 0
+        self._backlog = 0
+
+    def observe(self, utilization: float, backlog: int):
+        """Sample the share of busy workers and the messages waiting for them."""
+        self._utilization += utilization
+        self._samples += 1
+        self._backlog = max(self._backlog, backlog)
+
+    def due(self, now: float = None) -> bool:
+        return (time.monotonic() if now is None else now) >= self._next_decision
+
+    def decide(self, workers: int, lag: int, now: float = None) -> int:
+        """Number of workers for the next interval, given the current one."""
+        now = time.monotonic() if now is None else now
+        utilization = self._utilization / self._samples if self._samples else 0.0
+        backlog = self._backlog
+        self._utilization, self._samples, self._backlog = 0.0, 0, 0
+        self._next_decision = now + self.interval
+        WORKER_UTILIZATION.labels(self.name).set(utilization)
+        CONSUMER_LAG.labels(self.name).set(lag)
+
+        lagging = self.up_lag > 0 and lag >= self.up_lag * workers
+        if utilization >= self.up_utilization and backlog > 0:
+            direction, reason, target = 'up', 'utilization', workers * 2
+        elif lagging:
+            direction, reason, target = 'up', 'lag', workers * 2
+        elif (utilization <= self.down_utilization and backlog == 0
+              and not (self.up_lag > 0 and lag >= self.up_lag * workers / 2)):
+            direction, reason, target = 'down', 'idle', workers - 1
+        else:
+            return workers
+        target = min(max(target, self.min_workers), self.max_workers)
+        if target == workers or now < self._cooldown_until:
+            return workers
+        self._cooldown_until = now + (self.up_cooldown if direction == 'up' else self.down_cooldown)
+        AUTOSCALE_DECISIONS.labels(self.name, direction, reason).inc()
+        log.info('Scaling %s %s from %s to %s workers: utilization %.2f, %s waiting, lag %s.',
+                 self.name, direction, workers, target, utilization, backlog, lag)
+        return target
+
+
+_ack_queue = None
+_generation = None
+_queued = None
+_idle = None  # number of workers of the channel waiting for work
+_retire = None  # number of workers of the channel asked to exit
+_retiring = False
+_outstanding = 0  # messages taken by the worker and not acknowledged yet
+_outstanding_lock = threading.Lock()
+_chunk = deque()
+_started_at = None
+_ready = False
+
+# Seconds between checks of an idle worker whether it is asked to exit, and
+# of a retiring worker whether it is done with its messages.
+RETIRE_CHECK_INTERVAL = 1
+RETIRE_POLL_INTERVAL = 0.1
+
+
+def ack(msg):
+    """
+    Acknowledge that a worker is done with the message. Required in the manual
+    commit mode for the message offset to be committed, and for a worker
+    scaled down to exit.
+    """
+    global _outstanding
+    if not msg:
+        return
+    with _outstanding_lock:
+        _outstanding -= 1
+    if _ack_queue is not None:
+        _ack_queue.put((msg.topic, msg.partition, msg.offset))
+
+
+def get_work(workq: multiprocessing.Queue, timeout: float = None):
+    """
+    Get the next message from the work queue, or None on timeout. Messages
+    are taken off the queue in batches and returned one by one. Messages
+    dispatched before the last partition rebalance are skipped: they will be
+    consumed again from the last committed offsets.
+    """
+    global _outstanding
+    if not _ready:
+        worker_ready()
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while not _chunk:
+        if _retiring or _claim_retirement():
+            return _retired(timeout)
+        wait = timeout
+        if _retire is not None:
+            # Wake up to check whether the worker is asked to exit.
+            wait = RETIRE_CHECK_INTERVAL if deadline is None else \
+                min(max(deadline - time.monotonic(), 0), RETIRE_CHECK_INTERVAL)
+        if _idle is not None:
+            with _idle.get_lock():
+                _idle.value += 1
+        try:
+            generation, msgs = workq.get(timeout=wait)
+        except queue.Empty:
+            if deadline is None or time.monotonic() < deadline:
+                continue
+            return None
+        finally:
+            if _idle is not None:
+                with _idle.get_lock():
+                    _idle.value -= 1
+        if _generation is None or generation == _generation.value:
+            _chunk.extend(msgs)
+        else:
+            log.debug('Skipping %s messages dispatched before rebalance.', len(msgs))
+            _taken(len(msgs))
+    msg = _chunk.popleft()
+    _taken(1)
+    with _outstanding_lock:
+        _outstanding += 1
+    taken_up(msg)
+    return msg
+
+
+def _taken(n: int):
+    # Messages of a batch count as queued until taken up one by one.
+    if _queued is not None:
+        with _queued.get_lock():
+            _queued.value -= n
+
+
+def _claim_retirement() -> bool:
+    """Whether the worker takes one of the requests for workers to exit."""
+    global _retiring
+    if _retire is None or _retire.value <= 0:
+        return False
+    with _retire.get_lock():
+        if _retire.value <= 0:
+            return False
+        _retire.value -= 1
+    _retiring = True
+    log.info('Worker scaled down, exiting once done with %s messages.', _outstanding)
+    return True
+
+
+def retiring() -> bool:
+    """
+    Whether the worker is scaled down or shut down: it takes no more work,
+    and should send what it buffers, e.g. digests.
+    """
+    return _retiring
+
+
+def _retired(timeout: float = None):
+    """
+    No more work for a retiring worker: it exits once it acknowledged all its
+    messages, e.g. those deferred for a retry or buffered in a digest.
+    """
+    if _outstanding <= 0:
+        log.info('Worker exiting.')
+        sys.exit(0)
+    time.sleep(RETIRE_POLL_INTERVAL if timeout is None else min(timeout, RETIRE_POLL_INTERVAL))
+    return None
+
+
+class DelayedWork:
+    """
+    Work queue reader of a worker process that can hold messages back, e.g.
+    for a retry, and returns them once due before taking new messages off
+    the work queue. When `max_deferred` messages are held back, no more are
+    taken off the work queue.
+    """
+
+    def __init__(self, workq, max_deferred: int = MAX_DEFERRED):
+        self.workq = workq
+        self.max_deferred = max_deferred
+        self.deferred = DelayQueue()
+
+    def defer(self, msg, delay: float):
+        self.deferred.push(msg, delay)
+
+    def admit(self, msg) -> bool:
+        """Whether msg can be processed now. Otherwise it must be deferred."""
+        return True
+
+    def get(self, timeout: float = None):
+        """Next message to process, or None after timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            msg = self.deferred.pop_ready()
+            if msg is None:
+                wait = self.deferred.timeout()
+                if deadline is not None:
+                    remaining = max(deadline - time.monotonic(), 0)
+                    wait = remaining if wait is None else min(wait, remaining)
+                if len(self.deferred) >= self.max_deferred:
+                    time.sleep(wait)
+                else:
+                    msg = get_work(self.workq, timeout=wait)
+            if msg is not None and self.admit(msg):
+                return msg
+            if msg is None and deadline is not None and time.monotonic() >= deadline:
+                return None
+
+
+def worker_ready():
+    """
+    Report the worker process as ready to take work. Done on the first
+    `get_work()`, once the worker has set up its clients.
+    """
+    global _ready
+    _ready = True
+    WORKERS_READY.inc()
+    if _started_at is not None:
+        seconds = time.monotonic() - _started_at
+        STARTUP_SECONDS.labels('worker').set(seconds)
+        log.info('Worker ready in %.3fs.', seconds)
+
+
+def _init_worker(worker_fn, ack_queue, generation, queued, idle, retire, *args):
+    global _ack_queue, _generation, _queued, _idle, _retire, _started_at
+    _started_at = time.monotonic()
+    # The main process shuts the workers down, e.g. on Ctrl-C, and terminates
+    # those still running at the deadline.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    _ack_queue = ack_queue
+    _generation = generation
+    _queued = queued
+    _idle = idle
+    _retire = retire
+    worker_fn(*args)
+
+
+class _ChunkDispatcher:
+    """
+    Hands over polled messages to the work queue in batches of up to
+    `batch_size`, without blocking. Batches are made smaller when there are
+    not enough messages to keep all the workers busy, and a partial batch is
+    held back for at most `linger` seconds to be filled.
+    """
+
+    def __init__(self, work_queue, queued, num_workers: int,
+                 batch_size: int = KAFKA_BATCH_SIZE, linger: float = KAFKA_BATCH_LINGER):
+        self.work_queue = work_queue
+        self.queued = queued
+        self.num_workers = num_workers
+        self.batch_size = max(batch_size, 1)
+        self.linger = linger
+        self.pending = deque()  # polled messages not batched yet
+        self.ready = deque()  # batches waiting for room in the work queue
+        self._pending_since = None
+        self._ready_count = 0
+
+    def __len__(self):
+        return len(self.pending) + self._ready_count
+
+    def add(self, msg):
+        if not self.pending:
+            self._pending_since = time.monotonic()
+        self.pending.append(msg)
+
+    def clear(self):
+        self.pending.clear()
+        self.ready.clear()
+        self._ready_count = 0
+
+    def _batch(self, generation: int):
+        size = min(self.batch_size, -(-len(self.pending) // self.num_workers))
+        while self.pending:
+            if len(self.pending) < self.batch_size and \
+                    time.monotonic() - self._pending_since < self.linger:
+                break
+            batch = [self.pending.popleft() for _ in range(min(size, len(self.pending)))]
+            self.ready.append((generation, batch))
+            self._ready_count += len(batch)
+            self._pending_since = time.monotonic()
+
+    def dispatch(self, generation: int = 0):
+        self._batch(generation)
+        while self.ready:
+            item = self.ready[0]
+            # Counted before the put, for a worker may take it up right away.
+            with self.queued.get_lock():
+                self.queued.value += len(item[1])
+            try:
+                self.work_queue.put_nowait(item)
+            except queue.Full:
+                with self.queued.get_lock():
+                    self.queued.value -= len(item[1])
+                break
+            self.ready.popleft()
+            self._ready_count -= len(item[1])
+
+
+def message_key(msg):
+    """Kafka key of the message, or the values of AFFINITY_FIELDS without one."""
+    if msg.key:
+        return msg.key
+    value = msg.value or {}
+    return tuple(value.get(f) for f in AFFINITY_FIELDS)
+
+
+class _WorkerSlot:
+    """Work queue of a worker process with key affinity."""
+
+    def __init__(self, index: int, maxsize: int):
+        self.index = index
+        self.queue = multiprocessing.Queue(maxsize=maxsize)
+        self.queued = multiprocessing.Value('l', 0)  # messages not taken up by the worker
+        self.idle = multiprocessing.Value('i', 0)
+        self.retire = multiprocessing.Value('i', 0)
+        self.dispatcher = _ChunkDispatcher(self.queue, self.queued, 1)
+        self.dispatched = 0  # messages routed to the worker
+        self.taken = 0  # messages taken up by the worker, as of the last dispatch
+        self.depth = 0  # messages waiting for the worker
+        self.draining = False  # no new keys routed to the worker
+        self.retiring = False  # the worker is asked to exit
+        self.process = None
+
+    def owns(self, seq: int) -> bool:
+        """Whether the message `seq` is waiting for, or being processed by, the worker."""
+        return not self.retiring and self.taken <= seq
+
+
+class _KeyDispatcher:
+    """
+    Hands over polled messages to a work queue per worker by key: the Kafka
+    key of the message, or its SUBS_ID and RESOURCE_URI. Messages of a key go
+    to the same worker as long as one of them waits for or is processed by
+    it, which keeps their order. Otherwise, they go to the worker of the hash
+    of the key, or to the least busy worker when the former has
+    `steal_threshold` more messages waiting, so that idle workers take over
+    the keys of busy ones. Messages routed to a worker stay with it.
+
+    Workers process their messages in order: a key is done with its worker
+    once the worker took up a later message.
+    """
+
+    def __init__(self, name: str, maxsize: int, steal_threshold: int = KEY_STEAL_THRESHOLD):
+        self.name = name
+        self.maxsize = maxsize
+        self.steal_threshold = steal_threshold
+        self.slots = []
+        self.active = []  # slots new keys are routed to
+        self.owners = {}  # key: (slot, sequence number of its last message in the slot)
+        self._sweep_at = 10000
+        self._reported_at = 0
+
+    def __len__(self):
+        return sum(len(s.dispatcher) for s in self.slots)
+
+    def waiting(self) -> int:
+        """Number of messages waiting for the workers, or not dispatched yet."""
+        return sum(s.queued.value + len(s.dispatcher) for s in self.slots)
+
+    def add_slot(self) -> _WorkerSlot:
+        used = {s.index for s in self.slots}
+        slot = _WorkerSlot(next(i for i in itertools.count() if i not in used), self.maxsize)
+        self.slots.append(slot)
+        self._update_active()
+        return slot
+
+    def remove_slot(self, slot: _WorkerSlot):
+        slot.retiring = True
+        self.slots.remove(slot)
+        self._update_active()
+        WORKER_QUEUE_DEPTH.labels(self.name, str(slot.index)).set(0)
+
+    def _update_active(self):
+        self.active = sorted((s for s in self.slots if not s.draining), key=lambda s: s.index)
+
+    def drain(self, slot: _WorkerSlot, draining: bool = True):
+        slot.draining = draining
+        self._update_active()
+
+    def add(self, msg):
+        key = message_key(msg)
+        owner = self.owners.get(key)
+        if owner is not None and owner[0].owns(owner[1]):
+            slot = owner[0]
+        else:
+            slot = self.active[hash(key) % len(self.active)]
+            if slot.depth > self.steal_threshold:
+                least = min(self.active, key=lambda s: s.depth)
+                if slot.depth - least.depth >= self.steal_threshold:
+                    slot = least
+                    KEYS_REBALANCED.labels(self.name).inc()
+        slot.dispatcher.add(msg)
+        slot.dispatched += 1
+        slot.depth += 1
+        self.owners[key] = (slot, slot.dispatched)
+
+    def clear(self):
+        for slot in self.slots:
+            slot.dispatched -= len(slot.dispatcher)
+            slot.dispatcher.clear()
+
+    def dispatch(self, generation: int = 0):
+        for slot in self.slots:
+            slot.dispatcher.dispatch(generation)
+            waiting = slot.queued.value + len(slot.dispatcher)
+            slot.taken = slot.dispatched - waiting
+            slot.depth = waiting
+        if len(self.owners) > self._sweep_at:
+            self.owners = {k: o for k, o in self.owners.items() if o[0].owns(o[1])}
+            self._sweep_at = max(10000, 2 * len(self.owners))
+        now = time.monotonic()
+        if now - self._reported_at >= 1:
+            self._reported_at = now
+            for slot in self.slots:
+                WORKER_QUEUE_DEPTH.labels(self.name, str(slot.index)).set(slot.depth)
+
+
+class _Committer(ConsumerRebalanceListener):
+    """
+    Commits offsets acknowledged by workers in periodic batches, and on
+    partition revocation before in-flight work of the partitions is dropped.
+    """
+
+    def __init__(self, ack_queue, generation, interval: float = KAFKA_COMMIT_INTERVAL):
+        self.consumer = None
+        self.tracker = OffsetTracker()
+        self.ack_queue = ack_queue
+        self.generation = generation
+        self.interval = interval
+        self._last_commit = time.monotonic()
+        self._redelivered = {}  # TopicPartition -> first offset to be consumed again
+
+    def _drain_acks(self):
+        while True:
+            try:
+                topic, partition, offset = self.ack_queue.get_nowait()
+            except queue.Empty:
+                break
+            self.tracker.acked(TopicPartition(topic, partition), offset)
+
+    def commit(self):
+        self._drain_acks()
+        self._last_commit = time.monotonic()
+        offsets = self.tracker.committable()
+        if offsets:
+            self.consumer.commit(offsets)
+            log.debug('Committed offsets: %s', offsets)
+
+    def maybe_commit(self):
+        self._drain_acks()
+        if time.monotonic() - self._last_commit >= self.interval:
+            self.commit()
+
+    def on_partitions_revoked(self, revoked):
+        log.info('Partitions revoked: %s', revoked)
+        try:
+            self.commit()
+        except Exception as e:
+            log.error('Failed committing offsets on revocation: %s', e)
+        for tp in revoked:
+            offset = self.tracker.unacked(tp)
+            if offset is not None:
+                self._redelivered[tp] = offset
+        self.tracker.revoke(revoked)
+        # Workers skip the messages of the previous assignment still queued.
+        with self.generation.get_lock():
+            self.generation.value += 1
+
+    def on_partitions_assigned(self, assigned):
+        log.info('Partitions assigned: %s', assigned)
+
+    def pop_redelivered(self) -> dict:
+        """Offsets from which revoked partitions will be consumed again, since the last call."""
+        redelivered, self._redelivered = self._redelivered, {}
+        return redelivered
+
+
+class Channel:
+    """
+    A notification channel: the Kafka topic it consumes, the worker sending
+    its messages from worker processes, or the async worker with the asyncio
+    engine, and its concurrency budget.
 
     Parameters:
-        worker_fn: Worker function run in each process.
-        kafka_topic: Kafka topic to consume from.
-        group_id: Kafka consumer group ID.
-        initargs: Tuple of arguments passed to each worker process.
-        num_workers: Number of worker processes.
-        queue_maxsize: Max size of shared work queue.
-        consumer_poll_timeout: Timeout for placing item in queue.
+        name: Name of the channel, e.g. 'email'.
+        topic: Kafka topic to consume from.
+        worker: Worker function run in each process.
+        group_id: Kafka consumer group ID when run on its own.
+        async_worker: Coroutine function sending one message.
+        setup: Callable run in the main process at startup, e.g. loading the
+            configuration of the channel, returning a tuple of arguments
+            appended to `initargs`.
+        initargs: Tuple of arguments passed to each worker process, or to
+            the async worker after the message.
+        manual_commit: Commit offsets only once workers acknowledged the
+            messages with `ack()`, instead of relying on auto-commit.
+            Defaults to true in the at-least-once delivery mode.
+        num_workers: Number of worker processes, the minimum when autoscaling.
+        max_workers: Max number of worker processes. The number of workers is
+            scaled between `num_workers` and this by an `Autoscaler` when
+            greater than `num_workers`.
+        max_inflight: Max number of concurrent sends with the asyncio engine.
+        queue_maxsize: Max size of the work queue, in batches of messages,
+            split across the work queues of the workers with key affinity.
     """
 
-    log.info("Starting Kafka worker pool with topic '%s' and group '%s'", kafka_topic, group_id)
+    def __init__(self, name: str, topic: str, worker=None, *, group_id: str = None,
+                 async_worker=None, setup=None, initargs: tuple = (),
+                 manual_commit: bool = AT_LEAST_ONCE, num_workers: int = 5,
+                 max_workers: int = None, max_inflight: int = ASYNC_MAX_INFLIGHT,
+                 queue_maxsize: int = 100):
+        self.name = name
+        self.topic = topic
+        self.worker = worker
+        self.group_id = group_id
+        self.async_worker = async_worker
+        self.setup = setup
+        self.initargs = initargs
+        self.manual_commit = manual_commit
+        self.num_workers = num_workers
+        self.max_workers = max(max_workers or num_workers, num_workers)
+        self.max_inflight = max_inflight
+        self.queue_maxsize = queue_maxsize
+
+    def __repr__(self):
+        return f'Channel({self.name!r}, topic={self.topic!r})'
+
 
-    work_queue = multiprocessing.Queue(maxsize=queue_maxsize)
+CHANNELS = {}
 
-    # Extend initargs to include the work_queue
-    extended_initargs = (work_queue,) + initargs
 
-    # Create worker pool
-    pool = multiprocessing.Pool(
-        processes=num_workers,
-        initializer=worker_fn,
-        initargs=extended_initargs
-    )
+def register_channel(channel: Channel) -> Channel:
+    """Make the channel available to the runner of several channels."""
+    CHANNELS[channel.name] = channel
+    return channel
+
+
+def load_channels(names: list) -> list:
+    """
+    The channels of the given names, imported from the notify-<name>.py
+    scripts next to this module, which register them.
+    """
+    src = os.path.dirname(os.path.realpath(__file__))
+    for name in names:
+        module_name = f'notify_{name}'
+        if name in CHANNELS or module_name in sys.modules:
+            continue
+        path = os.path.join(src, f'notify-{name}.py')
+        if not os.path.isfile(path):
+            raise ValueError(f'Unknown channel: {name}')
+        spec = importlib.util.spec_from_file_location(module_name, path)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[module_name] = module
+        spec.loader.exec_module(module)
+        if name not in CHANNELS:
+            raise ValueError(f'Not a channel: {name}')
+    return [CHANNELS[name] for name in names]
+
+
+@contextlib.contextmanager
+def _shutdown_signals():
+    """
+    Event set on SIGTERM or SIGINT, for the consuming loop to stop and the
+    workers to drain. A second signal interrupts the drain.
+    """
+    stop = threading.Event()
 
+    def handler(signum, frame):
+        if stop.is_set():
+            raise KeyboardInterrupt
+        stop.set()
+
+    previous = {}
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            previous[sig] = signal.signal(sig, handler)
+        except ValueError:
+            # Not in the main thread: signals are left as they are.
+            pass
     try:
-        consumer = kafka_consumer(kafka_topic, KAFKA_BOOTSTRAP_SERVERS, group_id=group_id)
-        for msg in consumer:
-            while True:
+        yield stop
+    finally:
+        for sig, h in previous.items():
+            signal.signal(sig, signal.SIG_DFL if h is None else h)
+
+
+def _report_shutdown(started: float, abandoned: dict):
+    seconds = time.monotonic() - started
+    SHUTDOWN_SECONDS.set(seconds)
+    for name, n in abandoned.items():
+        if n:
+            MESSAGES_ABANDONED.labels(name).inc(n)
+    log.info('Workers drained in %.3fs, %s messages abandoned: %s.',
+             seconds, sum(abandoned.values()), abandoned)
+
+
+def main(worker_fn, kafka_topic: str, group_id: str, *, initargs: tuple = (),
+         num_workers: int = 5, max_workers: int = None, queue_maxsize: int = 100,
+         consumer_poll_timeout: float = 0.05, manual_commit: bool = AT_LEAST_ONCE,
+         async_worker=None, engine: str = WORKER_ENGINE,
+         max_inflight: int = ASYNC_MAX_INFLIGHT, setup=None):
+    """
+    Consume Kafka messages and send them either from a pool of worker
+    processes running `worker_fn`, or, with the asyncio engine, as concurrent
+    `async_worker` coroutines in the current process.
+
+    Workers get messages with `get_work()` and must `ack()` them once done.
+    Async workers are called as `async_worker(msg, *initargs)` and must
+    `ack()` the message once done as well.
+
+    The Kafka consumer is created while `setup` runs, before the workers are
+    started, and joins the consumer group on its first poll while the workers
+    warm up.
+
+    See `Channel` for the parameters. `consumer_poll_timeout` is the poll
+    timeout while polled messages wait for room in the work queue.
+    """
+    channel = Channel(kafka_topic, kafka_topic, worker_fn, group_id=group_id,
+                      async_worker=async_worker, setup=setup, initargs=initargs,
+                      manual_commit=manual_commit, num_workers=num_workers,
+                      max_workers=max_workers, max_inflight=max_inflight,
+                      queue_maxsize=queue_maxsize)
+    run([channel], engine=engine, consumer_poll_timeout=consumer_poll_timeout)
+
+
+def run(channels: list, group_id: str = None, *, engine: str = WORKER_ENGINE,
+        consumer_poll_timeout: float = 0.05):
+    """
+    Run the channels from a single Kafka consumer subscribed to all their
+    topics, routing each record to the channel of its topic. Each channel
+    has its own worker processes, or its own budget of concurrent sends
+    with the asyncio engine, and fetching is paused per topic. Offsets are
+    committed manually if any channel requires it.
+
+    Parameters:
+        channels: Channels to run.
+        group_id: Kafka consumer group ID. Defaults to the one of the
+            channel when running a single one.
+        engine: 'process' or 'asyncio'.
+        consumer_poll_timeout: Poll timeout while polled messages wait for
+            room in the work queues.
+    """
+    if group_id is None:
+        if len(channels) != 1:
+            raise ValueError('A consumer group ID is required to run several channels.')
+        group_id = channels[0].group_id
+    if engine == 'asyncio':
+        missing = [c.name for c in channels if c.async_worker is None]
+        if missing:
+            raise ValueError(f'The asyncio engine requires an async worker: {missing}')
+        try:
+            asyncio.run(_async_main(channels, group_id))
+        except KeyboardInterrupt:
+            log.warning("Interrupted by user. Shutting down.")
+    else:
+        _process_main(channels, group_id, consumer_poll_timeout=consumer_poll_timeout)
+
+
+class _AsyncLane:
+    """Messages of a channel waiting for, and being sent by, the asyncio engine."""
+
+    def __init__(self, channel: Channel, multi: bool):
+        self.channel = channel
+        self.initargs = channel.initargs
+        self.backpressure = _backpressure(channel.max_inflight, channel.topic if multi else None)
+        self.pending = deque()  # polled messages waiting for a free send slot
+        self.tasks = set()
+
+    def in_flight(self) -> int:
+        return len(self.tasks) + len(self.pending)
+
+
+async def _async_main(channels: list, group_id: str):
+    global _ack_queue
+    multi = len(channels) > 1
+    lanes = {c.topic: _AsyncLane(c, multi) for c in channels}
+    manual_commit = any(c.manual_commit for c in channels)
+    log.info("Starting asyncio engine with topics %s, group '%s' and %s max in-flight sends",
+             list(lanes), group_id, [c.max_inflight for c in channels])
+    loop = asyncio.get_running_loop()
+    # Blocking sends of the channels run in the default executor.
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=sum(c.max_inflight for c in channels),
+                                                 thread_name_prefix='send'))
+    # The consumer is not thread-safe: all calls to it are made from one thread.
+    kafka_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='kafka')
+
+    if manual_commit:
+        _ack_queue = queue.Queue()
+    committer = _Committer(_ack_queue, multiprocessing.Value('i', 0)) if manual_commit else None
+    dedup = _deduplicator()
+    flaps = _flap_suppressor(committer)
+
+    async def run_message(lane, msg):
+        taken_up(msg)
+        try:
+            await lane.channel.async_worker(msg, *lane.initargs)
+        except Exception as ex:
+            log.error('Failed processing %s: %s', msg, ex)
+            ack(msg)
+
+    def schedule():
+        for lane in lanes.values():
+            while lane.pending and len(lane.tasks) < lane.channel.max_inflight:
+                task = asyncio.ensure_future(run_message(lane, lane.pending.popleft()))
+                lane.tasks.add(task)
+                task.add_done_callback(lane.tasks.discard)
+
+    raw_records = KAFKA_RECORD_MODE == 'raw'
+    started = time.monotonic()
+    consumer, initargs = await loop.run_in_executor(
+        kafka_executor, _start_consumer,
+        lambda: kafka_consumer(list(lanes), KAFKA_BOOTSTRAP_SERVERS, group_id=group_id,
+                               enable_auto_commit=not manual_commit,
+                               decode_values=not raw_records, listener=committer),
+        channels)
+    for lane, args in zip(lanes.values(), initargs):
+        lane.initargs = args
+    if committer:
+        committer.consumer = consumer
+    assigned = False
+    current_generation = 0
+    with _shutdown_signals() as stop:
+        try:
+            while not stop.is_set():
+                busy = any(lane.pending or lane.backpressure.paused for lane in lanes.values())
+                timeout_ms = 50 if busy else 1000
+                records = await loop.run_in_executor(kafka_executor, consumer.poll, timeout_ms,
+                                                     KAFKA_MAX_POLL_RECORDS)
+                consumed_at = time.time()
+                if not assigned:
+                    assigned = _first_assignment(consumer, started)
+                if committer and committer.generation.value != current_generation:
+                    # Messages of revoked partitions not acked will be consumed again.
+                    current_generation = committer.generation.value
+                    for lane in lanes.values():
+                        lane.pending.clear()
+                    if flaps is not None:
+                        flaps.clear()
+                    if dedup is not None:
+                        dedup.forget(committer.pop_redelivered())
+                for tp, msgs in records.items():
+                    for msg in msgs:
+                        if raw_records:
+                            msg = Record.from_consumer_record(msg, consumed_at)
+                        if committer:
+                            committer.tracker.dispatched(tp, msg.offset)
+                        if dedup is not None and dedup.duplicate(msg):
+                            _acked(committer, msg)
+                            continue
+                        for m in (flaps.add(msg) if flaps is not None else (msg,)):
+                            lanes[m.topic].pending.append(m)
+                if flaps is not None:
+                    for m in flaps.expired():
+                        lanes[m.topic].pending.append(m)
+                schedule()
+                for lane in lanes.values():
+                    await loop.run_in_executor(kafka_executor, lane.backpressure.update,
+                                               consumer, lane.in_flight())
+                if committer:
+                    await loop.run_in_executor(kafka_executor, committer.maybe_commit)
+        finally:
+            started = time.monotonic()
+            await _async_drain(lanes, committer, flaps, schedule, SHUTDOWN_TIMEOUT)
+            abandoned = {lane.channel.name: len(lane.pending) for lane in lanes.values()}
+            if committer:
+                # Before cancelling the sends still running, which ack their message.
                 try:
-                    work_queue.put(msg, timeout=consumer_poll_timeout)
-                    break
-                except queue.Full:
-                    log.warning('Work queue full. Sleeping 1 second before retrying...')
-                    time.sleep(1)
+                    await loop.run_in_executor(kafka_executor, committer.commit)
+                except Exception as e:
+                    log.error("Failed committing offsets on shutdown: %s", e)
+                for topic, lane in lanes.items():
+                    abandoned[lane.channel.name] = \
+                        committer.tracker.in_flight(topic if multi else None)
+            tasks = set().union(*(lane.tasks for lane in lanes.values()))
+            if tasks:
+                log.warning('Cancelling %s sends still running after %ss.',
+                            len(tasks), SHUTDOWN_TIMEOUT)
+                for task in tasks:
+                    task.cancel()
+                await asyncio.wait(tasks)
+            _report_shutdown(started, abandoned)
+            try:
+                await loop.run_in_executor(kafka_executor, consumer.close)
+            except Exception as e:
+                log.error("Failed closing the Kafka consumer: %s", e)
+            kafka_executor.shutdown()
+            log.info("Asyncio engine shut down.")
+
+
+async def _async_drain(lanes: dict, committer, flaps, schedule, timeout: float):
+    """
+    Wait for the sends in flight to finish, within `timeout` seconds. With
+    manual commits, messages not sent yet are left to be consumed again
+    after the restart. Otherwise, their offsets may be committed already:
+    they are sent as well.
+    """
+    deadline = time.monotonic() + timeout
+    if committer:
+        for lane in lanes.values():
+            lane.pending.clear()
+    elif flaps is not None:
+        for m in flaps.expired(float('inf')):
+            lanes[m.topic].pending.append(m)
+    while True:
+        schedule()
+        tasks = set().union(*(lane.tasks for lane in lanes.values()))
+        remaining = deadline - time.monotonic()
+        if not tasks or remaining <= 0:
+            return
+        await asyncio.wait(tasks, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+
+
+def _first_assignment(consumer, started: float) -> bool:
+    """Whether partitions are assigned, recording the time to the first assignment."""
+    if not consumer.assignment():
+        return False
+    seconds = time.monotonic() - started
+    STARTUP_SECONDS.labels('assignment').set(seconds)
+    log.info('Partitions assigned %.3fs after startup.', seconds)
+    return True
+
+
+class _Lane:
+    """
+    Work queue, dispatcher and worker processes of a channel. With key
+    affinity, each worker has its own work queue instead.
+    """
+
+    def __init__(self, channel: Channel, multi: bool, dispatch_mode: str = KAFKA_DISPATCH_MODE):
+        self.channel = channel
+        self.keyed = dispatch_mode == 'key'
+        self.work_queue = None
+        if self.keyed:
+            self.dispatcher = _KeyDispatcher(
+                channel.name, max(channel.queue_maxsize // channel.num_workers, 1))
+        else:
+            self.work_queue = multiprocessing.Queue(maxsize=channel.queue_maxsize)
+            self.queued = multiprocessing.Value('l', 0)  # messages not taken up by the workers
+            self.idle = multiprocessing.Value('i', 0)  # number of workers waiting for work
+            self.retire = multiprocessing.Value('i', 0)  # number of workers asked to exit
+            self.dispatcher = _ChunkDispatcher(self.work_queue, self.queued, channel.num_workers)
+        self.backpressure = _backpressure(channel.queue_maxsize, channel.topic if multi else None)
+        self.autoscaler = None
+        if channel.max_workers > channel.num_workers:
+            self.autoscaler = Autoscaler(channel.name, channel.num_workers, channel.max_workers)
+        self.workers = channel.num_workers
+        self.processes = []
+        self._worker_args = None
+        self._initargs = ()
+        self._maintained_at = 0
+
+    def start(self, ack_queue, generation, initargs: tuple):
+        self._worker_args = (self.channel.worker, ack_queue, generation)
+        self._initargs = initargs
+        self.maintain()
+        WORKERS.labels(self.channel.name).set(self.workers)
+
+    def _start_worker(self, queued, idle, retire, work_queue):
+        # Extend initargs to include the ack and work queues
+        args = self._worker_args + (queued, idle, retire, work_queue) + self._initargs
+        p = multiprocessing.Process(target=_init_worker, args=args, daemon=True)
+        p.start()
+        return p
+
+    def _reap(self, p):
+        p.join()
+        process_dead(p.pid)
+        if p.exitcode != 0:
+            log.warning('Worker %s of %s exited with %s.', p.pid, self.channel.name, p.exitcode)
+
+    def maintain(self):
+        """Reap the exited workers, and start workers up to the number wanted."""
+        if self.keyed:
+            self._maintain_slots()
+        else:
+            alive = []
+            for p in self.processes:
+                if p.is_alive():
+                    alive.append(p)
+                else:
+                    self._reap(p)
+            self.processes = alive
+            # Workers asked to exit are still counted until one of them claims it.
+            for _ in range(self.workers + self.retire.value - len(self.processes)):
+                self.processes.append(self._start_worker(self.queued, self.idle, self.retire,
+                                                         self.work_queue))
+        self._maintained_at = time.monotonic()
+
+    def _maintain_slots(self):
+        dispatcher = self.dispatcher
+        for slot in list(dispatcher.slots):
+            if slot.process is not None and not slot.process.is_alive():
+                self._reap(slot.process)
+                slot.process = None
+                if slot.retiring:
+                    dispatcher.remove_slot(slot)
+                    continue
+            if slot.draining and not slot.retiring and slot.idle.value \
+                    and not slot.queued.value and not len(slot.dispatcher):
+                # Done with all its messages.
+                slot.retiring = True
+                slot.retire.value = 1
+            if slot.process is None:
+                slot.process = self._start_worker(slot.queued, slot.idle, slot.retire, slot.queue)
+        while len(dispatcher.active) < self.workers:
+            slot = dispatcher.add_slot()
+            slot.process = self._start_worker(slot.queued, slot.idle, slot.retire, slot.queue)
+        self.processes = [slot.process for slot in dispatcher.slots if slot.process is not None]
+
+    def scale(self, workers: int):
+        """Start workers, or ask idle ones to exit once done with their messages."""
+        if self.keyed:
+            # Workers scaled down take no new keys, and exit once idle.
+            if workers > self.workers:
+                draining = [s for s in self.dispatcher.slots if s.draining and not s.retiring]
+                for slot in draining[:workers - self.workers]:
+                    self.dispatcher.drain(slot, False)
+            else:
+                for slot in self.dispatcher.active[workers:]:
+                    self.dispatcher.drain(slot)
+        else:
+            with self.retire.get_lock():
+                if workers > self.workers:
+                    self.retire.value -= min(self.retire.value, workers - self.workers)
+                else:
+                    self.retire.value += self.workers - workers
+            self.dispatcher.num_workers = workers
+        self.workers = workers
+        WORKERS.labels(self.channel.name).set(workers)
+        self.maintain()
+
+    def waiting(self) -> int:
+        """Number of messages waiting for the workers, or not dispatched yet."""
+        if self.keyed:
+            return self.dispatcher.waiting()
+        return self.queued.value + len(self.dispatcher)
+
+    def _idle_workers(self) -> int:
+        if self.keyed:
+            return sum(slot.idle.value for slot in self.dispatcher.slots)
+        return self.idle.value
+
+    def autoscale(self, consumer):
+        if time.monotonic() - self._maintained_at >= 1:
+            self.maintain()
+        if self.autoscaler is None:
+            return
+        running = max(len(self.processes), 1)
+        self.autoscaler.observe(max(running - self._idle_workers(), 0) / running, self.waiting())
+        if self.autoscaler.due():
+            lag = consumer_lag(consumer, self.channel.topic)
+            workers = self.autoscaler.decide(self.workers, lag)
+            if workers != self.workers:
+                self.scale(workers)
+
+    def shutdown(self):
+        """Ask all the workers to exit once done with the messages they took up."""
+        if self.keyed:
+            for slot in self.dispatcher.slots:
+                slot.draining = slot.retiring = True
+                slot.retire.value = 1
+            self.dispatcher.active = []
+        else:
+            with self.retire.get_lock():
+                self.retire.value = len(self.processes)
+        self.workers = 0
+
+    def alive(self) -> int:
+        """Number of worker processes still running."""
+        return sum(p.is_alive() for p in self.processes)
+
+    def stop(self):
+        """Terminate the workers still running, abandoning their messages."""
+        for p in self.processes:
+            p.terminate()
+        for p in self.processes:
+            p.join()
+        queues = [s.queue for s in self.dispatcher.slots] if self.keyed else [self.work_queue]
+        for q in queues:
+            # Messages left in the queue are abandoned.
+            q.cancel_join_thread()
+            q.close()
+
+
+def _process_main(channels: list, group_id: str, *, consumer_poll_timeout: float):
+    multi = len(channels) > 1
+    lanes = {c.topic: _Lane(c, multi) for c in channels}
+    manual_commit = any(c.manual_commit for c in channels)
+    log.info("Starting Kafka worker pool with topics %s, group '%s' and %s workers",
+             list(lanes), group_id, [c.num_workers for c in channels])
+
+    ack_queue = multiprocessing.Queue() if manual_commit else None
+    generation = multiprocessing.Value('i', 0) if manual_commit else None
+    committer = _Committer(ack_queue, generation) if manual_commit else None
+    dedup = _deduplicator()
+    flaps = _flap_suppressor(committer)
+    raw_records = KAFKA_RECORD_MODE == 'raw'
+    started = time.monotonic()
+
+    consumer, initargs = _start_consumer(
+        lambda: kafka_consumer(list(lanes), KAFKA_BOOTSTRAP_SERVERS, group_id=group_id,
+                               enable_auto_commit=not manual_commit,
+                               decode_values=not raw_records, listener=committer),
+        channels)
+    if committer:
+        committer.consumer = consumer
+
+    # Create worker pools. Workers warm up while the consumer joins the group.
+    with startup_phase('workers'):
+        for lane, args in zip(lanes.values(), initargs):
+            lane.start(ack_queue, generation, args)
+
+    with _shutdown_signals() as stop:
+        try:
+            _consume(consumer, lanes, committer, generation, dedup, flaps, stop,
+                     started=started, consumer_poll_timeout=consumer_poll_timeout)
+        except KeyboardInterrupt:
+            log.warning("Interrupted by user. Shutting down.")
+        except Exception as e:
+            log.error("Unhandled error in main loop: %s", e)
+        finally:
+            _drain_lanes(consumer, lanes, committer, flaps, SHUTDOWN_TIMEOUT)
+        log.info("Kafka worker pool shut down gracefully.")
+
+
+def _consume(consumer, lanes: dict, committer, generation, dedup, flaps, stop, *,
+             started: float, consumer_poll_timeout: float):
+    multi = len(lanes) > 1
+    raw_records = KAFKA_RECORD_MODE == 'raw'
+    assigned = False
+    current_generation = 0
+    while not stop.is_set():
+        busy = any(lane.dispatcher or lane.backpressure.paused for lane in lanes.values())
+        timeout_ms = int(consumer_poll_timeout * 1000) if busy else 1000
+        records = consumer.poll(timeout_ms=timeout_ms, max_records=KAFKA_MAX_POLL_RECORDS)
+        consumed_at = time.time()
+        if not assigned:
+            assigned = _first_assignment(consumer, started)
+        if generation and generation.value != current_generation:
+            # Messages of revoked partitions will be consumed again.
+            current_generation = generation.value
+            for lane in lanes.values():
+                lane.dispatcher.clear()
+            if flaps is not None:
+                flaps.clear()
+            if dedup is not None:
+                dedup.forget(committer.pop_redelivered())
+        for tp, msgs in records.items():
+            for msg in msgs:
+                if raw_records:
+                    msg = Record.from_consumer_record(msg, consumed_at)
+                if committer:
+                    committer.tracker.dispatched(tp, msg.offset)
+                if dedup is not None and dedup.duplicate(msg):
+                    _acked(committer, msg)
+                    continue
+                for m in (flaps.add(msg) if flaps is not None else (msg,)):
+                    lanes[m.topic].dispatcher.add(m)
+        if flaps is not None:
+            for m in flaps.expired():
+                lanes[m.topic].dispatcher.add(m)
+        if committer:
+            committer.maybe_commit()
+        for topic, lane in lanes.items():
+            lane.dispatcher.dispatch(current_generation)
+            if committer:
+                in_flight = committer.tracker.in_flight(topic if multi else None)
+                if flaps is not None:
+                    # Alerts held back are not acked, but wait for no worker.
+                    in_flight -= flaps.held(topic if multi else None)
+            else:
+                in_flight = lane.waiting()
+            lane.backpressure.update(consumer, in_flight)
+            lane.autoscale(consumer)
+
+
+def _drain_lanes(consumer, lanes: dict, committer, flaps, timeout: float):
+    """
+    Stop the workers once done with the messages they took up, within
+    `timeout` seconds, then commit the offsets of the messages done and
+    close the consumer. With manual commits, messages not taken up yet are
+    left to be consumed again after the restart. Otherwise, their offsets
+    may be committed already: they are handed over to the workers first.
+    Workers still running at the deadline are terminated.
+    """
+    started = time.monotonic()
+    deadline = started + timeout
+    try:
+        if committer:
+            for lane in lanes.values():
+                lane.dispatcher.clear()
+        else:
+            if flaps is not None:
+                for m in flaps.expired(float('inf')):
+                    lanes[m.topic].dispatcher.add(m)
+            while any(lane.waiting() for lane in lanes.values()) \
+                    and time.monotonic() < deadline:
+                for lane in lanes.values():
+                    lane.dispatcher.dispatch()
+                time.sleep(RETIRE_POLL_INTERVAL)
+        for lane in lanes.values():
+            lane.shutdown()
+        while any(lane.alive() for lane in lanes.values()) and time.monotonic() < deadline:
+            time.sleep(RETIRE_POLL_INTERVAL)
     except KeyboardInterrupt:
-        log.warning("Interrupted by user. Shutting down.")
+        log.warning("Interrupted by user. Terminating the workers.")
+    terminated = sum(lane.alive() for lane in lanes.values())
+    if terminated:
+        log.warning('Terminating %s workers still running after %ss.', terminated, timeout)
+    for lane in lanes.values():
+        lane.stop()
+    abandoned = {}
+    if committer:
+        try:
+            committer.commit()
+        except Exception as e:
+            log.error("Failed committing offsets on shutdown: %s", e)
+        multi = len(lanes) > 1
+        for topic, lane in lanes.items():
+            abandoned[lane.channel.name] = committer.tracker.in_flight(topic if multi else None)
+    else:
+        for lane in lanes.values():
+            abandoned[lane.channel.name] = lane.waiting()
+    _report_shutdown(started, abandoned)
+    try:
+        consumer.close()
     except Exception as e:
-        log.error("Unhandled error in main loop: %s", e)
-    finally:
-        work_queue.close()
-        work_queue.join_thread()
-        pool.close()
-        pool.join()
-        log.info("Kafka worker pool shut down gracefully.")
\ No newline at end of file
+        log.error("Failed closing the Kafka consumer: %s", e)
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+
+import asyncio
+import multiprocessing
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+from notify_deps import get_logger, DelayedWork, MAX_DEFERRED
+from metrics import (NOTIFICATIONS_THROTTLED, NOTIFICATIONS_THROTTLED_SECONDS,
+                     NOTIFICATIONS_RATE_LIMITED, destination_label)
+
+log_local = get_logger('ratelimit')
+
+
+def retry_after(headers, default: float) -> float:
+    """Seconds to wait according to the Retry-After header, or the default."""
+    try:
+        return max(float(headers.get('Retry-After')), 0)
+    except (TypeError, ValueError):
+        return default
+
+
+class TokenBucket:
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.updated = now
+        self.blocked_until = 0.0
+
+    def delay(self, now: float) -> float:
+        """Take a token if available. Otherwise return the seconds until one is."""
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class RateLimiter:
+    """
+    Token bucket rate limiter per destination: `rate` sends per second with
+    bursts of up to `burst` sends. A rate of 0 disables the limiter.
+    Destinations can be blocked for a while, e.g. on HTTP 429 Retry-After.
+    At most `max_destinations` buckets are kept, least recently used first
+    out.
+    """
+
+    def __init__(self, channel: str, rate: float, burst: float = 1,
+                 max_destinations: int = 10000):
+        self.channel = channel
+        self.rate = rate
+        self.burst = burst
+        self.max_destinations = max_destinations
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _bucket(self, dest, now) -> TokenBucket:
+        bucket = self._buckets.get(dest)
+        if bucket is None:
+            bucket = TokenBucket(self.rate, self.burst, now)
+            self._buckets[dest] = bucket
+            while len(self._buckets) > self.max_destinations:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(dest)
+        return bucket
+
+    def acquire(self, dest) -> float:
+        """
+        Take a send slot for the destination. Returns 0 when granted, or the
+        number of seconds to wait before asking again.
+        """
+        delay = self._delay(dest, time.monotonic())
+        if delay > 0:
+            label = destination_label(dest)
+            NOTIFICATIONS_THROTTLED.labels(self.channel, label).inc()
+            NOTIFICATIONS_THROTTLED_SECONDS.labels(self.channel, label).inc(delay)
+        return delay
+
+    def _delay(self, dest, now: float) -> float:
+        with self._lock:
+            bucket = self._buckets.get(dest)
+            if self.rate <= 0 and (bucket is None or bucket.blocked_until <= now):
+                return 0.0
+            return self._bucket(dest, now).delay(now)
+
+    def _block(self, dest, until: float):
+        with self._lock:
+            bucket = self._bucket(dest, time.monotonic())
+            bucket.blocked_until = max(bucket.blocked_until, until)
+
+    def wait(self, dest):
+        """Block until a send slot for the destination is granted."""
+        while True:
+            delay = self.acquire(dest)
+            if delay <= 0:
+                return
+            time.sleep(delay)
+
+    async def async_wait(self, dest):
+        """Wait without blocking the event loop until a send slot is granted."""
+        while True:
+            delay = self.acquire(dest)
+            if delay <= 0:
+                return
+            await asyncio.sleep(delay)
+
+    def block(self, dest, seconds: float):
+        """Don't grant send slots to the destination for the next seconds."""
+        NOTIFICATIONS_RATE_LIMITED.labels(self.channel, destination_label(dest)).inc()
+        log_local.warning(f'{self.channel} destination {dest} rate limited for {seconds}s.')
+        self._block(dest, time.monotonic() + seconds)
+
+
+class SharedRateLimiter(RateLimiter):
+    """
+    Rate limiter whose buckets are in shared memory, so that the rate applies
+    per destination across the worker processes forked after its creation.
+    Destinations are hashed into `slots` buckets: colliding destinations
+    share their rate.
+    """
+
+    def __init__(self, channel: str, rate: float, burst: float = 1, slots: int = 4096):
+        super().__init__(channel, rate, burst)
+        self.slots = slots
+        # Tokens, time of the last update (0 when unused) and blocked until, per slot.
+        self._state = multiprocessing.Array('d', 3 * slots)
+
+    def _index(self, dest) -> int:
+        return 3 * (zlib.crc32(str(dest).encode()) % self.slots)
+
+    def _load(self, i: int, now: float) -> TokenBucket:
+        bucket = TokenBucket(self.rate, self.burst, now)
+        tokens, updated, bucket.blocked_until = self._state[i:i + 3]
+        if updated:
+            bucket.tokens, bucket.updated = tokens, updated
+        return bucket
+
+    def _store(self, i: int, bucket: TokenBucket):
+        self._state[i:i + 3] = [bucket.tokens, bucket.updated, bucket.blocked_until]
+
+    def _delay(self, dest, now: float) -> float:
+        i = self._index(dest)
+        with self._state.get_lock():
+            bucket = self._load(i, now)
+            if self.rate <= 0 and bucket.blocked_until <= now:
+                return 0.0
+            delay = bucket.delay(now)
+            self._store(i, bucket)
+        return delay
+
+    def _block(self, dest, until: float):
+        i = self._index(dest)
+        with self._state.get_lock():
+            bucket = self._load(i, time.monotonic())
+            bucket.blocked_until = max(bucket.blocked_until, until)
+            self._store(i, bucket)
+
+
+class ThrottledWork(DelayedWork):
+    """
+    Work queue reader that defers messages of destinations over their rate
+    limit instead of waiting for them, so the worker keeps serving other
+    destinations.
+    """
+
+    def __init__(self, workq, limiter: RateLimiter, destination,
+                 max_deferred: int = MAX_DEFERRED):
+        super().__init__(workq, max_deferred)
+        self.limiter = limiter
+        self.destination = destination
+
+    def admit(self, msg) -> bool:
+        try:
+            dest = self.destination(msg)
+        except Exception as ex:
+            # Let the message fail in processing, where errors are reported.
+            log_local.debug(f'No destination for {msg}: {ex}')
+            return True
+        delay = self.limiter.acquire(dest)
+        if delay > 0:
+            self.defer(msg, delay)
+            return False
+        return True
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Re-injects the messages of the dead-letter topic into the topics they were
+consumed from, at a controlled rate, e.g. after an outage of a destination.
+Stops once the dead-letter topic is drained.
+"""
+
+import os
+
+from kafka import KafkaProducer
+from kafka.structs import OffsetAndMetadata
+
+from notify_deps import get_logger, kafka_consumer
+from notify_deps import KAFKA_BOOTSTRAP_SERVERS, KAFKA_DLQ_TOPIC
+from ratelimit import RateLimiter
+
+KAFKA_GROUP_ID = 'nuvla-notification-dlq-replay'
+
+# Messages re-injected per second (0 for no limit).
+REPLAY_RATE = float(os.environ.get('REPLAY_RATE') or 100)
+# Only replay the messages that failed in this channel (all when not set).
+REPLAY_CHANNEL = os.environ.get('REPLAY_CHANNEL') or ''
+# Re-inject into this topic instead of the one the message was consumed from.
+REPLAY_TARGET_TOPIC = os.environ.get('REPLAY_TARGET_TOPIC') or ''
+# Stop after this many seconds without messages in the dead-letter topic.
+REPLAY_IDLE_TIMEOUT = float(os.environ.get('REPLAY_IDLE_TIMEOUT') or 10)
+# Stop after replaying this many messages (0 for no limit).
+REPLAY_MAX_MESSAGES = int(os.environ.get('REPLAY_MAX_MESSAGES') or 0)
+
+log_local = get_logger('replay-dlq')
+
+
+def record_headers(record) -> dict:
+    return {k: v.decode() for k, v in (record.headers or [])}
+
+
+def target_topic(headers: dict) -> str:
+    return REPLAY_TARGET_TOPIC or headers.get('dlq-topic')
+
+
+def done(replayed: int) -> bool:
+    return 0 < REPLAY_MAX_MESSAGES <= replayed
+
+
+def replay(consumer, producer, limiter: RateLimiter) -> int:
+    replayed = 0
+    idle = 0.0
+    poll_timeout = 1.0
+    while idle < REPLAY_IDLE_TIMEOUT and not done(replayed):
+        batches = consumer.poll(timeout_ms=poll_timeout * 1000, max_records=500)
+        if not batches:
+            idle += poll_timeout
+            continue
+        idle = 0.0
+        offsets = {}
+        for tp, records in batches.items():
+            for record in records:
+                if done(replayed):
+                    break
+                offsets[tp] = OffsetAndMetadata(record.offset + 1, None)
+                headers = record_headers(record)
+                if REPLAY_CHANNEL and headers.get('dlq-channel') != REPLAY_CHANNEL:
+                    continue
+                topic = target_topic(headers)
+                if not topic:
+                    log_local.warning(f'No topic to replay {record.topic}:{record.offset} to.')
+                    continue
+                limiter.wait('replay')
+                key = record.key.encode() if record.key else None
+                producer.send(topic, value=record.value, key=key)
+                replayed += 1
+        # Only mark as replayed what was written to the target topics.
+        producer.flush()
+        consumer.commit(offsets)
+        log_local.info(f'Replayed {replayed} messages.')
+    return replayed
+
+
+def main():
+    if not KAFKA_DLQ_TOPIC:
+        raise SystemExit('KAFKA_DLQ_TOPIC must be set.')
+    group_id = f'{KAFKA_GROUP_ID}-{REPLAY_CHANNEL}' if REPLAY_CHANNEL else KAFKA_GROUP_ID
+    consumer = kafka_consumer(KAFKA_DLQ_TOPIC, KAFKA_BOOTSTRAP_SERVERS, group_id,
+                              auto_offset_reset='earliest', enable_auto_commit=False,
+                              decode_values=False)
+    producer = KafkaProducer(bootstrap_servers=KAFKA_BOOTSTRAP_SERVERS,
+                             linger_ms=50, batch_size=256 * 1024, acks='all')
+    limiter = RateLimiter('replay', REPLAY_RATE, max(REPLAY_RATE, 1))
+    log_local.info(f'Replaying {KAFKA_DLQ_TOPIC} at {REPLAY_RATE or "unlimited"} msg/s.')
+    try:
+        replayed = replay(consumer, producer, limiter)
+    finally:
+        producer.close()
+        consumer.close()
+    log_local.info(f'Done: replayed {replayed} messages from {KAFKA_DLQ_TOPIC}.')
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,24 @@
 #!/bin/sh
 
-senders="<slack|email|mqtt>"
+senders="<slack|email|mqtt|multi|replay-dlq>"
 
 SENDER=${1:?"Sender ${senders} must be provided."}
 
 if [ "${SENDER}" == "email" ]
 then
-  ./notify-email.py
+  exec ./notify-email.py
 elif [ "${SENDER}" == "slack" ]
 then
-  ./notify-slack.py
+  exec ./notify-slack.py
 elif [ "${SENDER}" == "mqtt" ]
 then
-  ./notify-mqtt.py
+  exec ./notify-mqtt.py
+elif [ "${SENDER}" == "multi" ]
+then
+  exec ./notify-multi.py
+elif [ "${SENDER}" == "replay-dlq" ]
+then
+  exec ./replay-dlq.py
 else
   echo "Sender can be one of ${senders}."
   exit 1
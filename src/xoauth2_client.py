@@ -1,11 +1,16 @@
 #!/usr/bin/env python3
 
 import base64
+import fcntl
+import hashlib
+import json
+import os
 import smtplib
+import tempfile
 import time
 import threading
 from abc import ABC, abstractmethod
-from datetime import datetime, timedelta
+from datetime import datetime
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 
@@ -13,16 +18,32 @@ import requests
 from pydantic import BaseModel, Field
 
 from notify_deps import get_logger
+from metrics import OAUTH2_TOKEN_REFRESHES, SMTP_SESSION_RECONNECTS, SMTP_SESSION_REUSED
 
 
 log_local = get_logger('xoauth2-client')
 
+# Directory of the access token cache shared by the processes of the host.
+OAUTH2_TOKEN_CACHE_DIR = os.environ.get('OAUTH2_TOKEN_CACHE_DIR') or tempfile.gettempdir()
+# Seconds before expiry at which the token refresher gets a new access token.
+OAUTH2_TOKEN_REFRESH_MARGIN = float(os.environ.get('OAUTH2_TOKEN_REFRESH_MARGIN') or 300)
+# Seconds between attempts of the token refresher after a failure.
+OAUTH2_TOKEN_RETRY_INTERVAL = float(os.environ.get('OAUTH2_TOKEN_RETRY_INTERVAL') or 10)
+
+# A cached access token is no longer used this many seconds before expiry.
+TOKEN_EXPIRY_LEEWAY = 30
+
 
 class SMTPParams(BaseModel):
     smtp_port: int = Field(default=465, alias="smtp-port")
     smtp_host: str = Field(alias="smtp-host")
     smtp_username: str = Field(default=None, alias="smtp-username")
     smtp_debug: bool = Field(default=False, alias="smtp-debug")
+    smtp_timeout: float = Field(default=30, alias="smtp-timeout")
+    # Send NOOP before reusing a session idle for longer than this (seconds).
+    smtp_keepalive_interval: float = Field(default=60, alias="smtp-keepalive-interval")
+    # Drop and re-establish a session idle for longer than this (seconds).
+    smtp_idle_timeout: float = Field(default=300, alias="smtp-idle-timeout")
     smtp_xoauth2: str = Field(alias="smtp-xoauth2")
     smtp_xoauth2_config: dict = Field(default_factory=dict, alias="smtp-xoauth2-config")
 
@@ -42,6 +63,109 @@ class SMTPParamsGoogle(SMTPParams):
         alias="smtp-xoauth2-config")
 
 
+class SharedTokenCache:
+    """
+    OAuth2 access token shared by the processes of a host through a file.
+
+    The token is read from the file, and requested with `fetch` only when it
+    expires within `min_ttl` seconds. The request is made under an exclusive
+    lock of the file, after reading it again, so that concurrent processes
+    request a new token once.
+    """
+
+    def __init__(self, path: str, fetch):
+        """
+        Args:
+            path: File of the cache.
+            fetch: Callable returning a new access token and its lifetime in
+                seconds.
+        """
+        self.path = path
+        self.fetch = fetch
+
+    def read(self):
+        """Cached (token, expires_at), or None."""
+        try:
+            with open(self.path) as f:
+                cached = json.load(f)
+            return cached['access_token'], float(cached['expires_at'])
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def write(self, token: str, expires_at: float):
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.path), prefix='.token-')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'access_token': token, 'expires_at': expires_at}, f)
+            os.replace(tmp, self.path)
+        except Exception:
+            os.unlink(tmp)
+            raise
+
+    def get(self, min_ttl: float = TOKEN_EXPIRY_LEEWAY):
+        """Access token valid for at least `min_ttl` seconds, and its expiry time."""
+        cached = self.read()
+        if cached and cached[1] - time.time() > min_ttl:
+            return cached
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            cached = self.read()
+            if cached and cached[1] - time.time() > min_ttl:
+                return cached
+            try:
+                token, expires_in = self.fetch()
+            except Exception:
+                OAUTH2_TOKEN_REFRESHES.labels('error').inc()
+                raise
+            OAUTH2_TOKEN_REFRESHES.labels('ok').inc()
+            expires_at = time.time() + expires_in
+            self.write(token, expires_at)
+            log_local.info(f'New access token obtained, expires in {expires_in} seconds '
+                           f'at {_format_time(expires_at)}.')
+            return token, expires_at
+
+
+class TokenRefresher(threading.Thread):
+    """
+    Keeps a shared access token fresh, requesting a new one `margin` seconds
+    before expiry. Run by the parent process, so that workers only read the
+    token from the cache.
+    """
+
+    def __init__(self, cache: SharedTokenCache, margin: float = OAUTH2_TOKEN_REFRESH_MARGIN,
+                 retry_interval: float = OAUTH2_TOKEN_RETRY_INTERVAL):
+        super().__init__(name='token-refresher', daemon=True)
+        self.cache = cache
+        self.margin = margin
+        self.retry_interval = retry_interval
+        self._stop_refresh = threading.Event()
+
+    def refresh(self) -> float:
+        """Refresh the token if needed, and return the seconds until the next refresh."""
+        _, expires_at = self.cache.get(self.margin)
+        next_refresh = max(expires_at - self.margin - time.time(), 5)
+        log_local.info(f'Next token refresh in {next_refresh:.0f} seconds at '
+                       f'{_format_time(time.time() + next_refresh)}.')
+        return next_refresh
+
+    def run(self):
+        while not self._stop_refresh.is_set():
+            try:
+                wait = self.refresh()
+            except Exception as ex:
+                log_local.error(f'Failed refreshing OAuth2 token: {ex}')
+                wait = self.retry_interval
+            self._stop_refresh.wait(wait)
+
+    def stop(self):
+        self._stop_refresh.set()
+
+
+def _format_time(epoch: float) -> str:
+    return datetime.fromtimestamp(epoch).strftime("%Y-%m-%d %H:%M:%S")
+
+
 class XOAuth2SMTPClient(ABC):
     @abstractmethod
     def __init__(self):
@@ -51,6 +175,10 @@ class XOAuth2SMTPClient(ABC):
     def send_email(self, to_emails: list, subject, html: str, from_email=None):
         pass
 
+    @abstractmethod
+    def close_session(self):
+        pass
+
     @abstractmethod
     def stop(self):
         pass
@@ -60,59 +188,127 @@ class XOAuth2SMTPClientGoogle(XOAuth2SMTPClient):
 
     REFRESH_TOKEN_URL = "https://accounts.google.com/o/oauth2/token"
 
+    @classmethod
+    def token_cache(cls, config: SMTPParams) -> SharedTokenCache:
+        """Access token cache shared by the clients with the same credentials."""
+        xoauth2 = config.smtp_xoauth2_config
+        key = hashlib.sha256(f'{xoauth2.client_id}\0{xoauth2.refresh_token}'.encode())
+        path = os.path.join(OAUTH2_TOKEN_CACHE_DIR,
+                            f'kafka-notify-oauth2-{key.hexdigest()[:16]}.json')
+        return SharedTokenCache(path, lambda: cls.fetch_token(xoauth2))
+
+    @classmethod
+    def fetch_token(cls, xoauth2: XOAuth2ConfigGoogle):
+        log_local.info('Refreshing OAuth2 token...')
+        data = {
+            'client_id': xoauth2.client_id,
+            'client_secret': xoauth2.client_secret,
+            'refresh_token': xoauth2.refresh_token,
+            'grant_type': 'refresh_token'
+        }
+        resp = requests.post(cls.REFRESH_TOKEN_URL, data=data, timeout=30)
+        resp.raise_for_status()
+        token_data = resp.json()
+        return token_data['access_token'], int(token_data['expires_in'])
+
     def __init__(self, config: SMTPParams):
         self.smtp_host = config.smtp_host
         self.smtp_port = config.smtp_port
         self.email = config.smtp_username
         self.debug_level = config.smtp_debug
+        self.timeout = config.smtp_timeout
+        self.keepalive_interval = config.smtp_keepalive_interval
+        self.idle_timeout = config.smtp_idle_timeout
 
         # For token retrieval
         self.client_id = config.smtp_xoauth2_config.client_id
         self.client_secret = config.smtp_xoauth2_config.client_secret
         self.refresh_token = config.smtp_xoauth2_config.refresh_token
 
+        # Access token read from the shared cache, kept until about to expire.
+        self._tokens = self.token_cache(config)
         self._access_token = None
-
-        self._refresh_thread = None
+        self._token_expires_at = 0.0
         self._lock = threading.Lock()
-        self._stop_refresh = threading.Event()
 
-        self._refresh_token_now()
+        # Long-lived authenticated SMTP session reused across emails.
+        self._server = None
+        self._server_token = None
+        self._last_used = 0.0
+        self._connected_once = False
+        self._session_lock = threading.Lock()
 
-    def _refresh_token_now(self):
-        def _format_delta_time(in_seconds):
-            return (datetime.now() + timedelta(seconds=in_seconds)).strftime(
-                "%Y-%m-%d %H:%M:%S")
-        log_local.info('Refreshing OAuth2 token...')
-        data = {
-            'client_id': self.client_id,
-            'client_secret': self.client_secret,
-            'refresh_token': self.refresh_token,
-            'grant_type': 'refresh_token'
-        }
-        resp = requests.post(self.REFRESH_TOKEN_URL, data=data)
-        resp.raise_for_status()
-        token_data = resp.json()
+    def _current_token(self):
         with self._lock:
-            self._access_token = token_data['access_token']
-            expires_in = int(token_data['expires_in'])
-        log_local.info(f'New access token obtained, expires in '
-                       f'{expires_in} seconds at {_format_delta_time(expires_in)}.')
-        # Schedule next refresh (30s before expiry, minimum 5s)
-        next_refresh = max(expires_in - 30, 5)
-        log_local.info(f'Scheduling next token refresh in {next_refresh} seconds at '
-                       f'{_format_delta_time(next_refresh)}.')
-        if not self._stop_refresh.is_set():
-            self._refresh_thread = threading.Timer(next_refresh, self._refresh_token_now)
-            self._refresh_thread.daemon = True
-            self._refresh_thread.start()
-
-    def _xoauth2_string(self):
-        with self._lock:
-            token = self._access_token
+            if self._access_token is None or \
+                    self._token_expires_at - time.time() <= TOKEN_EXPIRY_LEEWAY:
+                self._access_token, self._token_expires_at = self._tokens.get()
+            return self._access_token
+
+    def _xoauth2_string(self, token=None):
+        if token is None:
+            token = self._current_token()
         auth_string = f"user={self.email}\1auth=Bearer {token}\1\1"
         return base64.b64encode(auth_string.encode()).decode()
 
+    def _connect(self, reason):
+        self._close_server()
+        log_local.info(f'Connecting to SMTP server {self.smtp_host}:{self.smtp_port} ({reason}).')
+        server = smtplib.SMTP_SSL(self.smtp_host, self.smtp_port, timeout=self.timeout)
+        try:
+            server.ehlo()
+            token = self._current_token()
+            code, response = server.docmd('AUTH', 'XOAUTH2 ' + self._xoauth2_string(token))
+            if code != 235:
+                raise smtplib.SMTPAuthenticationError(
+                    code, f'XOAUTH2 authentication failed: {response}')
+        except Exception:
+            server.close()
+            raise
+        self._server = server
+        self._server_token = token
+        self._last_used = time.monotonic()
+        self._connected_once = True
+        SMTP_SESSION_RECONNECTS.labels(reason).inc()
+        return server
+
+    def _close_server(self):
+        server, self._server = self._server, None
+        self._server_token = None
+        if server is None:
+            return
+        try:
+            server.quit()
+        except Exception:
+            server.close()
+
+    def _alive(self, server) -> bool:
+        try:
+            code, _ = server.noop()
+            return code == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    def _session(self):
+        """
+        Return an authenticated SMTP session and whether it was reused.
+
+        A new session is established when there is none yet, when the current
+        one was idle for longer than `idle_timeout`, when the access token was
+        rotated since authentication, or when a NOOP probe (sent after
+        `keepalive_interval` of inactivity) shows the server dropped it.
+        """
+        if self._server is None:
+            return self._connect('dropped' if self._connected_once else 'initial'), False
+        idle = time.monotonic() - self._last_used
+        if idle > self.idle_timeout:
+            return self._connect('idle'), False
+        if self._server_token != self._current_token():
+            return self._connect('token'), False
+        if idle > self.keepalive_interval and not self._alive(self._server):
+            return self._connect('dropped'), False
+        return self._server, True
+
     def send_email(self, recipients: list, subject, html: str, from_email=None):
         # Build message
         if from_email is None:
@@ -122,16 +318,28 @@ class XOAuth2SMTPClientGoogle(XOAuth2SMTPClient):
         msg['From'] = f'Nuvla <{from_email}>'
         msg['To'] = ', '.join(recipients)
         msg.attach(MIMEText(html, 'html', 'utf-8'))
-        # Connect, authenticate, and send the email
-        with smtplib.SMTP_SSL(self.smtp_host, self.smtp_port) as server:
-            server.ehlo()
-            auth_string = self._xoauth2_string()
-            code, response = server.docmd('AUTH', 'XOAUTH2 ' + auth_string)
-            if code != 235:
-                raise Exception(f"XOAUTH2 authentication failed: {response}")
-            server.sendmail(from_email, recipients, msg.as_string())
+        with self._session_lock:
+            try:
+                server, reused = self._session()
+                try:
+                    server.sendmail(from_email, recipients, msg.as_string())
+                except (smtplib.SMTPServerDisconnected, ConnectionError):
+                    if not reused:
+                        raise
+                    # The server closed the session between the probe and the send.
+                    server = self._connect('dropped')
+                    reused = False
+                    server.sendmail(from_email, recipients, msg.as_string())
+            except Exception:
+                self._close_server()
+                raise
+            self._last_used = time.monotonic()
+        if reused:
+            SMTP_SESSION_REUSED.inc()
+
+    def close_session(self):
+        with self._session_lock:
+            self._close_server()
 
     def stop(self):
-        self._stop_refresh.set()
-        if self._refresh_thread:
-            self._refresh_thread.cancel()
+        self.close_session()
@@ -6,7 +6,8 @@ import os
 import notify_email
 notify_email.init_email_templates(
     default=os.path.join('..', 'src', notify_email.EMAIL_TEMPLATE_DEFAULT_FILE),
-    app_pub=os.path.join('..', 'src', notify_email.EMAIL_TEMPLATE_APP_PUB_FILE))
+    app_pub=os.path.join('..', 'src', notify_email.EMAIL_TEMPLATE_APP_PUB_FILE),
+    digest=os.path.join('..', 'src', notify_email.EMAIL_TEMPLATE_DIGEST_FILE))
 
 tests = [
     'event-app-pub-app-bq.json',
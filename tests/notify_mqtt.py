@@ -0,0 +1 @@
+../src/notify-mqtt.py
\ No newline at end of file
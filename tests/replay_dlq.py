@@ -0,0 +1 @@
+../src/replay-dlq.py
\ No newline at end of file
@@ -0,0 +1,45 @@
+import unittest
+from unittest.mock import patch
+
+import metrics
+from metrics import TopDestinations, destination_label, error_label
+
+
+class TestLabelPolicy(unittest.TestCase):
+
+    def test_raw(self):
+        assert 'a@b.c' == destination_label('a@b.c')
+
+    def test_hash(self):
+        with patch.object(metrics, 'METRICS_DESTINATION_LABELS', 'hash'):
+            label = destination_label('https://hooks.slack.com/services/secret')
+            assert 12 == len(label)
+            assert 'secret' not in label
+            assert label == destination_label('https://hooks.slack.com/services/secret')
+
+    def test_bucket(self):
+        with patch.object(metrics, 'METRICS_DESTINATION_LABELS', 'bucket'), \
+                patch.object(metrics, 'METRICS_DESTINATION_BUCKETS', 4):
+            labels = {destination_label(f'user{i}@b.c') for i in range(1000)}
+            assert labels == {'bucket-0', 'bucket-1', 'bucket-2', 'bucket-3'}
+
+    def test_error_class_only(self):
+        assert 'ConnectionError' == error_label(ConnectionError('secret details'))
+        assert 'ValueError' == error_label(ValueError)
+
+
+class TestTopDestinations(unittest.TestCase):
+
+    def test_busiest_destinations_named(self):
+        top = TopDestinations(2, capacity=10)
+        for _ in range(5):
+            top.label('busy1')
+            top.label('busy2')
+        assert 'busy1' == top.label('busy1')
+        assert 'other' == top.label('rare')
+
+    def test_bounded_label_set(self):
+        top = TopDestinations(3, capacity=10)
+        labels = {top.label(f'dest{i}') for i in range(1000)}
+        assert 4 == len(labels)
+        assert 'other' in labels
@@ -1,6 +1,24 @@
+import asyncio
+import json
+import multiprocessing
+import os
+import pickle
+import queue
+import signal
+import subprocess
+import sys
+import threading
+import time
 import unittest
+from unittest.mock import Mock, patch
 
-from notify_deps import timestamp_convert
+from kafka import TopicPartition
+from kafka.consumer.fetcher import ConsumerRecord
+
+import notify_deps
+from notify_deps import (timestamp_convert, Coalescer, OffsetTracker, Record, Backpressure,
+                         LRUCache, CircuitBreaker, CircuitOpen, Retrier, Throttled, PermanentError,
+                         DelayQueue, DelayedWork, Deduplicator, FlapSuppressor)
 
 
 class NotifyDeps(unittest.TestCase):
@@ -8,3 +26,982 @@ class NotifyDeps(unittest.TestCase):
     @staticmethod
     def test_now_timestamp():
         assert '2023-10-08 01:02:03 UTC' == timestamp_convert('2023-10-08T01:02:03Z')
+
+
+class TestRecord(unittest.TestCase):
+
+    def test_lazy_value(self):
+        r = Record('t', 1, 2, 'k', b'{"DESTINATION": "a@b.c"}')
+        assert r._value is None
+        assert 'a@b.c' == r.value['DESTINATION']
+        assert r.value is r.value
+        assert {} == Record('t', 1, 2, 'k', None).value
+
+    def test_pickle_raw_value_only(self):
+        r = Record('t', 1, 2, 'k', b'{"a": 1}')
+        assert 1 == r.value['a']
+        r2 = pickle.loads(pickle.dumps(r))
+        assert r2._value is None
+        assert (r.topic, r.partition, r.offset, r.key, r.raw_value) == \
+               (r2.topic, r2.partition, r2.offset, r2.key, r2.raw_value)
+        assert 1 == r2.value['a']
+
+    def test_pickle_timestamps(self):
+        r = Record('t', 1, 2, 'k', b'{}', timestamp=1700000000000, consumed_at=1700000001.5)
+        r2 = pickle.loads(pickle.dumps(r))
+        assert (1700000000000, 1700000001.5) == (r2.timestamp, r2.consumed_at)
+
+
+class TestLatency(unittest.TestCase):
+
+    def test_delivery_delay_from_kafka_timestamp(self):
+        r = Record('t', 1, 2, 'k', b'{"TIMESTAMP": "2023-11-09T10:29:31Z"}',
+                   timestamp=int((time.time() - 5) * 1000))
+        assert 5 <= notify_deps.delivery_delay(r) < 6
+
+    def test_delivery_delay_from_event_timestamp(self):
+        ts = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(time.time() - 60))
+        r = Record('t', 1, 2, 'k', b'{"TIMESTAMP": "%s"}' % ts.encode())
+        assert 59 <= notify_deps.delivery_delay(r) < 62
+        assert notify_deps.delivery_delay(Record('t', 1, 2, 'k', b'{}')) is None
+
+    def test_queue_wait_observed_when_taken_up(self):
+        q = queue.Queue()
+        q.put((0, [Record('t', 0, 0, 'k', b'{}', consumed_at=time.time() - 2)]))
+        with patch.object(notify_deps, 'QUEUE_WAIT') as queue_wait:
+            notify_deps.get_work(q)
+        assert 2 <= queue_wait.observe.call_args.args[0] < 3
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_evict_least_recently_used(self):
+        c = LRUCache(2)
+        c.put('a', 1)
+        c.put('b', 2)
+        assert 1 == c.get('a')
+        c.put('c', 3)
+        assert 'b' not in c
+        assert 1 == c.get('a')
+        assert 3 == c.get('c')
+        assert c.get('b') is None
+        assert 2 == len(c)
+
+    def test_disabled(self):
+        c = LRUCache(0)
+        c.put('a', 1)
+        assert 0 == len(c)
+
+
+class TestCoalescer(unittest.TestCase):
+
+    def test_flush_on_max_items(self):
+        c = Coalescer(window=10, max_items=3)
+        assert [] == c.add('a', 1, now=0)
+        assert [] == c.add('b', 1, now=0)
+        assert [] == c.add('a', 2, now=1)
+        assert [1, 2, 3] == c.add('a', 3, now=2)
+        assert 1 == len(c)
+
+    def test_flush_on_window(self):
+        c = Coalescer(window=10, max_items=100)
+        assert c.timeout() is None
+        c.add('a', 1, now=0)
+        c.add('b', 2, now=5)
+        c.add('a', 3, now=6)
+        assert 4 == c.timeout(now=6)
+        assert [] == c.expired(now=9)
+        assert [('a', [1, 3])] == c.expired(now=10)
+        assert [('b', [2])] == c.expired(now=15)
+        assert c.timeout() is None
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    def test_open_after_threshold(self):
+        breaker = CircuitBreaker('test', threshold=2, reset_timeout=10)
+        breaker.failure('a')
+        breaker.check('a')
+        breaker.failure('a')
+        with self.assertRaises(CircuitOpen) as cm:
+            breaker.check('a')
+        assert 9 < cm.exception.retry_after <= 10
+        breaker.check('b')
+
+    def test_trial_send_after_reset_timeout(self):
+        breaker = CircuitBreaker('test', threshold=1, reset_timeout=0.01)
+        breaker.failure('a')
+        time.sleep(0.01)
+        breaker.check('a')
+        with self.assertRaises(CircuitOpen):
+            breaker.check('a')
+        breaker.success('a')
+        breaker.check('a')
+        assert 0 == breaker.open_for('a')
+
+    def test_disabled(self):
+        breaker = CircuitBreaker('test', threshold=0)
+        for _ in range(10):
+            breaker.failure('a')
+        breaker.check('a')
+
+
+MSG = Record('t', 0, 0, 'k', b'{}')
+
+
+class TestRetrier(unittest.TestCase):
+
+    def test_backoff_until_out_of_attempts(self):
+        retrier = Retrier('test', attempts=3, backoff=1, backoff_max=1.5,
+                          breaker=CircuitBreaker('test', threshold=0))
+        fn = Mock(side_effect=ConnectionError('down'))
+        assert 0 <= retrier.run(MSG, 'a', fn) <= 1
+        assert 0 <= retrier.run(MSG, 'a', fn) <= 1.5
+        with self.assertRaises(ConnectionError):
+            retrier.run(MSG, 'a', fn)
+        assert not retrier._failed
+
+    def test_success_resets_attempts(self):
+        retrier = Retrier('test', attempts=2)
+        fn = Mock(side_effect=[ConnectionError('down'), None])
+        retrier.run(MSG, 'a', fn)
+        assert 0 == retrier.run(MSG, 'a', fn)
+        assert not retrier._failed
+
+    def test_throttled_and_permanent_errors(self):
+        retrier = Retrier('test', attempts=2)
+        assert 7 == retrier.run(MSG, 'a', Mock(side_effect=Throttled(7)))
+        assert 7 == retrier.run(MSG, 'a', Mock(side_effect=Throttled(7)))
+        with self.assertRaises(PermanentError):
+            retrier.run(MSG, 'a', Mock(side_effect=PermanentError('gone')))
+        assert 0 == retrier.breaker.open_for('a')
+
+    def test_throttled_attempts(self):
+        retrier = Retrier('test', attempts=2, throttled_attempts=3)
+        for _ in range(5):
+            assert 1 == retrier.run(MSG, 'a', Mock(side_effect=Throttled(1, rejected=False)))
+        with patch.object(notify_deps, 'dead_letter') as dead_letter:
+            assert 7 == retrier.run(MSG, 'a', Mock(side_effect=Throttled(7)))
+            assert 7 == retrier.run(MSG, 'a', Mock(side_effect=Throttled(7)))
+            with self.assertRaises(Throttled):
+                retrier.run(MSG, 'a', Mock(side_effect=Throttled(7)))
+        assert 3 == dead_letter.call_args[0][3]
+
+    def test_fail_fast_while_circuit_open(self):
+        retrier = Retrier('test', attempts=5,
+                          breaker=CircuitBreaker('test', threshold=1, reset_timeout=60))
+        retrier.run(Record('t', 0, 1, 'k', b'{}'), 'a', Mock(side_effect=ConnectionError('down')))
+        fn = Mock()
+        assert retrier.run(Record('t', 0, 2, 'k', b'{}'), 'a', fn) > 59
+        fn.assert_not_called()
+
+    def test_decoded_consumer_record(self):
+        msg = ConsumerRecord('t', 0, 1, 0, 0, 'key', {'DESTINATION': 'a'}, [], None, -1, -1, -1)
+        retrier = Retrier('test', attempts=2, breaker=CircuitBreaker('test', threshold=0))
+        fn = Mock(side_effect=ConnectionError('down'))
+        with patch.object(notify_deps, 'dead_letter') as dead_letter:
+            assert 0 <= retrier.run(msg, 'a', fn)
+            assert 7 == retrier.run(msg, 'a', Mock(side_effect=Throttled(7)))
+            with self.assertRaises(ConnectionError):
+                retrier.run(msg, 'a', fn)
+        dead_letter.assert_called_once_with(msg, 'test', fn.side_effect, 3)
+
+
+class TestDelayQueue(unittest.TestCase):
+
+    def test_ready_in_order(self):
+        q = DelayQueue()
+        q.push('later', 0.05)
+        q.push('now', 0)
+        assert 'now' == q.pop_ready()
+        assert q.pop_ready() is None
+        assert 0 < q.timeout() <= 0.05
+        time.sleep(0.05)
+        assert 'later' == q.pop_ready()
+        assert q.timeout() is None
+
+
+class TestDelayedWork(unittest.TestCase):
+
+    def test_deferred_returned_once_due(self):
+        workq = queue.Queue()
+        workq.put((0, ['new']))
+        work = DelayedWork(workq)
+        work.defer('retry', 0.02)
+        assert 'new' == work.get()
+        assert work.get(timeout=0.001) is None
+        assert 'retry' == work.get()
+
+    def test_max_deferred(self):
+        workq = queue.Queue()
+        workq.put((0, ['new']))
+        work = DelayedWork(workq, max_deferred=1)
+        work.defer('retry', 0.02)
+        assert 'retry' == work.get()
+        assert 'new' == work.get()
+
+
+class TestOffsetTracker(unittest.TestCase):
+
+    def test_commit_contiguous_acked(self):
+        tp = TopicPartition('t', 0)
+        t = OffsetTracker()
+        for offset in range(10, 15):
+            t.dispatched(tp, offset)
+        assert {} == t.committable()
+        t.acked(tp, 11)
+        t.acked(tp, 12)
+        assert {} == t.committable()
+        t.acked(tp, 10)
+        assert 13 == t.committable()[tp].offset
+        assert {} == t.committable()
+        assert 2 == t.in_flight()
+        t.acked(tp, 14)
+        t.acked(tp, 13)
+        assert 15 == t.committable()[tp].offset
+        assert 0 == t.in_flight()
+
+
+class TestBackpressure(unittest.TestCase):
+
+    def test_pause_resume(self):
+        consumer = FakeConsumer([])
+        bp = Backpressure(high=10, low=5)
+        assert not bp.update(consumer, 9)
+        assert bp.update(consumer, 10)
+        assert consumer.assignment() == consumer.paused()
+        assert bp.update(consumer, 6)
+        assert not bp.update(consumer, 5)
+        assert set() == consumer.paused()
+
+    def test_default_low_watermark(self):
+        assert 50 == Backpressure(100).low
+        assert 0 == Backpressure(1).low
+
+    def test_pause_topic(self):
+        consumer = FakeConsumer([], topics=('t1', 't2'))
+        bp = Backpressure(high=2, topic='t1')
+        assert bp.update(consumer, 2)
+        assert {TopicPartition('t1', 0)} == consumer.paused()
+        assert not bp.update(consumer, 0)
+        assert set() == consumer.paused()
+
+
+class FakeQueue(queue.Queue):
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+
+class TestCommitter(unittest.TestCase):
+
+    def setUp(self):
+        self.acks = FakeQueue()
+        self.committer = notify_deps._Committer(self.acks, multiprocessing.Value('i', 0),
+                                                interval=60)
+        self.committer.consumer = Mock()
+        self.tp = TopicPartition('t', 0)
+        for offset in range(3):
+            self.committer.tracker.dispatched(self.tp, offset)
+
+    def test_batched_commit(self):
+        self.acks.put(('t', 0, 0))
+        self.acks.put(('t', 0, 1))
+        self.committer.maybe_commit()
+        self.committer.consumer.commit.assert_not_called()
+        self.committer._last_commit -= 60
+        self.committer.maybe_commit()
+        offsets = self.committer.consumer.commit.call_args[0][0]
+        assert 2 == offsets[self.tp].offset
+
+    def test_revoke(self):
+        self.acks.put(('t', 0, 0))
+        self.committer.on_partitions_revoked([self.tp])
+        offsets = self.committer.consumer.commit.call_args[0][0]
+        assert 1 == offsets[self.tp].offset
+        assert 0 == self.committer.tracker.in_flight()
+        assert 1 == self.committer.generation.value
+
+
+class TestGetWork(unittest.TestCase):
+
+    def tearDown(self):
+        notify_deps._generation = None
+        notify_deps._chunk.clear()
+
+    def test_skip_messages_dispatched_before_rebalance(self):
+        notify_deps._generation = multiprocessing.Value('i', 1)
+        q = queue.Queue()
+        q.put((0, ['stale']))
+        q.put((1, ['current']))
+        assert 'current' == notify_deps.get_work(q)
+        assert notify_deps.get_work(q, timeout=0.01) is None
+
+    def test_batches_returned_one_by_one(self):
+        q = queue.Queue()
+        q.put((0, ['a', 'b']))
+        q.put((0, ['c']))
+        assert ['a', 'b', 'c'] == [notify_deps.get_work(q) for _ in range(3)]
+        assert q.empty()
+
+    def test_retire_once_done_with_messages(self):
+        notify_deps._retire = multiprocessing.Value('i', 0)
+        notify_deps._outstanding = 0
+        self.addCleanup(setattr, notify_deps, '_retire', None)
+        self.addCleanup(setattr, notify_deps, '_retiring', False)
+        q = queue.Queue()
+        q.put((0, [Record('t', 0, 0, 'k', b'{}')]))
+        msg = notify_deps.get_work(q)
+        notify_deps._retire.value = 1
+        q.put((0, ['next']))
+        assert notify_deps.get_work(q, timeout=0.01) is None
+        assert 0 == notify_deps._retire.value
+        notify_deps.ack(msg)
+        with self.assertRaises(SystemExit):
+            notify_deps.get_work(q)
+        assert not q.empty()
+
+
+class TestChunkDispatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.q = queue.Queue(maxsize=2)
+        self.queued = multiprocessing.Value('l', 0)
+
+    def test_batch_size(self):
+        d = notify_deps._ChunkDispatcher(self.q, self.queued, num_workers=1, batch_size=3)
+        for i in range(7):
+            d.add(i)
+        d.dispatch(5)
+        assert (5, [0, 1, 2]) == self.q.get_nowait()
+        assert (5, [3, 4, 5]) == self.q.get_nowait()
+        assert 1 == len(d)
+        assert 6 == self.queued.value
+        d.dispatch(5)
+        assert (5, [6]) == self.q.get_nowait()
+        assert 0 == len(d)
+
+    def test_spread_across_workers(self):
+        d = notify_deps._ChunkDispatcher(self.q, self.queued, num_workers=2, batch_size=10)
+        for i in range(4):
+            d.add(i)
+        d.dispatch()
+        assert (0, [0, 1]) == self.q.get_nowait()
+        assert (0, [2, 3]) == self.q.get_nowait()
+
+    def test_linger(self):
+        d = notify_deps._ChunkDispatcher(self.q, self.queued, num_workers=1, batch_size=3,
+                                         linger=60)
+        d.add(0)
+        d.dispatch()
+        assert self.q.empty()
+        d._pending_since -= 60
+        d.dispatch()
+        assert (0, [0]) == self.q.get_nowait()
+
+
+class TestKeyDispatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.d = notify_deps._KeyDispatcher('test', maxsize=100, steal_threshold=3)
+        self.slots = [self.d.add_slot(), self.d.add_slot()]
+        self.offset = 0
+
+    def tearDown(self):
+        for slot in self.slots:
+            slot.queue.close()
+
+    def add(self, key):
+        self.offset += 1
+        self.d.add(Record('t', 0, self.offset, key, b'{}'))
+
+    def home(self, key):
+        return self.d.active[hash(key) % 2]
+
+    def other(self, key):
+        return next(s for s in self.slots if s is not self.home(key))
+
+    @staticmethod
+    def take(slot, n):
+        with slot.queued.get_lock():
+            slot.queued.value -= n
+
+    def test_message_key(self):
+        assert 'k' == notify_deps.message_key(Record('t', 0, 0, 'k', b'{"SUBS_ID": "s"}'))
+        assert ('s', 'edge/1') == notify_deps.message_key(
+            Record('t', 0, 0, '', b'{"SUBS_ID": "s", "RESOURCE_URI": "edge/1"}'))
+
+    def test_key_kept_with_worker_until_taken_up(self):
+        slot = self.home('k')
+        for _ in range(5):
+            self.add('k')
+        self.d.dispatch()
+        assert 5 == slot.queued.value
+        # Busier than the other worker, but the key has messages waiting.
+        self.add('k')
+        self.d.dispatch()
+        assert 6 == slot.queued.value
+        assert 0 == self.other('k').queued.value
+        # All its messages taken up, the last one possibly in process.
+        self.take(slot, 6)
+        self.d.dispatch()
+        self.add('k')
+        assert 1 == len(slot.dispatcher)
+
+    def test_idle_worker_takes_over_keys(self):
+        busy = self.home('k')
+        for _ in range(5):
+            self.add('k')
+        key = next(k for k in (f'k{i}' for i in range(100)) if self.home(k) is busy)
+        before = notify_deps.KEYS_REBALANCED.labels('test')._value.get()
+        self.add(key)
+        assert 1 == len(self.other('k').dispatcher)
+        assert before + 1 == notify_deps.KEYS_REBALANCED.labels('test')._value.get()
+
+    def test_draining_worker_takes_no_new_keys(self):
+        slot = self.slots[0]
+        self.d.drain(slot)
+        for i in range(10):
+            self.add(f'k{i}')
+        assert 0 == len(slot.dispatcher)
+        assert [self.slots[1]] == self.d.active
+
+
+class FakeConsumer:
+    """Returns the given batches of records, then interrupts the main loop."""
+
+    def __init__(self, batches, topics=('t',)):
+        self.batches = list(batches)
+        self.topics = topics
+        self.commits = []
+        self.closed = False
+        self._paused = set()
+
+    def assignment(self):
+        return {TopicPartition(t, 0) for t in self.topics}
+
+    def pause(self, *partitions):
+        self._paused.update(partitions)
+
+    def resume(self, *partitions):
+        self._paused.difference_update(partitions)
+
+    def paused(self):
+        return set(self._paused)
+
+    def poll(self, timeout_ms=0, max_records=None):
+        if not self.batches:
+            raise KeyboardInterrupt
+        batch = self.batches.pop(0)
+        if callable(batch):
+            batch = batch()
+        if not batch:
+            time.sleep(0.01)
+        return batch
+
+    def commit(self, offsets):
+        self.commits.append({tp.partition: om.offset for tp, om in offsets.items()})
+
+    def close(self):
+        self.closed = True
+
+
+def consumer_records(topic, partition, offsets):
+    tp = TopicPartition(topic, partition)
+    return {tp: [ConsumerRecord(topic, partition, o, 0, 0, 'key', b'{"offset": %d}' % o,
+                                [], None, 1, 1, -1) for o in offsets]}
+
+
+class TestAsyncEngine(unittest.TestCase):
+
+    def test_concurrent_sends_and_commit(self):
+        consumer = FakeConsumer([consumer_records('t', 0, range(50))] + [{}] * 20)
+        sent = []
+        running = [0, 0]
+
+        async def async_worker(msg):
+            running[0] += 1
+            running[1] = max(running)
+            await asyncio.sleep(0.01)
+            running[0] -= 1
+            sent.append(msg.value['offset'])
+            notify_deps.ack(msg)
+
+        with patch.object(notify_deps, 'kafka_consumer', return_value=consumer):
+            notify_deps.main(None, 't', 'g', engine='asyncio', async_worker=async_worker,
+                             manual_commit=True, max_inflight=10)
+        assert list(range(50)) == sorted(sent)
+        assert 10 == running[1]
+        assert {0: 50} == consumer.commits[-1]
+
+    def test_pending_dropped_on_rebalance(self):
+        tp = TopicPartition('t', 0)
+        listeners = []
+        done = threading.Event()
+
+        def rebalance():
+            # Once done with offset 0, while the next ones wait for a send slot.
+            assert done.wait(5)
+            listeners[0].on_partitions_revoked([tp])
+            listeners[0].on_partitions_assigned([tp])
+            return consumer_records('t', 0, range(1, 4))
+
+        consumer = FakeConsumer([consumer_records('t', 0, range(4)), rebalance] + [{}] * 10)
+        sent = []
+
+        async def async_worker(msg):
+            sent.append(msg.offset)
+            await asyncio.sleep(0)
+            notify_deps.ack(msg)
+            done.set()
+
+        def kafka_consumer(*args, listener=None, **kwargs):
+            listeners.append(listener)
+            return consumer
+
+        with patch.object(notify_deps, 'kafka_consumer', side_effect=kafka_consumer):
+            notify_deps.main(None, 't', 'g', engine='asyncio', async_worker=async_worker,
+                             manual_commit=True, max_inflight=1)
+        assert [0, 1, 2, 3] == sent
+        assert {0: 4} == consumer.commits[-1]
+
+
+def collecting_worker(workq, results):
+    while True:
+        msg = notify_deps.get_work(workq)
+        if msg:
+            results.put(msg.value['offset'])
+            notify_deps.ack(msg)
+
+
+class TestShutdown(unittest.TestCase):
+
+    def test_sigterm_stops_consuming_and_waits_for_sends(self):
+        consumer = FakeConsumer([consumer_records('t', 0, range(10))] + [{}] * 100)
+        sent = []
+
+        async def async_worker(msg):
+            if msg.offset == 0:
+                os.kill(os.getpid(), signal.SIGTERM)
+            await asyncio.sleep(0.01)
+            sent.append(msg.offset)
+            notify_deps.ack(msg)
+
+        with patch.object(notify_deps, 'kafka_consumer', return_value=consumer):
+            notify_deps.main(None, 't', 'g', engine='asyncio', async_worker=async_worker,
+                             manual_commit=True, max_inflight=2)
+        # Messages not sent yet are left to be consumed again.
+        assert [0, 1] == sorted(sent)
+        assert {0: 2} == consumer.commits[-1]
+        assert len(consumer.batches) > 90
+        assert consumer.closed
+        assert signal.getsignal(signal.SIGTERM) == signal.SIG_DFL
+
+    def test_sends_cancelled_after_timeout(self):
+        consumer = FakeConsumer([consumer_records('t', 0, range(3))])
+        cancelled = []
+
+        async def async_worker(msg):
+            try:
+                if msg.offset == 1:
+                    await asyncio.sleep(10)
+                notify_deps.ack(msg)
+            except asyncio.CancelledError:
+                cancelled.append(msg.offset)
+                raise
+
+        started = time.monotonic()
+        with patch.object(notify_deps, 'kafka_consumer', return_value=consumer), \
+                patch.object(notify_deps, 'SHUTDOWN_TIMEOUT', 0.1):
+            notify_deps.main(None, 't', 'g', engine='asyncio', async_worker=async_worker,
+                             manual_commit=True)
+        assert time.monotonic() - started < 5
+        assert [1] == cancelled
+        assert {0: 1} == consumer.commits[-1]
+
+    def test_workers_drained_without_manual_commits(self):
+        consumer = FakeConsumer([consumer_records('t', 0, range(20))])
+        results = multiprocessing.Queue()
+        with patch.object(notify_deps, 'kafka_consumer', return_value=consumer):
+            notify_deps.main(collecting_worker, 't', 'g', initargs=(results,),
+                             num_workers=2, manual_commit=False)
+        assert list(range(20)) == sorted(results.get(timeout=1) for _ in range(20))
+        assert consumer.closed
+
+    def test_lane_shutdown(self):
+        lane = notify_deps._Lane(notify_deps.Channel('c', 't', num_workers=3), False)
+        lane.processes = [Mock(), Mock(), Mock()]
+        lane.shutdown()
+        assert 3 == lane.retire.value
+        assert 0 == lane.workers
+
+        lane = notify_deps._Lane(notify_deps.Channel('c', 't', num_workers=2), False, 'key')
+        slots = [lane.dispatcher.add_slot() for _ in range(2)]
+        lane.shutdown()
+        assert [] == lane.dispatcher.active
+        assert all(s.retiring and s.retire.value == 1 for s in slots)
+
+
+class TestAutoscaler(unittest.TestCase):
+
+    def scaler(self, **kwargs):
+        kwargs = {'interval': 10, 'up_utilization': 0.8, 'down_utilization': 0.3, 'up_lag': 100,
+                  'up_cooldown': 30, 'down_cooldown': 300, **kwargs}
+        return notify_deps.Autoscaler('test', 2, 10, **kwargs)
+
+    def decisions(self, direction, reason):
+        return notify_deps.AUTOSCALE_DECISIONS.labels('test', direction, reason)._value.get()
+
+    def test_scale_up_when_busy_with_backlog(self):
+        scaler = self.scaler()
+        before = self.decisions('up', 'utilization')
+        scaler.observe(1.0, 50)
+        scaler.observe(0.8, 0)
+        assert 4 == scaler.decide(2, lag=0, now=0)
+        scaler.observe(1.0, 50)
+        assert 4 == scaler.decide(4, lag=0, now=29)
+        scaler.observe(1.0, 50)
+        assert 8 == scaler.decide(4, lag=0, now=30)
+        scaler.observe(1.0, 50)
+        assert 10 == scaler.decide(8, lag=0, now=60)
+        assert before + 3 == self.decisions('up', 'utilization')
+
+    def test_scale_up_on_lag(self):
+        scaler = self.scaler()
+        scaler.observe(0.5, 0)
+        assert 2 == scaler.decide(2, lag=199, now=0)
+        scaler.observe(0.5, 0)
+        assert 4 == scaler.decide(2, lag=200, now=10)
+
+    def test_scale_down_one_at_a_time(self):
+        scaler = self.scaler()
+        scaler.observe(0.1, 0)
+        assert 4 == scaler.decide(5, lag=0, now=0)
+        scaler.observe(0.1, 0)
+        assert 4 == scaler.decide(4, lag=0, now=299)
+        scaler.observe(0.1, 0)
+        assert 3 == scaler.decide(4, lag=0, now=300)
+        scaler.observe(0.0, 0)
+        assert 2 == scaler.decide(2, lag=0, now=1000)
+
+    def test_hysteresis(self):
+        scaler = self.scaler()
+        for utilization, backlog, lag in ((0.5, 10, 0), (0.9, 0, 0), (0.1, 1, 0), (0.1, 0, 150)):
+            scaler.observe(utilization, backlog)
+            assert 3 == scaler.decide(3, lag=lag, now=0)
+
+
+class TestChannels(unittest.TestCase):
+
+    def test_records_routed_to_channel_of_topic(self):
+        records = {**consumer_records('t1', 0, range(5)), **consumer_records('t2', 0, range(3))}
+        consumer = FakeConsumer([records] + [{}] * 10, topics=('t1', 't2'))
+        sent = []
+
+        def channel(name, topic, max_inflight):
+            async def async_worker(msg):
+                sent.append((name, msg.value['offset']))
+                notify_deps.ack(msg)
+            return notify_deps.Channel(name, topic, async_worker=async_worker,
+                                       max_inflight=max_inflight)
+
+        with patch.object(notify_deps, 'kafka_consumer', return_value=consumer) as create:
+            notify_deps.run([channel('a', 't1', 2), channel('b', 't2', 1)], 'g',
+                            engine='asyncio')
+        assert ['t1', 't2'] == create.call_args[0][0]
+        assert [('a', o) for o in range(5)] == sorted(m for m in sent if m[0] == 'a')
+        assert [('b', o) for o in range(3)] == sorted(m for m in sent if m[0] == 'b')
+
+    def test_group_id_required_for_several_channels(self):
+        with self.assertRaises(ValueError):
+            notify_deps.run([notify_deps.Channel('a', 't1'), notify_deps.Channel('b', 't2')])
+
+    def test_load_channels(self):
+        slack, = notify_deps.load_channels(['slack'])
+        assert 'NOTIFICATIONS_SLACK_S' == slack.topic
+        assert slack is notify_deps.CHANNELS['slack']
+        with self.assertRaises(ValueError):
+            notify_deps.load_channels(['pigeon'])
+
+
+class TestStartup(unittest.TestCase):
+
+    def tearDown(self):
+        notify_deps._ready = False
+        notify_deps._started_at = None
+
+    def test_consumer_created_while_setting_up(self):
+        def create_consumer():
+            time.sleep(0.2)
+            return 'consumer'
+
+        def setup():
+            time.sleep(0.2)
+            return 'b',
+
+        started = time.monotonic()
+        channels = [notify_deps.Channel('c1', 't1', initargs=('a',), setup=setup),
+                    notify_deps.Channel('c2', 't2', initargs=('c',))]
+        consumer, initargs = notify_deps._start_consumer(create_consumer, channels)
+        assert time.monotonic() - started < 0.35
+        assert 'consumer' == consumer
+        assert [('a', 'b'), ('c',)] == initargs
+        assert notify_deps.STARTUP_SECONDS.labels('consumer')._value.get() >= 0.2
+
+    def test_setup_args_passed_to_async_worker(self):
+        consumer = FakeConsumer([consumer_records('t', 0, range(3))])
+        args = []
+
+        async def async_worker(msg, smtp_params):
+            args.append(smtp_params)
+
+        with patch.object(notify_deps, 'kafka_consumer', return_value=consumer):
+            notify_deps.main(None, 't', 'g', engine='asyncio', async_worker=async_worker,
+                             setup=lambda: ('params',))
+        assert ['params'] * 3 == args
+        assert notify_deps.STARTUP_SECONDS.labels('assignment')._value.get() > 0
+
+    def test_shared_modules_import_no_channel_dependency(self):
+        code = ('import sys, notify_deps, metrics, ratelimit; '
+                'print(sorted({m.split(".")[0] for m in sys.modules} '
+                '& {"jinja2", "pydantic", "paho", "yaml"}))')
+        env = {k: v for k, v in os.environ.items() if k != 'PROMETHEUS_MULTIPROC_DIR'}
+        out = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True,
+                             cwd=os.path.dirname(os.path.realpath(notify_deps.__file__)),
+                             env=env, check=True)
+        assert '[]' == out.stdout.strip()
+
+    def test_worker_ready_on_first_get_work(self):
+        notify_deps._started_at = time.monotonic()
+        ready = notify_deps.WORKERS_READY._value.get()
+        q = queue.Queue()
+        q.put((0, ['a', 'b']))
+        assert 'a' == notify_deps.get_work(q)
+        assert 'b' == notify_deps.get_work(q)
+        assert ready + 1 == notify_deps.WORKERS_READY._value.get()
+
+
+def notification(subs_id='s/1', timestamp='2025-06-11T01:02:03Z', recovery=False):
+    return Mock(value={'SUBS_ID': subs_id, 'RESOURCE_URI': 'nuvlabox/1',
+                       'RECOVERY': recovery, 'TIMESTAMP': timestamp})
+
+
+class TestDeduplicator(unittest.TestCase):
+
+    def test_fingerprint_stable(self):
+        value = {'SUBS_ID': 's/1', 'TIMESTAMP': '2023-11-09T10:29:31Z'}
+        out = subprocess.check_output(
+            [sys.executable, '-c', 'import notify_deps, sys; '
+             f'sys.stdout.write(notify_deps.fingerprint({value!r}).hex())'],
+            cwd=os.path.dirname(os.path.realpath(notify_deps.__file__)),
+            env=dict({k: v for k, v in os.environ.items() if k != 'PROMETHEUS_MULTIPROC_DIR'},
+                     PYTHONHASHSEED='random'))
+        assert notify_deps.fingerprint(value).hex() == out.decode()
+        assert notify_deps.fingerprint(value) != \
+               notify_deps.fingerprint(dict(value, TIMESTAMP='2023-11-09T10:29:32Z'))
+        assert notify_deps.fingerprint({'SUBS_ID': 's/1'}) is None
+
+    def test_duplicates_within_ttl(self):
+        dedup = Deduplicator(ttl=60, capacity=10)
+        hits = notify_deps.DEDUP_LOOKUPS.labels('hit')._value.get()
+        assert not dedup.duplicate(notification())
+        assert dedup.duplicate(notification())
+        assert not dedup.duplicate(notification(recovery=True))
+        assert not dedup.duplicate(notification(timestamp='2025-06-11T01:02:04Z'))
+        assert not dedup.duplicate(notification(subs_id='s/2'))
+        assert hits + 1 == notify_deps.DEDUP_LOOKUPS.labels('hit')._value.get()
+
+    def test_expiry_and_capacity(self):
+        dedup = Deduplicator(ttl=0.05, capacity=2)
+        assert not dedup.duplicate(notification())
+        time.sleep(0.06)
+        assert not dedup.duplicate(notification())
+        dedup.duplicate(notification(subs_id='s/2'))
+        dedup.duplicate(notification(subs_id='s/3'))
+        assert 2 == len(dedup)
+        assert not dedup.duplicate(notification())
+
+    def test_without_identity(self):
+        dedup = Deduplicator(ttl=60, capacity=10)
+        for _ in range(2):
+            assert not dedup.duplicate(Mock(value={'SUBS_ID': 's/1'}))
+            assert not dedup.duplicate(Mock(value={}))
+        assert 0 == len(dedup)
+
+    def test_duplicates_dropped_and_committed(self):
+        value = b'{"SUBS_ID": "s/1", "TIMESTAMP": "2025-06-11T01:02:0%dZ", "offset": %d}'
+        tp = TopicPartition('t', 0)
+        records = {tp: [ConsumerRecord('t', 0, o, 0, 0, 'key', value % (o // 2, o // 2), [], None,
+                                       1, 1, -1) for o in range(10)]}
+        consumer = FakeConsumer([records] + [{}] * 10)
+        sent = []
+
+        async def async_worker(msg):
+            sent.append(msg.value['offset'])
+            notify_deps.ack(msg)
+
+        with patch.object(notify_deps, 'kafka_consumer', return_value=consumer), \
+                patch.object(notify_deps, 'DEDUP_TTL', 60):
+            notify_deps.main(None, 't', 'g', engine='asyncio', async_worker=async_worker,
+                             manual_commit=True)
+        assert [0, 1, 2, 3, 4] == sorted(sent)
+        assert {0: 10} == consumer.commits[-1]
+
+    def test_redelivered_after_rebalance_not_dropped(self):
+        value = b'{"SUBS_ID": "s/1", "TIMESTAMP": "2025-06-11T01:02:0%dZ", "offset": %d}'
+        tp = TopicPartition('t', 0)
+        listeners = []
+
+        def records(offsets):
+            return {tp: [ConsumerRecord('t', 0, o, 0, 0, 'key', value % (o, o), [], None,
+                                        1, 1, -1) for o in offsets]}
+
+        def rebalance():
+            listeners[0].on_partitions_revoked([tp])
+            listeners[0].on_partitions_assigned([tp])
+            return records(range(1, 3))
+
+        consumer = FakeConsumer([records(range(3)), {}, rebalance] + [{}] * 10)
+        sent = []
+
+        async def async_worker(msg):
+            sent.append(msg.offset)
+            # Only the first message is done with before the rebalance.
+            if msg.offset == 0 or sent.count(msg.offset) > 1:
+                notify_deps.ack(msg)
+
+        def kafka_consumer(*args, listener=None, **kwargs):
+            listeners.append(listener)
+            return consumer
+
+        with patch.object(notify_deps, 'kafka_consumer', side_effect=kafka_consumer), \
+                patch.object(notify_deps, 'DEDUP_TTL', 60):
+            notify_deps.main(None, 't', 'g', engine='asyncio', async_worker=async_worker,
+                             manual_commit=True)
+        assert [0, 1, 1, 2, 2] == sorted(sent)
+        assert {0: 3} == consumer.commits[-1]
+
+    def test_forget_redelivered(self):
+        dedup = Deduplicator(ttl=60)
+        msgs = [Record('t', p, o, 'k', b'{"SUBS_ID": "s/1", "TIMESTAMP": "%d"}' % (10 * p + o))
+                for p in range(2) for o in range(3)]
+        assert not any(dedup.duplicate(m) for m in msgs)
+        dedup.forget({TopicPartition('t', 0): 1})
+        assert [False, False, True, True, True, True] == \
+            [dedup.duplicate(m) for m in msgs[1:3] + msgs[:1] + msgs[3:]]
+
+
+def flap_record(offset, recovery, resource='nuvlabox/1'):
+    value = {'SUBS_ID': 's/1', 'RESOURCE_URI': resource, 'RECOVERY': recovery}
+    return Record('t', 0, offset, 'k', json.dumps(value).encode())
+
+
+class TestFlapSuppressor(unittest.TestCase):
+
+    def setUp(self):
+        self.dropped = []
+
+    def suppressor(self, summary=False, capacity=10):
+        return FlapSuppressor(10, capacity, summary,
+                              on_drop=lambda m: self.dropped.append(m.offset))
+
+    def test_alert_and_recovery_dropped(self):
+        flaps = self.suppressor()
+        assert [] == flaps.add(flap_record(0, False), now=0)
+        assert [] == flaps.add(flap_record(1, True), now=1)
+        assert [0, 1] == self.dropped
+        assert [] == flaps.expired(now=20)
+
+    def test_alert_released_after_window(self):
+        flaps = self.suppressor()
+        flaps.add(flap_record(0, False), now=0)
+        other = flap_record(1, True, resource='nuvlabox/2')
+        assert [other] == flaps.add(other, now=1)
+        assert [] == flaps.expired(now=9)
+        released = flaps.expired(now=10)
+        assert [0] == [m.offset for m in released]
+        assert 'FLAPPING' not in released[0].value
+        assert 0 == len(flaps)
+
+    def test_summary(self):
+        flaps = self.suppressor(summary=True)
+        for offset, recovery in enumerate([False, True, False, True]):
+            assert [] == flaps.add(flap_record(offset, recovery), now=offset)
+        assert [0, 1, 2] == self.dropped
+        released, = flaps.expired(now=10)
+        assert 3 == released.offset
+        assert released.value['RECOVERY']
+        assert 2 == released.value['FLAPPING']
+        assert 2 == pickle.loads(pickle.dumps(released)).value['FLAPPING']
+
+    def test_capacity(self):
+        flaps = self.suppressor(capacity=2)
+        flaps.add(flap_record(0, False, 'a'), now=0)
+        flaps.add(flap_record(1, False, 'b'), now=0)
+        assert [0] == [m.offset for m in flaps.add(flap_record(2, False, 'c'), now=0)]
+        assert 2 == len(flaps)
+
+    def test_held_per_topic(self):
+        flaps = self.suppressor(summary=True)
+        flaps.add(flap_record(0, False, 'a'), now=0)
+        flaps.add(flap_record(1, True, 'a'), now=0)
+        flaps.add(flap_record(2, False, 'b'), now=0)
+        assert 2 == flaps.held('t') == flaps.held()
+        assert 0 == flaps.held('other')
+        flaps.expired(now=10)
+        assert 0 == flaps.held('t')
+
+    def test_held_alerts_do_not_pause_consumer(self):
+        tp = TopicPartition('t', 0)
+        records = {tp: [ConsumerRecord('t', 0, o, 0, 0, 'key', json.dumps(
+            {'SUBS_ID': 's/1', 'RESOURCE_URI': f'nuvlabox/{o}', 'RECOVERY': False}).encode(),
+            [], None, 1, 1, -1) for o in range(150)]}
+        consumer = FakeConsumer([records] + [{}] * 5)
+        consumer.pause = Mock()
+        with patch.object(notify_deps, 'kafka_consumer', return_value=consumer), \
+                patch.object(notify_deps, 'FLAP_WINDOW', 60):
+            notify_deps.main(collecting_worker, 't', 'g', initargs=(multiprocessing.Queue(),),
+                             num_workers=1, manual_commit=True, queue_maxsize=100)
+        consumer.pause.assert_not_called()
+
+
+class TestDeadLetterQueue(unittest.TestCase):
+
+    def test_headers(self):
+        msg = Record('NOTIFICATIONS_EMAIL_S', 1, 42, 'key', b'{}')
+        headers = dict(notify_deps.DeadLetterQueue.headers(msg, 'email', ValueError('bad'), 3))
+        assert b'NOTIFICATIONS_EMAIL_S' == headers['dlq-topic']
+        assert b'42' == headers['dlq-offset']
+        assert b'email' == headers['dlq-channel']
+        assert b'ValueError' == headers['dlq-error-type']
+        assert b'bad' == headers['dlq-error']
+        assert b'3' == headers['dlq-attempts']
+
+    def test_dead_lettered_when_out_of_attempts(self):
+        dlq = Mock()
+        msg = Record('t', 0, 1, 'key', b'{}')
+        retrier = Retrier('test', attempts=2, breaker=CircuitBreaker('test', threshold=0))
+        fn = Mock(side_effect=ConnectionError('down'))
+        with patch.object(notify_deps, 'dead_letter_queue', return_value=dlq):
+            retrier.run(msg, 'a', fn)
+            dlq.publish.assert_not_called()
+            with self.assertRaises(ConnectionError):
+                retrier.run(msg, 'a', fn)
+        dlq.publish.assert_called_once_with(msg, 'test', fn.side_effect, 2)
+
+    def test_flushed_on_worker_exit(self):
+        flushed = multiprocessing.Queue()
+
+        def retired_worker():
+            notify_deps.dead_letter(Record('t', 0, 1, 'key', b'{}'), 'test', ValueError('bad'))
+            notify_deps._retired()
+
+        dlq = Mock()
+        dlq.return_value.flush.side_effect = flushed.put
+        with patch.object(notify_deps, 'KAFKA_DLQ_TOPIC', 'dlq'), \
+                patch.object(notify_deps, 'DeadLetterQueue', dlq):
+            p = multiprocessing.get_context('fork').Process(target=retired_worker)
+            p.start()
+            p.join()
+        assert 0 == p.exitcode
+        assert 10 == flushed.get(timeout=1)
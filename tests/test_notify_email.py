@@ -1,6 +1,8 @@
+import multiprocessing
 import os
+import smtplib
 import unittest
-from unittest.mock import Mock
+from unittest.mock import Mock, patch
 import shutil
 from prometheus_client import multiprocess
 
@@ -14,7 +16,9 @@ shutil.rmtree = Mock()
 
 multiprocess.MultiProcessCollector = Mock()
 import notify_email
-from notify_email import get_recipients, html_content, email_template
+from notify_email import (get_recipients, html_content, email_template,
+                          digest_html_content, digest_subject)
+from notify_deps import Record
 
 notify_email.EMAIL_TEMPLATES['default'] = email_template(
     os.path.join('src', notify_email.EMAIL_TEMPLATE_DEFAULT_FILE))
@@ -22,6 +26,9 @@ notify_email.EMAIL_TEMPLATES['default'] = email_template(
 notify_email.EMAIL_TEMPLATES['app-pub'] = email_template(
     os.path.join('src', notify_email.EMAIL_TEMPLATE_APP_PUB_FILE))
 
+notify_email.EMAIL_TEMPLATES['digest'] = email_template(
+    os.path.join('src', notify_email.EMAIL_TEMPLATE_DIGEST_FILE))
+
 
 class NotifyEmail(unittest.TestCase):
 
@@ -46,6 +53,41 @@ class NotifyEmail(unittest.TestCase):
         assert 'Condition' in html
         assert 'Value' in html
 
+    def test_html_content_flapping(self):
+        msg = {'SUBS_NAME': 'NE offline', 'RECOVERY': True, 'FLAPPING': 2,
+               'TIMESTAMP': '2023-11-09T10:29:31Z'}
+        html = html_content(msg)
+        assert '[Flapping] NE offline' in html
+        assert 'nuvla-alert-ok.png' in html
+
+    def test_render_cache(self):
+        msg = {'SUBS_NAME': 'NE offline',
+               'RESOURCE_URI': 'edge/1',
+               'TIMESTAMP': '2023-11-09T10:29:31Z'}
+        hits = notify_email.RENDER_CACHE_HITS.labels('default')
+        before = hits._value.get()
+        html = html_content({**msg, 'DESTINATION': 'a@b.c'})
+        assert html == html_content({**msg, 'DESTINATION': 'd@e.f'})
+        assert before + 1 == hits._value.get()
+        assert html != html_content({**msg, 'RESOURCE_URI': 'edge/2'})
+
+    def test_digest_html_content(self):
+        msgs = [{'SUBS_NAME': 'NE offline',
+                 'RESOURCE_URI': f'edge/{i}',
+                 'RESOURCE_NAME': f'ne-{i}',
+                 'TIMESTAMP': '2023-11-09T10:29:31Z'} for i in range(3)]
+        msgs.append({'SUBS_NAME': 'CPU load',
+                     'CONDITION': '>',
+                     'VALUE': '95',
+                     'TIMESTAMP': '2023-11-09T10:29:31Z'})
+        assert '4 notifications: NE offline, CPU load' == digest_subject(msgs)
+        html = digest_html_content(msgs)
+        for i in range(3):
+            assert f'>ne-{i}</a>' in html
+        assert 3 == html.count('[Alert] NE offline')
+        assert 1 == html.count('<p><b>Condition</b></p>')
+        assert 'nuvla-alert-nok.png' in html
+
     def test_AppAppBqPublishedDeploymentGroupUpdateNotification(self):
 
         affected_dpl_grp = 'affected deployment group name'
@@ -119,6 +161,67 @@ def _load_smtp_params() -> xoauth2_client.SMTPParams:
     return notify_email.load_smtp_params()
 
 
+class TestSend(unittest.TestCase):
+
+    msg = Mock(value={'DESTINATION': 'a@b.c', 'SUBS_NAME': 'foo',
+                      'TIMESTAMP': '2023-11-09T10:29:31Z'}, timestamp=None)
+
+    def test_single_attempt_then_retry(self):
+        smtp_client = Mock(email='retry@b.c')
+        smtp_client.send_email.side_effect = smtplib.SMTPServerDisconnected()
+        assert notify_email.process_message(smtp_client, self.msg) > 0
+        smtp_client.send_email.assert_called_once()
+
+        smtp_client.send_email.side_effect = None
+        assert 0 == notify_email.process_message(smtp_client, self.msg)
+        assert not notify_email.retrier._failed
+
+    def test_recipients_refused_not_retried(self):
+        smtp_client = Mock(email='refused@b.c')
+        smtp_client.send_email.side_effect = smtplib.SMTPRecipientsRefused({'a@b.c': (550, b'')})
+        with patch('notify_deps.dead_letter') as dead_letter:
+            assert 0 == notify_email.process_message(smtp_client, self.msg)
+        dead_letter.assert_called_once()
+        smtp_client.send_email.assert_called_once()
+
+    def test_transient_4xx_retried_without_blocking_account(self):
+        smtp_client = Mock(email='transient@b.c')
+        smtp_client.send_email.side_effect = smtplib.SMTPDataError(451, b'4.3.0 Try again later')
+        assert 0 < notify_email.process_message(smtp_client, self.msg) < \
+            notify_email.EMAIL_QUOTA_BACKOFF
+        assert 0 == notify_email.limiter.acquire('transient@b.c')
+        notify_email.retrier.done(self.msg)
+
+    def test_quota_exceeded_throttles_account(self):
+        smtp_client = Mock(email='quota@b.c')
+        smtp_client.send_email.side_effect = smtplib.SMTPDataError(
+            550, b'5.4.5 Daily user sending quota exceeded.')
+        assert notify_email.EMAIL_QUOTA_BACKOFF == \
+               notify_email.process_message(smtp_client, self.msg)
+        smtp_client.send_email.reset_mock()
+        assert notify_email.process_message(smtp_client, self.msg) > 0
+        smtp_client.send_email.assert_not_called()
+
+    def test_quota_exceeded_throttles_account_in_all_workers(self):
+        smtp_client = Mock(email='shared-quota@b.c')
+        smtp_client.send_email.side_effect = smtplib.SMTPDataError(452, b'4.5.3 Too many emails')
+        child = multiprocessing.get_context('fork').Process(
+            target=notify_email.process_message, args=(smtp_client, self.msg))
+        child.start()
+        child.join()
+        assert notify_email.limiter.acquire('shared-quota@b.c') > 0
+        assert 0 == notify_email.limiter.acquire('other@b.c')
+
+    def test_undecodable_dead_lettered(self):
+        smtp_client = Mock(email='undecodable@b.c')
+        msg = Record('t', 0, 0, 'k', b'not json')
+        with patch('notify_deps.dead_letter') as dead_letter:
+            assert 0 == notify_email.process_message(smtp_client, msg)
+        dead_letter.assert_called_once()
+        assert msg.raw_value == dead_letter.call_args[0][0].raw_value
+        smtp_client.send_email.assert_not_called()
+
+
 class TestSMTPParams(unittest.TestCase):
 
     fn = 'test_smtp_config.yaml'
@@ -173,7 +276,6 @@ class TestSMTPClient(unittest.TestCase):
 
     def setUp(self):
         notify_email.SMTP_PARAMS = None
-        xoauth2_client.XOAuth2SMTPClientGoogle._refresh_token_now = Mock()
 
     def tearDown(self):
         notify_email.get_smtp_config_from_nuvla = _get_smtp_config_from_nuvla
@@ -0,0 +1,136 @@
+import unittest
+import os
+from unittest.mock import Mock, patch
+import shutil
+from prometheus_client import multiprocess
+
+os.environ['PROMETHEUS_MULTIPROC_DIR'] = ''
+os.path.exists = Mock(return_value=True)
+os.mkdir = Mock()
+shutil.rmtree = Mock()
+
+multiprocess.MultiProcessCollector = Mock()
+
+import notify_mqtt
+from notify_mqtt import BrokerConnectionPool, extract_destination
+from notify_deps import Record
+
+
+def _mqtt_client(*args, **kwargs):
+    client = Mock()
+    mids = iter(range(1, 1000))
+
+    def publish(*args, **kwargs):
+        return Mock(rc=notify_mqtt.mqtt.MQTT_ERR_SUCCESS, mid=next(mids))
+    client.publish.side_effect = publish
+    return client
+
+
+class TestBrokerConnectionPool(unittest.TestCase):
+
+    def setUp(self):
+        self.patcher = patch.object(notify_mqtt.mqtt, 'Client', side_effect=_mqtt_client)
+        self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+
+    def test_extract_destination(self):
+        assert ('broker', 1883, 'a/b') == extract_destination('broker/a/b')
+        assert ('broker', 8883, 'a') == extract_destination('broker:8883/a')
+
+    def test_connection_reused(self):
+        pool = BrokerConnectionPool(max_size=2, idle_timeout=60)
+        c1 = pool.get('a', 1883)
+        assert c1 is pool.get('a', 1883)
+        assert c1 is not pool.get('a', 1884)
+        assert 2 == len(pool)
+
+    def test_lru_eviction(self):
+        pool = BrokerConnectionPool(max_size=2, idle_timeout=60)
+        a = pool.get('a', 1883)
+        b = pool.get('b', 1883)
+        pool.get('a', 1883)
+        pool.get('c', 1883)
+        assert 2 == len(pool)
+        b.client.disconnect.assert_called_once()
+        a.client.disconnect.assert_not_called()
+
+    def test_idle_eviction(self):
+        pool = BrokerConnectionPool(max_size=2, idle_timeout=60)
+        a = pool.get('a', 1883)
+        pool.evict_idle()
+        assert 1 == len(pool)
+        a.last_used -= 61
+        pool.evict_idle()
+        assert 0 == len(pool)
+
+    def test_publish_acknowledged(self):
+        conn = BrokerConnectionPool().get('a', 1883)
+        on_done = Mock()
+        conn.publish('topic', 'payload', on_done)
+        assert 1 == conn.inflight()
+        on_done.assert_not_called()
+        conn._on_publish(conn.client, None, 1, Mock(is_failure=False), None)
+        on_done.assert_called_once_with(None)
+        assert 0 == conn.inflight()
+
+    def test_publish_window_full(self):
+        with patch.object(notify_mqtt, 'MQTT_MAX_INFLIGHT', 1), \
+                patch.object(notify_mqtt, 'MQTT_PUBLISH_TIMEOUT', 0.01):
+            conn = BrokerConnectionPool().get('a', 1883)
+            conn.publish('topic', 'payload', Mock())
+            with self.assertRaises(TimeoutError):
+                conn.publish('topic', 'payload', Mock())
+
+    def test_pending_failed_on_close(self):
+        conn = BrokerConnectionPool().get('a', 1883)
+        on_done = Mock()
+        conn.publish('topic', 'payload', on_done)
+        conn.close()
+        error, = on_done.call_args[0]
+        assert isinstance(error, ConnectionError)
+
+
+class TestRetry(unittest.TestCase):
+
+    def test_failed_publish_retried(self):
+        msg = Mock(value={'DESTINATION': 'broker:1883/topic', 'SUBS_NAME': 'foo'})
+        retry = Mock()
+        with patch.object(notify_mqtt, 'send_message', side_effect=ConnectionError('down')), \
+                patch.object(notify_mqtt, 'ack') as ack:
+            notify_mqtt.process_message(msg, retry)
+            retry.assert_called_once()
+            ack.assert_not_called()
+
+            notify_mqtt.retrier.done(msg)
+            notify_mqtt.process_message(msg)
+            ack.assert_called_once_with(msg)
+
+    def test_undecodable_dead_lettered(self):
+        msg = Record('t', 0, 0, 'k', b'not json')
+        with patch.object(notify_mqtt, 'send_message') as send_message, \
+                patch.object(notify_mqtt, 'ack') as ack, \
+                patch('notify_deps.dead_letter') as dead_letter:
+            notify_mqtt.process_message(msg, Mock())
+        ack.assert_called_once_with(msg)
+        dead_letter.assert_called_once()
+        send_message.assert_not_called()
+
+    def test_missing_destination_dead_lettered(self):
+        msg = Record('t', 0, 0, 'k', b'{"NAME": "foo"}')
+        with patch.object(notify_mqtt, 'send_message') as send_message, \
+                patch.object(notify_mqtt, 'ack') as ack, \
+                patch('notify_deps.dead_letter') as dead_letter:
+            notify_mqtt.process_message(msg, Mock())
+        ack.assert_called_once_with(msg)
+        assert 'Missing DESTINATION' == str(dead_letter.call_args[0][2])
+        send_message.assert_not_called()
+
+    def test_sent_without_subscription_name(self):
+        msg = Record('t', 0, 0, 'k', b'{"DESTINATION": "broker:1883/topic"}')
+        with patch.object(notify_mqtt, 'send_message') as send_message, \
+                patch('notify_deps.dead_letter') as dead_letter:
+            notify_mqtt.process_message(msg, Mock())
+        send_message.assert_called_once()
+        dead_letter.assert_not_called()
@@ -1,6 +1,8 @@
+import asyncio
+import json
 import unittest
 import os
-from unittest.mock import Mock
+from unittest.mock import Mock, patch
 import shutil
 from prometheus_client import multiprocess
 
@@ -11,7 +13,9 @@ shutil.rmtree = Mock()
 
 multiprocess.MultiProcessCollector = Mock()
 
-from notify_slack import now_timestamp, message_content
+import notify_slack
+from notify_slack import now_timestamp, message_content, http_session
+from notify_deps import Record
 
 
 class NotifyEmail(unittest.TestCase):
@@ -32,3 +36,123 @@ class NotifyEmail(unittest.TestCase):
         fields = message_content(msg)['attachments'][0]['fields']
         assert 0 == len(list(filter(
             lambda x: x['title'] in ['Criteria', 'Value'], fields)))
+
+
+class TestHTTPSession(unittest.TestCase):
+
+    def test_session_per_webhook_host(self):
+        s1 = http_session('https://hooks.slack.com/services/a')
+        s2 = http_session('https://hooks.slack.com/services/b')
+        s3 = http_session('https://example.com/hook')
+        assert s1 is s2
+        assert s1 is not s3
+
+    def test_send_message_timeouts(self):
+        dest = 'https://hooks.slack.com/services/a'
+        session = http_session(dest)
+        post = session.post
+        session.post = Mock()
+        try:
+            notify_slack.send_message(dest, {'text': 'foo'})
+            _, kwargs = session.post.call_args
+            assert kwargs['timeout'] == (notify_slack.SLACK_CONNECT_TIMEOUT,
+                                         notify_slack.SLACK_READ_TIMEOUT)
+        finally:
+            session.post = post
+
+
+class TestRateLimit(unittest.TestCase):
+
+    def test_retry_after_blocks_webhook(self):
+        dest = 'https://hooks.slack.com/services/throttled'
+        msg = Mock(value={'DESTINATION': dest, 'SUBS_NAME': 'foo',
+                          'TIMESTAMP': '2023-11-09T10:29:31Z'})
+        resp = Mock(status_code=429, ok=False, headers={'Retry-After': '20'})
+        send_message = notify_slack.send_message
+        notify_slack.send_message = Mock(return_value=resp)
+        try:
+            assert 20 == notify_slack.process_message(msg)
+            assert notify_slack.limiter.acquire(dest) > 19
+        finally:
+            notify_slack.send_message = send_message
+
+
+def slack_msg(dest, offset, **params):
+    value = {'DESTINATION': dest, 'SUBS_NAME': f'subs {offset % 2}',
+             'TIMESTAMP': '2023-11-09T10:29:31Z', **params}
+    return Record('t', 0, offset, 'k', json.dumps(value).encode())
+
+
+class TestBatch(unittest.TestCase):
+
+    def setUp(self):
+        send_message = notify_slack.send_message
+        self.addCleanup(setattr, notify_slack, 'send_message', send_message)
+        notify_slack.send_message = Mock(return_value=Mock(status_code=200, ok=True))
+
+    def test_single_payload_with_summary(self):
+        dest = 'https://hooks.slack.com/services/batch'
+        msgs = [slack_msg(dest, i, RECOVERY=i == 2) for i in range(3)]
+        assert [] == notify_slack.process_batch(dest, msgs)
+        notify_slack.send_message.assert_called_once()
+        payload = notify_slack.send_message.call_args[0][1]
+        assert 3 == len(payload['attachments'])
+        assert '*3 notifications* (2 alerts, 1 recoveries): subs 0, subs 1' == payload['text']
+
+    def test_single_message_without_summary(self):
+        dest = 'https://hooks.slack.com/services/batch-single'
+        [(msgs, payload)] = notify_slack.batch_payloads(dest, [slack_msg(dest, 0)])
+        assert 'text' not in payload
+        assert 1 == len(payload['attachments'])
+
+    def test_split_on_max_bytes(self):
+        dest = 'https://hooks.slack.com/services/batch-split'
+        msgs = [slack_msg(dest, i) for i in range(10)]
+        size = len(json.dumps(message_content(msgs[0].value)))
+        max_bytes = notify_slack.SLACK_BATCH_MAX_BYTES
+        notify_slack.SLACK_BATCH_MAX_BYTES = 4 * size
+        try:
+            payloads = notify_slack.batch_payloads(dest, msgs)
+        finally:
+            notify_slack.SLACK_BATCH_MAX_BYTES = max_bytes
+        assert msgs == [m for chunk, _ in payloads for m in chunk]
+        assert len(payloads) > 2
+        assert all(len(json.dumps(p)) <= 4 * size for _, p in payloads)
+
+    def test_retry_whole_batch(self):
+        dest = 'https://hooks.slack.com/services/batch-retry'
+        notify_slack.send_message.return_value = Mock(status_code=500, ok=False, text='error')
+        msgs = [slack_msg(dest, i) for i in range(3)]
+        retries = notify_slack.process_batch(dest, msgs)
+        assert msgs == [m for m, _ in retries]
+        assert all(delay > 0 for _, delay in retries)
+
+    def test_rate_limited_per_batch(self):
+        dest = 'https://hooks.slack.com/services/batch-rate'
+        for _ in range(5):
+            notify_slack.limiter.acquire(dest)
+        retries = notify_slack.process_batch(dest, [slack_msg(dest, i) for i in range(3)])
+        assert 3 == len(retries)
+        notify_slack.send_message.assert_not_called()
+
+
+class TestMalformed(unittest.TestCase):
+
+    msg = Record('t', 0, 0, 'k', b'{"SUBS_NAME": "foo"}')
+
+    def test_missing_destination_dead_lettered(self):
+        with patch.object(notify_slack, 'send_message') as send_message, \
+                patch('notify_deps.dead_letter') as dead_letter:
+            assert 0 == notify_slack.process_message(self.msg)
+        assert 'Missing DESTINATION' == str(dead_letter.call_args[0][2])
+        send_message.assert_not_called()
+
+    def test_async_missing_destination_dead_lettered_and_acked(self):
+        self.addCleanup(setattr, notify_slack, '_async_inflight', None)
+        with patch.object(notify_slack, 'send_message') as send_message, \
+                patch.object(notify_slack, 'ack') as ack, \
+                patch('notify_deps.dead_letter') as dead_letter:
+            asyncio.run(notify_slack.async_worker(self.msg))
+        ack.assert_called_once_with(self.msg)
+        dead_letter.assert_called_once()
+        send_message.assert_not_called()
@@ -0,0 +1,90 @@
+import multiprocessing
+import queue
+import unittest
+
+from ratelimit import TokenBucket, RateLimiter, SharedRateLimiter, ThrottledWork, retry_after
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    def test_burst_then_rate(self):
+        bucket = TokenBucket(rate=2, burst=3, now=0)
+        assert [0, 0, 0] == [bucket.delay(0) for _ in range(3)]
+        assert 0.5 == bucket.delay(0)
+        assert 0 == bucket.delay(0.5)
+        assert 0.5 == bucket.delay(0.5)
+
+    def test_refill_capped_by_burst(self):
+        bucket = TokenBucket(rate=1, burst=2, now=0)
+        bucket.delay(0)
+        bucket.delay(0)
+        assert [0, 0] == [bucket.delay(100) for _ in range(2)]
+        assert bucket.delay(100) > 0
+
+
+class TestRateLimiter(unittest.TestCase):
+
+    def test_per_destination(self):
+        limiter = RateLimiter('test', rate=1, burst=1)
+        assert 0 == limiter.acquire('a')
+        assert limiter.acquire('a') > 0
+        assert 0 == limiter.acquire('b')
+
+    def test_disabled(self):
+        limiter = RateLimiter('test', rate=0)
+        assert all(0 == limiter.acquire('a') for _ in range(100))
+
+    def test_block(self):
+        limiter = RateLimiter('test', rate=0)
+        limiter.block('a', 10)
+        assert 9 < limiter.acquire('a') <= 10
+        assert 0 == limiter.acquire('b')
+
+    def test_max_destinations(self):
+        limiter = RateLimiter('test', rate=1, max_destinations=2)
+        for dest in 'abc':
+            limiter.acquire(dest)
+        assert ['b', 'c'] == list(limiter._buckets)
+
+    def test_retry_after(self):
+        assert 12 == retry_after({'Retry-After': '12'}, 30)
+        assert 30 == retry_after({}, 30)
+        assert 30 == retry_after({'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'}, 30)
+
+
+class TestSharedRateLimiter(unittest.TestCase):
+
+    def test_shared_across_processes(self):
+        limiter = SharedRateLimiter('test', rate=0.01, burst=2)
+        child = multiprocessing.get_context('fork').Process(
+            target=lambda: [limiter.acquire('a') for _ in range(2)])
+        child.start()
+        child.join()
+        assert limiter.acquire('a') > 0
+        assert 0 == limiter.acquire('b')
+
+    def test_block_shared_across_processes(self):
+        limiter = SharedRateLimiter('test', rate=0)
+        child = multiprocessing.get_context('fork').Process(target=limiter.block, args=('a', 10))
+        child.start()
+        child.join()
+        assert 9 < limiter.acquire('a') <= 10
+        assert 0 == limiter.acquire('b')
+
+
+class TestThrottledWork(unittest.TestCase):
+
+    def test_throttled_destination_does_not_block_others(self):
+        workq = queue.Queue()
+        for item in [('slow', 1), ('slow', 2), ('fast', 3)]:
+            workq.put((0, [item]))
+        limiter = RateLimiter('test', rate=20, burst=1)
+        work = ThrottledWork(workq, limiter, lambda m: m[0])
+        assert ('slow', 1) == work.get()
+        assert ('fast', 3) == work.get()
+        assert 1 == len(work.deferred)
+        assert ('slow', 2) == work.get()
+
+    def test_timeout(self):
+        work = ThrottledWork(queue.Queue(), RateLimiter('test', rate=0), lambda m: m)
+        assert work.get(timeout=0.01) is None
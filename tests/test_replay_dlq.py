@@ -0,0 +1,45 @@
+import unittest
+from unittest.mock import Mock, patch
+
+from kafka import TopicPartition
+from kafka.consumer.fetcher import ConsumerRecord
+
+import replay_dlq
+from ratelimit import RateLimiter
+
+
+def dlq_record(offset, channel, topic='NOTIFICATIONS_EMAIL_S'):
+    headers = [('dlq-topic', topic.encode()), ('dlq-channel', channel.encode())]
+    return ConsumerRecord('DLQ', 0, offset, 0, 0, 'key', b'{"i": %d}' % offset, headers,
+                          None, 1, 1, -1)
+
+
+class TestReplay(unittest.TestCase):
+
+    def setUp(self):
+        tp = TopicPartition('DLQ', 0)
+        self.consumer = Mock()
+        self.consumer.poll.side_effect = [
+            {tp: [dlq_record(0, 'email'), dlq_record(1, 'slack', 'NOTIFICATIONS_SLACK_S'),
+                  dlq_record(2, 'email')]},
+            {}]
+        self.producer = Mock()
+        self.limiter = RateLimiter('test', rate=0)
+
+    def test_replay_to_original_topics(self):
+        with patch.object(replay_dlq, 'REPLAY_IDLE_TIMEOUT', 1):
+            assert 3 == replay_dlq.replay(self.consumer, self.producer, self.limiter)
+        topics = [c.args[0] for c in self.producer.send.call_args_list]
+        assert ['NOTIFICATIONS_EMAIL_S', 'NOTIFICATIONS_SLACK_S', 'NOTIFICATIONS_EMAIL_S'] == topics
+        offsets = self.consumer.commit.call_args.args[0]
+        assert 3 == offsets[TopicPartition('DLQ', 0)].offset
+
+    def test_replay_channel_and_max_messages(self):
+        with patch.object(replay_dlq, 'REPLAY_CHANNEL', 'email'), \
+                patch.object(replay_dlq, 'REPLAY_MAX_MESSAGES', 1):
+            assert 1 == replay_dlq.replay(self.consumer, self.producer, self.limiter)
+        self.producer.send.assert_called_once_with(
+            'NOTIFICATIONS_EMAIL_S', value=b'{"i": 0}', key=b'key')
+        # The message not replayed yet is consumed again by the next replay.
+        offsets = self.consumer.commit.call_args.args[0]
+        assert 1 == offsets[TopicPartition('DLQ', 0)].offset
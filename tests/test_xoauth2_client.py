@@ -0,0 +1,158 @@
+import os
+import smtplib
+import tempfile
+import threading
+import time
+import unittest
+import uuid
+from unittest.mock import Mock, patch
+
+import xoauth2_client
+from xoauth2_client import (SMTPParamsGoogle, SharedTokenCache, TokenRefresher,
+                            XOAuth2SMTPClientGoogle)
+
+SMTP_CONFIG = {
+    "smtp-port": 465,
+    "smtp-host": "smtp.gmail.com",
+    "smtp-username": "mailer@sixsq.com",
+    "smtp-xoauth2": "google",
+    "smtp-keepalive-interval": 60,
+    "smtp-idle-timeout": 300,
+    "smtp-xoauth2-config": {
+        "client-id": "client-id",
+        "client-secret": "client-secret",
+        "refresh-token": "refresh-token"
+    }
+}
+
+
+def _smtp_server():
+    server = Mock()
+    server.docmd.return_value = (235, b'Accepted')
+    server.noop.return_value = (250, b'OK')
+    return server
+
+
+class TestSMTPSession(unittest.TestCase):
+
+    def setUp(self):
+        self.client = XOAuth2SMTPClientGoogle(SMTPParamsGoogle(**SMTP_CONFIG))
+        self.client._access_token = 'token-1'
+        self.client._token_expires_at = time.time() + 3600
+        self.smtp_ssl = patch.object(xoauth2_client.smtplib, 'SMTP_SSL',
+                                     side_effect=lambda *a, **kw: _smtp_server())
+        self.smtp_ssl.start()
+
+    def tearDown(self):
+        self.smtp_ssl.stop()
+
+    def _send(self):
+        self.client.send_email(['a@b.c'], 'subject', '<p>html</p>')
+
+    def test_session_reused(self):
+        for _ in range(3):
+            self._send()
+        assert xoauth2_client.smtplib.SMTP_SSL.call_count == 1
+        assert self.client._server.sendmail.call_count == 3
+        assert self.client._server.docmd.call_count == 1
+
+    def test_reconnect_on_token_rotation(self):
+        self._send()
+        self.client._access_token = 'token-2'
+        self._send()
+        assert xoauth2_client.smtplib.SMTP_SSL.call_count == 2
+        assert self.client._server_token == 'token-2'
+
+    def test_reconnect_on_idle_timeout(self):
+        self._send()
+        self.client._last_used -= self.client.idle_timeout + 1
+        self._send()
+        assert xoauth2_client.smtplib.SMTP_SSL.call_count == 2
+
+    def test_keepalive_probe(self):
+        self._send()
+        server = self.client._server
+        self.client._last_used -= self.client.keepalive_interval + 1
+        self._send()
+        server.noop.assert_called_once()
+        assert self.client._server is server
+
+        server.noop.side_effect = smtplib.SMTPServerDisconnected()
+        self.client._last_used -= self.client.keepalive_interval + 1
+        self._send()
+        assert self.client._server is not server
+
+    def test_reconnect_when_dropped_during_send(self):
+        self._send()
+        self.client._server.sendmail.side_effect = smtplib.SMTPServerDisconnected()
+        self._send()
+        assert xoauth2_client.smtplib.SMTP_SSL.call_count == 2
+        self.client._server.sendmail.assert_called_once()
+
+    def test_auth_failure(self):
+        xoauth2_client.smtplib.SMTP_SSL.side_effect = None
+        server = _smtp_server()
+        server.docmd.return_value = (535, b'Invalid credentials')
+        xoauth2_client.smtplib.SMTP_SSL.return_value = server
+        with self.assertRaises(smtplib.SMTPAuthenticationError):
+            self._send()
+        assert self.client._server is None
+        server.close.assert_called()
+
+
+class TestSharedTokenCache(unittest.TestCase):
+
+    def setUp(self):
+        self.path = os.path.join(tempfile.gettempdir(), f'test-token-{uuid.uuid4().hex}.json')
+        self.fetches = 0
+
+    def tearDown(self):
+        for path in (self.path, self.path + '.lock'):
+            if os.path.isfile(path):
+                os.unlink(path)
+
+    def fetch(self):
+        self.fetches += 1
+        time.sleep(0.01)
+        return f'token-{self.fetches}', 3600
+
+    def test_fetched_once_across_caches(self):
+        caches = [SharedTokenCache(self.path, self.fetch) for _ in range(8)]
+        threads = [threading.Thread(target=c.get) for c in caches]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert self.fetches == 1
+        assert caches[3].get()[0] == 'token-1'
+        assert oct(os.stat(self.path).st_mode & 0o777) == oct(0o600)
+
+    def test_refresh_ahead_of_expiry(self):
+        cache = SharedTokenCache(self.path, self.fetch)
+        _, expires_at = cache.get()
+        assert cache.get(min_ttl=60)[0] == 'token-1'
+        assert cache.get(min_ttl=3600)[0] == 'token-2'
+        assert cache.read()[1] >= expires_at
+
+    def test_client_reads_token_without_fetching(self):
+        cache = SharedTokenCache(self.path, self.fetch)
+        cache.get()
+        with patch.object(XOAuth2SMTPClientGoogle, 'token_cache',
+                          return_value=SharedTokenCache(self.path, Mock(side_effect=AssertionError))):
+            client = XOAuth2SMTPClientGoogle(SMTPParamsGoogle(**SMTP_CONFIG))
+        assert client._current_token() == 'token-1'
+
+    def test_token_cache_per_credentials(self):
+        params = SMTPParamsGoogle(**SMTP_CONFIG)
+        other = SMTPParamsGoogle(**{**SMTP_CONFIG, 'smtp-xoauth2-config': {
+            **SMTP_CONFIG['smtp-xoauth2-config'], 'refresh-token': 'other'}})
+        assert XOAuth2SMTPClientGoogle.token_cache(params).path == \
+            XOAuth2SMTPClientGoogle.token_cache(params).path
+        assert XOAuth2SMTPClientGoogle.token_cache(params).path != \
+            XOAuth2SMTPClientGoogle.token_cache(other).path
+
+    def test_refresher(self):
+        refresher = TokenRefresher(SharedTokenCache(self.path, self.fetch), margin=300)
+        assert 3290 < refresher.refresh() <= 3300
+        assert refresher.refresh() <= 3300
+        assert self.fetches == 1